@@ -1,24 +1,92 @@
+"""
+Sum the vehicle class volumes (V1_1..V18_1) of the LOAD{XX}_FINAL.csv loaded
+networks in a directory, writing LOAD{XX}_FINAL-veh_class_sum.csv (or
+.parquet), with A, B, sum(V1_1..V18_1), plus any user-defined class groupings,
+e.g.
+python sum_veh_class.py <directory> --group DA=V1+V4+V7 --format parquet
+(V{i} is short for V{i}_1). All the time periods are processed concurrently,
+streaming from the CSVs straight to the output files (with the streaming
+engine, i.e. in bounded memory).
+"""
+
 import argparse
+import re
 from pathlib import Path
 
 import polars as pl
+from profiling import stage, write_profile
+
+champ_periods = ["EA", "AM", "MD", "PM", "EV"]
+veh_class_cols = [f"V{i}_1" for i in range(1, 19)]
+
+
+def parse_group(group):
+    """e.g. "DA=V1+V4+V7" -> ("DA", ["V1_1", "V4_1", "V7_1"])"""
+    name, _, cols = group.partition("=")
+    if not cols:
+        raise argparse.ArgumentTypeError(
+            f"expected NAME=COL+COL+..., got {group}"
+        )
+    return name.strip(), [
+        f"{col}_1" if re.fullmatch(r"V\d+", col) else col
+        for col in (col.strip() for col in cols.split("+"))
+    ]
+
+
+def sum_veh_class(loaded_network_filepath, groups):
+    """
+    (Lazy) A, B, sum(V1_1..V18_1) and the groups' sums of a loaded network
+
+    groups: {name: [columns to sum]}
+    """
+    return pl.scan_csv(
+        loaded_network_filepath,
+        separator=",",
+        quote_char="'",
+        schema_overrides={
+            col: pl.Float64
+            for col in veh_class_cols
+            + [col for cols in groups.values() for col in cols]
+        },
+    ).select(
+        "A",
+        "B",
+        pl.sum_horizontal(veh_class_cols).alias("sum(V1_1..V18_1)"),
+        *(
+            pl.sum_horizontal(cols).alias(name)
+            for name, cols in groups.items()
+        ),
+    )
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("directory")
+    parser.add_argument(
+        "--group",
+        action="append",
+        default=[],
+        type=parse_group,
+        help="class grouping NAME=COL+COL+..., e.g. DA=V1+V4+V7 (repeatable)",
+    )
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
     args = parser.parse_args()
 
-    champ_periods = ["EA", "AM", "MD", "PM", "EV"]
-    veh_class_cols = [f"V{i}_1" for i in range(1, 19)]
+    groups = dict(args.group)
+    sinks = []
     for champ_period in champ_periods:
         filename_root = f"LOAD{champ_period}_FINAL"
-        df = pl.scan_csv(
-            Path(args.directory, f"{filename_root}.csv"),
-            separator=",",
-            quote_char="'",
-            dtypes={col: pl.Float64 for col in veh_class_cols},
-        ).with_columns(
-            pl.sum_horizontal(veh_class_cols).alias("sum(V1_1..V18_1)")
-        ).select(["A", "B", "sum(V1_1..V18_1)"]).collect().write_csv(
-            Path(args.directory, f"{filename_root}-veh_class_sum.csv")
+        df = sum_veh_class(
+            Path(args.directory, f"{filename_root}.csv"), groups
+        )
+        out_filepath = Path(
+            args.directory, f"{filename_root}-veh_class_sum.{args.format}"
         )
+        if args.format == "parquet":
+            sinks.append(df.sink_parquet(out_filepath, lazy=True))
+        else:
+            sinks.append(df.sink_csv(out_filepath, lazy=True))
+    # run all the time periods' (streaming) queries concurrently
+    with stage("sum_veh_class"):
+        pl.collect_all(sinks, engine="streaming")
+    write_profile(args.directory)
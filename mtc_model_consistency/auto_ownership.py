@@ -1,32 +1,60 @@
 from pathlib import Path
 
-from core import load_config, read_hh_with_home_geog
+from core import daysim_filepath, load_config, read_hh_with_home_geog
+from incremental import run_if_stale
+from preview import (
+    expand,
+    preview_out_dir,
+    sample_fraction,
+    se_filepath,
+    total_se,
+)
+from profiling import profiled, write_profile
 
 
+def out_filepaths(out_dir, forecast_year):
+    out_dir = Path(out_dir)
+    return (
+        out_dir / f"F-ForecastAutoOwnership-county-{forecast_year}.csv",
+        out_dir / f"F-ForecastAutoOwnership-superdst-{forecast_year}.csv",
+    )
+
+
+@profiled
 def auto_ownership(model_run_dir, taz_filepath, out_dir, forecast_year):
     hh = read_hh_with_home_geog(model_run_dir, taz_filepath, {"hhvehs"})
 
-    out_dir = Path(out_dir)
-    out_bycounty_filepath = (
-        out_dir / f"F-ForecastAutoOwnership-county-{forecast_year}.csv"
-    )
-    out_bysuperdst_filepath = (
-        out_dir / f"F-ForecastAutoOwnership-superdst-{forecast_year}.csv"
+    out_bycounty_filepath, out_bysuperdst_filepath = out_filepaths(
+        out_dir, forecast_year
     )
 
-    hh.pivot_table(index=["COUNTY"], columns="hhvehs", aggfunc="size").to_csv(
-        out_bycounty_filepath
-    )
-    hh.pivot_table(
-        index=["SUPERDST"], columns="hhvehs", aggfunc="size"
-    ).to_csv(out_bysuperdst_filepath)
+    # (keeping the TAZ file column names as the index names)
+    for geog, geog_col, filepath in [
+        ("home_county", "COUNTY", out_bycounty_filepath),
+        ("home_superdst", "SUPERDST", out_bysuperdst_filepath),
+    ]:
+        expand(
+            hh.pivot_table(index=[geog], columns="hhvehs", aggfunc="size")
+        ).rename_axis(index=geog_col).to_csv(filepath)
+        if sample_fraction() is not None:
+            total_se(hh, [geog, "hhvehs"]).unstack("hhvehs").rename_axis(
+                index=geog_col
+            ).to_csv(se_filepath(filepath))
 
 
 if __name__ == "__main__":
     config = load_config()
-    auto_ownership(
-        config["champ"]["forecast"]["model_run_dir"],
-        config["champ"]["forecast"]["taz_filepath"],
-        config["out_dir"],
+    model_run_dir = config["champ"]["forecast"]["model_run_dir"]
+    taz_filepath = config["champ"]["forecast"]["taz_filepath"]
+    out_dir = preview_out_dir(config["out_dir"])
+    run_if_stale(
+        auto_ownership,
+        out_filepaths(out_dir, config["forecast_year"]),
+        [daysim_filepath(model_run_dir, "_household_2.dat"), taz_filepath],
+        model_run_dir,
+        taz_filepath,
+        out_dir,
         config["forecast_year"],
+        force=config["force"],
     )
+    write_profile(config["out_dir"])
@@ -0,0 +1,224 @@
+"""
+Run the Daysim reports for both the base and the forecast model runs
+([champ.base] and [champ.forecast] model_run_dir) in one job, e.g.
+python base_vs_forecast.py 2023.toml
+
+Each report is run for the two runs concurrently (so that the reads of one
+run's Daysim outputs overlap the other's processing), writing the usual
+outputs to out_dir/base/ and out_dir/forecast/ (named with base_year and
+forecast_year), then a side by side table of each output to
+out_dir/base_vs_forecast/{forecast output name}-base_vs_forecast.csv, with,
+for each value column, the base, forecast and difference (forecast - base)
+columns.
+
+Both runs use the same TAZ to geography (county, superdistrict) lookup (of
+the forecast taz_filepath; the reports only use its geography columns), so
+that the two runs' tables have the same rows.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import polars as pl
+from auto_ownership import auto_ownership
+from auto_ownership import out_filepaths as auto_ownership_out_filepaths
+from core import daysim_filepath, load_config
+from county_to_county_work_flows import county_to_county_work_flows
+from county_to_county_work_flows import (
+    out_filepaths as work_flows_out_filepaths,
+)
+from incremental import run_if_stale
+from preview import preview_out_dir
+from profiling import profiled, write_profile
+from trip_length_distribution import out_filename as tlfd_out_filename
+from trip_length_distribution import trip_length_distribution
+from trips import out_filenames as trips_out_filenames
+from trips import trips_stats
+
+scenarios = ["base", "forecast"]
+diff_dirname = "base_vs_forecast"
+daysim_filenames = [
+    "_household_2.dat",
+    "_person_2.dat",
+    "_tour_2.dat",
+    "_trip_2.dat",
+]
+
+
+def report_jobs(model_run_dir, taz_filepath, out_dir, year):
+    """
+    The Daysim reports of a model run:
+    [(report, report arguments, {output filepath: key (index) columns})]
+    """
+    out_dir = Path(out_dir)
+    work_flows_filepaths = work_flows_out_filepaths(out_dir, year)
+    return [
+        (
+            trips_stats,
+            (model_run_dir, out_dir, taz_filepath),
+            {
+                out_dir
+                / trips_out_filenames["tripfreq_county"]: ["home_county"],
+                out_dir
+                / trips_out_filenames["tripfreq_superdst"]: ["home_superdst"],
+                out_dir / trips_out_filenames["triplen"]: ["purpose"],
+                out_dir
+                / trips_out_filenames["mode_choice"]: [
+                    "home_county",
+                    "purpose",
+                ],
+            },
+        ),
+        (
+            auto_ownership,
+            (model_run_dir, taz_filepath, out_dir, year),
+            dict(
+                zip(
+                    auto_ownership_out_filepaths(out_dir, year),
+                    [["COUNTY"], ["SUPERDST"]],
+                )
+            ),
+        ),
+        (
+            county_to_county_work_flows,
+            (model_run_dir, taz_filepath, out_dir, year),
+            {
+                work_flows_filepaths["county"]: ["home_county"],
+                work_flows_filepaths["superdst"]: ["home_superdst"],
+                work_flows_filepaths["taz"]: ["home_taz", "work_taz"],
+            },
+        ),
+        (
+            trip_length_distribution,
+            (model_run_dir, out_dir, taz_filepath),
+            {
+                out_dir
+                / tlfd_out_filename: [
+                    "home_county",
+                    "purpose",
+                    "trip_mode",
+                    "travdist_from",
+                    "travdist_to",
+                ]
+            },
+        ),
+    ]
+
+
+def side_by_side(base, forecast, keys):
+    """
+    base and forecast (tables of the same report) joined on the keys
+    columns, with {column} base, {column} forecast and {column} diff
+    (forecast - base) columns for each of their other (value) columns, in
+    the row order of forecast (then the rows only in base)
+    """
+    values = [col for col in forecast.columns if col not in keys]
+
+    def prepare(df, scenario):
+        return df.select(
+            pl.col(keys).cast(pl.String),
+            *(
+                pl.col(col).cast(pl.Float64).alias(f"{col} {scenario}")
+                for col in values
+            ),
+        )
+
+    return (
+        prepare(forecast, "forecast")
+        .join(
+            prepare(base, "base"),
+            on=keys,
+            how="full",
+            coalesce=True,
+            nulls_equal=True,
+            maintain_order="left_right",
+        )
+        .select(
+            *keys,
+            *(
+                expr
+                for col in values
+                for expr in (
+                    pl.col(f"{col} base"),
+                    pl.col(f"{col} forecast"),
+                    (pl.col(f"{col} forecast") - pl.col(f"{col} base")).alias(
+                        f"{col} diff"
+                    ),
+                )
+            ),
+        )
+    )
+
+
+@profiled
+def base_vs_forecast(runs, taz_filepath, out_dir, force=False):
+    """
+    runs: {"base"/"forecast": (model_run_dir, year)}
+    taz_filepath: the TAZ file of the (shared) geography lookup
+    force: rerun the reports even if their outputs are up to date
+    """
+    out_dir = Path(out_dir)
+    for scenario in [*scenarios, diff_dirname]:
+        (out_dir / scenario).mkdir(parents=True, exist_ok=True)
+    jobs = {
+        scenario: report_jobs(
+            model_run_dir, taz_filepath, out_dir / scenario, year
+        )
+        for scenario, (model_run_dir, year) in runs.items()
+    }
+    diff_dir = out_dir / diff_dirname
+    with ThreadPoolExecutor(max_workers=len(scenarios)) as executor:
+        for base_job, forecast_job in zip(jobs["base"], jobs["forecast"]):
+            futures = []
+            for scenario, (report, args, outputs) in zip(
+                scenarios, [base_job, forecast_job]
+            ):
+                model_run_dir = runs[scenario][0]
+                futures.append(
+                    executor.submit(
+                        run_if_stale,
+                        report,
+                        list(outputs),
+                        [
+                            daysim_filepath(model_run_dir, filename)
+                            for filename in daysim_filenames
+                        ]
+                        + [taz_filepath],
+                        *args,
+                        force=force,
+                    )
+                )
+            for future in futures:
+                future.result()
+            for (base_filepath, keys), forecast_filepath in zip(
+                base_job[2].items(), forecast_job[2]
+            ):
+                side_by_side(
+                    pl.read_csv(base_filepath, infer_schema_length=None),
+                    pl.read_csv(forecast_filepath, infer_schema_length=None),
+                    keys,
+                ).write_csv(
+                    diff_dir / f"{forecast_filepath.stem}-{diff_dirname}.csv"
+                )
+
+
+if __name__ == "__main__":
+    config = load_config()
+    if "model_run_dir" not in config["champ"]["base"]:
+        raise SystemExit("no [champ.base] model_run_dir in the config")
+    base_vs_forecast(
+        {
+            "base": (
+                config["champ"]["base"]["model_run_dir"],
+                config["base_year"],
+            ),
+            "forecast": (
+                config["champ"]["forecast"]["model_run_dir"],
+                config["forecast_year"],
+            ),
+        },
+        config["champ"]["forecast"]["taz_filepath"],
+        preview_out_dir(config["out_dir"]),
+        force=config["force"],
+    )
+    write_profile(config["out_dir"])
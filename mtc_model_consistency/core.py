@@ -1,14 +1,25 @@
 import argparse
+import hashlib
 import tomllib
 from pathlib import Path
 
 import pandas as pd
 import polars as pl
+from preview import configure as configure_preview
+from preview import sample_fraction, sample_households
+from profiling import profiled, stage
+from staging import configure as configure_staging
+from staging import staged_filepath
 
 time_periods = ["EA", "AM", "MD", "PM", "EV"]
 
 
-def load_config():
+def load_config(add_arguments=None):
+    """
+    add_arguments: function adding script specific arguments (after the
+    config filename) to the argparse.ArgumentParser; all the parsed
+    arguments are in config["args"]
+    """
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "config_filename",
@@ -17,54 +28,418 @@ def load_config():
             "champ-postprocess/mtc_model_consistency/configs/"
         ),
     )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="rerun even if the outputs are up to date with their inputs",
+    )
+    parser.add_argument(
+        "--preview",
+        type=float,
+        metavar="FRACTION",
+        help=(
+            "run the Daysim reports on this fraction of the households "
+            "(e.g. 0.05), see preview.py"
+        ),
+    )
+    if add_arguments is not None:
+        add_arguments(parser)
     args = parser.parse_args()
     with open(
         Path(__file__).parent.resolve() / "configs" / args.config_filename,
         "rb",
     ) as f:
-        return tomllib.load(f)
+        config = tomllib.load(f)
+    config["force"] = args.force
+    # where the parsed inputs (GIS/Excel, link stores, Parquet copies) are
+    # cached
+    config.setdefault("cache_dir", Path(config["out_dir"]) / ".cache")
+    config["args"] = args
+    configure_preview(args.preview)
+    configure_staging(
+        config.get("staging_dir"), config.get("staging_max_size_gb")
+    )
+    return config
 
 
+@profiled
 def read_taz(taz_filepath, usecols=None):
     if usecols:
         usecols = {"SFTAZ", "COUNTY", "SUPERDST"} | set(usecols)
     else:
         usecols = {"SFTAZ", "COUNTY", "SUPERDST"}
-    return pd.read_csv(taz_filepath, usecols=usecols)
+    return pd.read_csv(staged_filepath(taz_filepath), usecols=usecols)
+
+
+def _file_fingerprint(filepath):
+    """
+    Fingerprint of the version of a file, from its size and modification
+    time (i.e. without reading it, e.g. from a network share)
+    """
+    stat = Path(filepath).stat()
+    return hashlib.sha256(
+        f"{stat.st_size}-{stat.st_mtime_ns}".encode()
+    ).hexdigest()
 
 
-def _read_model_output_dat(model_run_dir, filename, usecols=None):
-    return pd.read_csv(
-        Path(model_run_dir) / "daysim" / "abm_output1" / filename,
-        sep=r"\s+",
-        usecols=usecols,
+def _extract_mtc_taz_landuse(taz_excel_filepath):
+    """
+    Extract every year sheet (e.g. "2015", "2050") of the MTC land use
+    workbook into one table (with a year column), in a single read-only
+    (streaming) pass through the workbook
+    """
+    # imported here, so that the reports that don't read the workbook don't
+    # need openpyxl
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(
+        taz_excel_filepath, read_only=True, data_only=True
+    )
+    try:
+        year_tables = []
+        for sheet_name in workbook.sheetnames:
+            if not sheet_name.isdigit():
+                continue
+            rows = workbook[sheet_name].iter_rows(values_only=True)
+            header = next(rows)
+            # skip empty (formatted but unused) columns and rows
+            cols = [i for i, h in enumerate(header) if h is not None]
+            year_tables.append(
+                pl.DataFrame(
+                    (
+                        [row[i] for i in cols]
+                        for row in rows
+                        if any(v is not None for v in row)
+                    ),
+                    schema=[str(header[i]) for i in cols],
+                    orient="row",
+                    infer_schema_length=None,
+                ).with_columns(pl.lit(int(sheet_name), pl.Int16).alias("year"))
+            )
+    finally:
+        workbook.close()
+    return pl.concat(year_tables, how="diagonal_relaxed").select(
+        pl.col("year"), pl.exclude("year")
     )
 
 
-def read_hh(model_run_dir, usecols=None):
+@profiled
+def read_mtc_taz_landuse(
+    taz_excel_filepath, cache_dir, years=None, usecols=None
+):
+    """
+    MTC TAZ land use (e.g. PBA50_FinalBlueprintLandUse_TAZdata.xlsx) for all
+    (or the requested) years, as one DataFrame with a year column.
+
+    The workbook is only parsed once: all its year sheets are cached as one
+    Parquet file in cache_dir, keyed by the workbook's size and modification
+    time, so later reads (for any years/columns) skip the Excel parsing.
+    """
+    cache_filepath = Path(cache_dir) / (
+        f"{Path(taz_excel_filepath).stem}-"
+        f"{_file_fingerprint(taz_excel_filepath)[:16]}.parquet"
+    )
+    if not cache_filepath.exists():
+        cache_filepath.parent.mkdir(parents=True, exist_ok=True)
+        _extract_mtc_taz_landuse(taz_excel_filepath).write_parquet(
+            cache_filepath
+        )
+    landuse = pl.scan_parquet(cache_filepath)
+    if years is not None:
+        landuse = landuse.filter(pl.col("year").is_in(list(years)))
+    if usecols is not None:
+        landuse = landuse.select(
+            ["year"] + [c for c in usecols if c != "year"]
+        )
+    return landuse.collect().to_pandas()
+
+
+# Daysim 2.1 output file schemas (source: Daysim2.1 Users Guide.xlsx), with
+# the narrowest integer dtypes that hold each column's range (signed, as -1 is
+# used for "not applicable"), and float32 for times/costs/distances/weights.
+# Columns not listed here (e.g. ones added in a later Daysim version) are left
+# to dtype inference.
+daysim_schemas = {
+    "_household_2.dat": {
+        "hhno": "int32",
+        "hhsize": "int8",
+        "hhvehs": "int8",
+        "hhwkrs": "int8",
+        "hhftw": "int8",
+        "hhptw": "int8",
+        "hhret": "int8",
+        "hhoad": "int8",
+        "hhuni": "int8",
+        "hhhsc": "int8",
+        "hh515": "int8",
+        "hhcu5": "int8",
+        "hhincome": "int32",
+        "hownrent": "int8",
+        "hrestype": "int8",
+        "hhparcel": "int32",
+        "hhtaz": "int16",
+        "hhexpfac": "float32",
+        "samptype": "int8",
+    },
+    "_person_2.dat": {
+        "hhno": "int32",
+        "pno": "int8",
+        "pptyp": "int8",
+        "pagey": "int8",
+        "pgend": "int8",
+        "pwtyp": "int8",
+        "pwpcl": "int32",
+        "pwtaz": "int16",
+        "pwautime": "float32",
+        "pwaudist": "float32",
+        "pstyp": "int8",
+        "pspcl": "int32",
+        "pstaz": "int16",
+        "psautime": "float32",
+        "psaudist": "float32",
+        "puwmode": "int8",
+        "puwarrp": "int16",
+        "puwdepp": "int16",
+        "ptpass": "int8",
+        "ppaidprk": "int8",
+        "pdiary": "int8",
+        "pproxy": "int8",
+        "psexpfac": "float32",
+    },
+    "_tour_2.dat": {
+        "hhno": "int32",
+        "pno": "int8",
+        "day": "int8",
+        "tour": "int8",
+        "jtindex": "int16",
+        "parent": "int8",
+        "subtrs": "int8",
+        "pdpurp": "int8",
+        "tlvorig": "int16",
+        "tardest": "int16",
+        "tlvdest": "int16",
+        "tarorig": "int16",
+        "toadtyp": "int8",
+        "tdadtyp": "int8",
+        "topcl": "int32",
+        "totaz": "int16",
+        "tdpcl": "int32",
+        "tdtaz": "int16",
+        "tmodetp": "int8",
+        "tpathtp": "int8",
+        "tautotime": "float32",
+        "tautocost": "float32",
+        "tautodist": "float32",
+        "tripsh1": "int8",
+        "tripsh2": "int8",
+        "phtindx1": "int16",
+        "phtindx2": "int16",
+        "fhtindx1": "int16",
+        "fhtindx2": "int16",
+        "toexpfac": "float32",
+        "id": "int64",
+    },
+    "_trip_2.dat": {
+        "hhno": "int32",
+        "pno": "int8",
+        "day": "int8",
+        "tour": "int8",
+        "jtindex": "int16",
+        "half": "int8",
+        "tseg": "int8",
+        "tsvid": "int8",
+        "opurp": "int8",
+        "dpurp": "int8",
+        "oadtyp": "int8",
+        "dadtyp": "int8",
+        "opcl": "int32",
+        "otaz": "int16",
+        "dpcl": "int32",
+        "dtaz": "int16",
+        "mode": "int8",
+        "pathtype": "int8",
+        "dorp": "int8",
+        "deptm": "int16",
+        "arrtm": "int16",
+        "endacttm": "int16",
+        "travtime": "float32",
+        "travcost": "float32",
+        "travdist": "float32",
+        "vot": "float32",
+        "trexpfac": "float32",
+        "id": "int64",
+        "tour_id": "int64",
+    },
+}
+
+# source: Daysim2.1 Users Guide.xlsx
+modes_champ = {
+    0: "none",
+    1: "walk",
+    2: "bike",
+    3: "sov",
+    4: "hov 2",
+    5: "hov 3",
+    6: "walk to transit",
+    7: "park and ride",
+    8: "school bus",
+    9: "other",
+}
+
+# source: Daysim2.1 Users Guide.xlsx
+purposes_champ = {
+    0: "none/home",
+    1: "work",
+    2: "school",
+    3: "escort",
+    4: "pers.bus",
+    5: "shop",
+    6: "meal",
+    7: "social",
+    8: "recreational",  # (currently combined with social)
+    9: "medical",  # (currently combined with pers.bus.)
+    10: "change mode inserted purpose",
+    # extra:
+    11: "work-based",
+    12: "college/university",
+    13: "other school",
+}
+
+# source: Daysim2.1 Users Guide.xlsx
+person_type = {
+    1: "Full time worker",
+    2: "Part time worker",
+    3: 'Non working adult age 6"5+',
+    4: "Non working adult age<65",
+    5: "University student",
+    6: "High school student age 16+",
+    7: "Child age 5-15",
+    8: "Child age 0-4",
+}
+
+# {Daysim column: code labels}
+daysim_labels = {
+    "mode": modes_champ,
+    "tmodetp": modes_champ,
+    "opurp": purposes_champ,
+    "dpurp": purposes_champ,
+    "pdpurp": purposes_champ,
+    "pptyp": person_type,
+}
+
+
+def label_codes(codes, labels, categories=None):
+    """
+    Map the (integer) codes Series to its labels as a categorical Series
+    (instead of object strings); codes without a label become NaN.
+
+    labels: {code: label}, e.g. daysim_labels["mode"] or a CHAMP-to-MTC dict
+    categories: the (ordered) categories, default: the labels' unique values
+    """
+    if categories is None:
+        categories = list(dict.fromkeys(labels.values()))
+    return codes.map(labels).astype(pd.CategoricalDtype(categories))
+
+
+def daysim_filepath(model_run_dir, filename):
+    return Path(model_run_dir) / "daysim" / "abm_output1" / filename
+
+
+# rows read at a time when sampling the Daysim outputs (preview mode)
+preview_chunksize = 1_000_000
+
+
+def run_cache_dir(model_run_dir, cache_dir, name):
+    """
+    a directory in cache_dir for cached data (e.g. name: "link_store") of
+    model_run_dir, unique to model_run_dir
+    """
+    model_run_dir = Path(model_run_dir).resolve()
+    model_run_hash = hashlib.sha256(str(model_run_dir).encode()).hexdigest()
+    return (
+        Path(cache_dir) / f"{name}-{model_run_dir.name}-{model_run_hash[:8]}"
+    )
+
+
+def _read_model_output_dat(
+    model_run_dir, filename, usecols=None, chunksize=None
+):
+    """
+    The whole file, or, with a chunksize, an iterator of chunks of chunksize
+    rows (see _read_dat())
+    """
+    if chunksize is not None:
+        return _read_dat(model_run_dir, filename, usecols, chunksize)
+    # profiled here rather than in the readers, as with a chunksize they only
+    # create the iterator: reading the chunks is then profiled as part of the
+    # stage consuming them
+    with stage(f"read {filename}") as record:
+        df = _read_dat(model_run_dir, filename, usecols, None)
+        record["rows_out"] = len(df)
+    return df
+
+
+def _read_dat(model_run_dir, filename, usecols, chunksize):
+    """
+    In preview mode, only the rows of the sampled households are returned,
+    the file being read and filtered chunk by chunk
+    """
+    if sample_fraction() is None:
+        return pd.read_csv(
+            staged_filepath(daysim_filepath(model_run_dir, filename)),
+            sep=r"\s+",
+            usecols=usecols,
+            dtype=daysim_schemas.get(filename),
+            chunksize=chunksize,
+        )
+    chunks = (
+        (
+            sample_households(chunk)
+            if usecols is None or "hhno" in usecols
+            else sample_households(chunk).drop(columns="hhno")
+        )
+        for chunk in pd.read_csv(
+            staged_filepath(daysim_filepath(model_run_dir, filename)),
+            sep=r"\s+",
+            usecols=None if usecols is None else {"hhno"} | set(usecols),
+            dtype=daysim_schemas.get(filename),
+            chunksize=chunksize or preview_chunksize,
+        )
+    )
+    if chunksize is not None:
+        return chunks
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_hh(model_run_dir, usecols=None, chunksize=None):
     return _read_model_output_dat(
-        model_run_dir, "_household_2.dat", usecols=usecols
+        model_run_dir, "_household_2.dat", usecols=usecols, chunksize=chunksize
     )
 
 
-def read_pers(model_run_dir, usecols=None):
+def read_pers(model_run_dir, usecols=None, chunksize=None):
     return _read_model_output_dat(
-        model_run_dir, "_person_2.dat", usecols=usecols
+        model_run_dir, "_person_2.dat", usecols=usecols, chunksize=chunksize
     )
 
 
-def read_tours(model_run_dir, usecols=None):
+def read_tours(model_run_dir, usecols=None, chunksize=None):
     return _read_model_output_dat(
-        model_run_dir, "_tour_2.dat", usecols=usecols
+        model_run_dir, "_tour_2.dat", usecols=usecols, chunksize=chunksize
     )
 
 
-def read_trips(model_run_dir, usecols=None):
+def read_trips(model_run_dir, usecols=None, chunksize=None):
+    """
+    chunksize: if given, return an iterator of DataFrames of chunksize rows
+    (see pd.read_csv) instead of the whole table
+    """
     return _read_model_output_dat(
-        model_run_dir, "_trip_2.dat", usecols=usecols
+        model_run_dir, "_trip_2.dat", usecols=usecols, chunksize=chunksize
     )
 
 
+@profiled
 def read_hh_pers(model_run_dir, hh_usecols=None, pers_usecols=None):
     if hh_usecols:
         hh_usecols = {"hhno"} | set(hh_usecols)
@@ -79,6 +454,7 @@ def read_hh_pers(model_run_dir, hh_usecols=None, pers_usecols=None):
     return pd.merge(hh, pers, on=["hhno"])
 
 
+@profiled
 def read_tours_pers(
     model_run_dir,
     tours_usecols=None,
@@ -97,6 +473,7 @@ def read_tours_pers(
     return pd.merge(pers, tours, on=["pno"])
 
 
+@profiled
 def read_tours_hh_pers(
     model_run_dir,
     tours_usecols=None,
@@ -114,6 +491,7 @@ def read_tours_hh_pers(
     return pd.merge(hh_pers, tours, on=["hhno", "pno"])
 
 
+@profiled
 def merge_home_geog(hh, taz):
     """
     hh: can be any DataFrame with the hhtaz column from the household file
@@ -132,6 +510,7 @@ def merge_home_geog(hh, taz):
     )
 
 
+@profiled
 def merge_work_geog(pers, taz):
     """
     pers: can be any DataFrame with the pwtaz column from the household file
@@ -154,6 +533,7 @@ def merge_home_and_work_geog(hh_pers, taz):
     return merge_work_geog(merge_home_geog(hh_pers, taz), taz)
 
 
+@profiled
 def read_hh_with_home_geog(model_run_dir, taz_filepath, hh_usecols=None):
     if hh_usecols:
         hh_usecols = {"hhno", "hhtaz"} | set(hh_usecols)
@@ -164,6 +544,7 @@ def read_hh_with_home_geog(model_run_dir, taz_filepath, hh_usecols=None):
     return merge_home_geog(hh, taz)
 
 
+@profiled
 def read_pers_with_home_geog(
     model_run_dir, taz_filepath, hh_usecols=None, pers_usecols=None
 ):
@@ -178,6 +559,7 @@ def read_pers_with_home_geog(
     return pd.merge(hh, pers, on=["hhno"])
 
 
+@profiled
 def read_tours_with_home_geog(
     model_run_dir,
     taz_filepath,
@@ -199,6 +581,14 @@ def read_tours_with_home_geog(
     return pd.merge(pers, tours, on=["hhno", "pno"])
 
 
+def loaded_network_filepath(model_run_dir, time_period):
+    """
+    created with Y:/champ/util/Validation/NETtoCSV_simple.s
+    (see champ-postprocess/cube/csv/README.md)
+    """
+    return Path(model_run_dir) / f"LOAD{time_period}_FINAL.csv"
+
+
 def time_period_conversion_champ_to_mtc(df):
     """
     Convert from 3hr (CHAMP) to 4hr (MTC) peaks while maintaining totals.
@@ -1,50 +1,157 @@
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
 from core import (
+    daysim_filepath,
     load_config,
-    merge_home_and_work_geog,
+    read_hh,
+    read_pers,
     read_taz,
-    read_tours_hh_pers,
+    read_tours,
 )
+from incremental import run_if_stale
+from od_matrix import aggregate_od, od_matrix, od_table, taz_geographies
+from preview import (
+    expand,
+    preview_out_dir,
+    sample_fraction,
+    se_filepath,
+    total_se,
+)
+from profiling import profiled, write_profile
+
+# {geography level: (TAZ file column, output name infix)}
+flow_geogs = {
+    "county": ("COUNTY", ""),
+    "superdst": ("SUPERDST", "-superdst"),
+}
+
+
+def out_filepaths(out_dir, forecast_year):
+    """{geography level (county, superdst, taz): output filepath}"""
+    infixes = {level: infix for level, (_, infix) in flow_geogs.items()}
+    return {
+        level: Path(out_dir)
+        / (
+            "H-ForecastActivityLocation-"
+            f"journey_to_work_flows{infix}-{forecast_year}.csv"
+        )
+        for level, infix in (infixes | {"taz": "-taz"}).items()
+    }
 
 
+@profiled
+def read_journey_to_work_workers(model_run_dir):
+    """
+    The home (hhtaz) and work (pwtaz) TAZs of the persons making work tours,
+    each person counted once (even if making multiple work tours a day)
+    """
+    tours = read_tours(model_run_dir, usecols=["hhno", "pno", "pdpurp"])
+    # tour purpose == work
+    # Disabled: tour destination TAZ == work location TAZ (of the person)
+    # disabled because work tours do NOT necessarily have to end at the work TAZ in Daysim
+    work_tours = tours[tours["pdpurp"] == 1]
+    # only count once for people who makes multiple work tours a day,
+    # deduplicating on the (hhno, pno) key before attaching any geography
+    workers = work_tours[["hhno", "pno"]].drop_duplicates()
+    return workers.merge(
+        read_pers(model_run_dir, usecols=["hhno", "pno", "pwtaz"]),
+        on=["hhno", "pno"],
+    ).merge(read_hh(model_run_dir, usecols=["hhno", "hhtaz"]), on="hhno")
+
+
+@profiled
 def county_to_county_work_flows(
     model_run_dir, taz_filepath, out_dir, forecast_year
 ):
-    out_dir = Path(out_dir)
-    out_filepath = out_dir / (
-        "H-ForecastActivityLocation-"
-        f"journey_to_work_flows-{forecast_year}.csv"
-    )
-
+    """
+    Journey to work flows (workers) by home and work county, superdistrict
+    and TAZ, all from one TAZ x TAZ OD matrix
+    """
     taz = read_taz(taz_filepath)
-    tours_hh_pers = read_tours_hh_pers(
-        model_run_dir,
-        tours_usecols=["tdtaz", "pdpurp"],
-        hh_usecols=["hhtaz"],
-        pers_usecols=["pwtaz"],
+    tazs, geogs = taz_geographies(
+        taz, [geog for geog, _ in flow_geogs.values()]
     )
-    journey_to_work_tours = (
-        tours_hh_pers[
-            # tour purpose == work
-            (tours_hh_pers["pdpurp"] == 1)
-            # Disabled: tour destination TAZ == work location TAZ (of the person)
-            # disabled because work tours do NOT necessarily have to end at the work TAZ in Daysim
-            # & (tours_hh_pers["pwtaz"] == tours_hh_pers["tdtaz"])
-        ]
-        # only count once for people who makes multiple work tours to the work-TAZ a day
-        .drop_duplicates()
+    workers = read_journey_to_work_workers(model_run_dir)
+    # only the home/work TAZs in the TAZ file
+    workers = workers[
+        np.isin(workers["hhtaz"], tazs) & np.isin(workers["pwtaz"], tazs)
+    ]
+    home_work_od = expand(od_matrix(tazs, workers["hhtaz"], workers["pwtaz"]))
+    filepaths = out_filepaths(out_dir, forecast_year)
+    for level, (geog_col, _) in flow_geogs.items():
+        zones = geogs[geog_col].zones
+        od_table(
+            aggregate_od(home_work_od, geogs[geog_col]),
+            zones,
+            zones,
+            f"home_{level}",
+            f"work_{level}",
+        ).to_csv(filepaths[level])
+    # TAZ flows (long, as TAZ x TAZ would mostly be zeros)
+    home_tazs, work_tazs = np.nonzero(home_work_od)
+    taz_flows = pd.DataFrame(
+        {
+            "home_taz": tazs[home_tazs],
+            "work_taz": tazs[work_tazs],
+            "workers": home_work_od[home_tazs, work_tazs],
+        }
     )
-    merge_home_and_work_geog(journey_to_work_tours, taz).pivot_table(
-        index="home_county", columns="work_county", aggfunc="size"
-    ).to_csv(out_filepath)
+    taz_flows.to_csv(filepaths["taz"], index=False)
+    if sample_fraction() is not None:
+        work_flows_se(workers, taz, geogs, taz_flows, filepaths)
+
+
+def work_flows_se(workers, taz, geogs, taz_flows, filepaths):
+    """
+    Write the standard errors of the (expanded) journey to work flows of
+    the sampled workers (preview mode)
+    """
+    zones_of_tazs = taz.set_index("SFTAZ")
+    for level, (geog_col, _) in flow_geogs.items():
+        zones = geogs[geog_col].zones
+        total_se(
+            workers.assign(
+                home=workers["hhtaz"].map(zones_of_tazs[geog_col]),
+                work=workers["pwtaz"].map(zones_of_tazs[geog_col]),
+            ),
+            ["home", "work"],
+        ).unstack("work", fill_value=0).reindex(
+            index=zones, columns=zones, fill_value=0
+        ).rename_axis(
+            index=f"home_{level}", columns=f"work_{level}"
+        ).to_csv(
+            se_filepath(filepaths[level])
+        )
+    taz_flows[["home_taz", "work_taz"]].assign(
+        workers=total_se(workers, ["hhtaz", "pwtaz"])
+        .reindex(pd.MultiIndex.from_frame(taz_flows[["home_taz", "work_taz"]]))
+        .to_numpy()
+    ).to_csv(se_filepath(filepaths["taz"]), index=False)
 
 
 if __name__ == "__main__":
     config = load_config()
-    county_to_county_work_flows(
-        config["champ"]["forecast"]["model_run_dir"],
-        config["champ"]["forecast"]["taz_filepath"],
-        config["out_dir"],
+    model_run_dir = config["champ"]["forecast"]["model_run_dir"]
+    taz_filepath = config["champ"]["forecast"]["taz_filepath"]
+    out_dir = preview_out_dir(config["out_dir"])
+    run_if_stale(
+        county_to_county_work_flows,
+        list(out_filepaths(out_dir, config["forecast_year"]).values()),
+        [
+            daysim_filepath(model_run_dir, filename)
+            for filename in [
+                "_household_2.dat",
+                "_person_2.dat",
+                "_tour_2.dat",
+            ]
+        ]
+        + [taz_filepath],
+        model_run_dir,
+        taz_filepath,
+        out_dir,
         config["forecast_year"],
+        force=config["force"],
     )
+    write_profile(config["out_dir"])
@@ -0,0 +1,218 @@
+"""
+Land use comparison tables (CHAMP vs MTC) for the base and forecast years:
+Table B.1/B.2 (base county/superdistrict) and C.1/C.2 (forecast)
+"""
+
+from pathlib import Path
+
+import polars as pl
+from core import load_config, read_mtc_taz_landuse, read_taz
+from incremental import run_if_stale
+from profiling import profiled, write_profile
+
+# {output column: (CHAMP tazdata column, MTC land use expression)}
+landuse_variables = {
+    "population": ("POP", pl.col("TOTPOP")),
+    "Households": ("HHLDS", pl.col("TOTHH")),
+    # the MTC non-institutional group quarters types (university, military,
+    # other non-institutional), not TOTPOP - HHPOP (all group quarters)
+    "Non-Institutional Group Quarters Population": (
+        "GQPOP",
+        pl.sum_horizontal("gq_type_univ", "gq_type_mil", "gq_type_othnon"),
+    ),
+    "Jobs": ("TOTALEMP", pl.col("TOTEMP")),
+    "Employed Residents": ("EMPRES", pl.col("EMPRES")),
+}
+
+geogs = ["COUNTY", "SD"]
+
+# {(scenario, geog): output filename (in out_dir/landuse_out_dirname)}
+landuse_out_dirname = "2.Land Use"
+demographics_tables = {
+    ("base", "COUNTY"): "Table B.1 Base County Demographics.csv",
+    ("base", "SD"): "Table B.2 Base Superdistrict Demographics.csv",
+    ("forecast", "COUNTY"): "Table C.1 Forecast County Demographics.csv",
+    ("forecast", "SD"): "Table C.2 Forecast Superdistrict Demographics.csv",
+}
+
+
+def superdistrict(district=pl.col("DISTRICT")):
+    # the (MTC) districts 1-4 are all in SF, and are combined into one
+    return pl.when(district > 4).then(district).otherwise(1).alias("SD")
+
+
+@profiled
+def read_champ_landuse(taz_filepath, mtc_districts):
+    """
+    CHAMP tazdata, with the (MTC) superdistrict of each TAZ from mtc_districts
+    (MTCTAZ, DISTRICT)
+    """
+    champ_taz = pl.from_pandas(
+        read_taz(
+            taz_filepath,
+            usecols={"MTCTAZ"}
+            | {champ for champ, _ in landuse_variables.values()},
+        )
+    )
+    return champ_taz.join(mtc_districts, on="MTCTAZ").select(
+        "COUNTY",
+        superdistrict(),
+        *(
+            pl.col(champ).alias(var)
+            for var, (champ, _) in landuse_variables.items()
+        ),
+    )
+
+
+@profiled
+def read_mtc_landuse(mtc_taz_excel_filepath, years, cache_dir):
+    return pl.from_pandas(
+        read_mtc_taz_landuse(
+            mtc_taz_excel_filepath,
+            cache_dir,
+            years=years,
+            usecols={"ZONE", "COUNTY", "DISTRICT"}
+            | {
+                col
+                for _, mtc_expr in landuse_variables.values()
+                for col in mtc_expr.meta.root_names()
+            },
+        )
+    )
+
+
+@profiled
+def aggregate_landuse(landuse):
+    """
+    Sum the land use variables by geography (COUNTY and SD) in one grouped
+    aggregation, by stacking the geographies into (geog, zone) columns
+
+    landuse: TAZ-level table with scenario, source, COUNTY, SD columns
+    """
+    return (
+        pl.concat(
+            landuse.select(
+                "scenario",
+                "source",
+                pl.lit(geog).alias("geog"),
+                pl.col(geog).alias("zone"),
+                *landuse_variables,
+            )
+            for geog in geogs
+        )
+        .group_by("scenario", "source", "geog", "zone")
+        .agg(pl.col(list(landuse_variables)).sum())
+    )
+
+
+def compare_champ_mtc(landuse_by_geog, scenario, geog):
+    """CHAMP and MTC side by side, plus their differences"""
+    tables = {
+        source: landuse_by_geog.filter(
+            (pl.col("scenario") == scenario)
+            & (pl.col("geog") == geog)
+            & (pl.col("source") == source)
+        ).select(
+            pl.col("zone").alias(geog),
+            *(
+                pl.col(var).alias(f"{var}-{source}")
+                for var in landuse_variables
+            ),
+        )
+        for source in ["CHAMP", "MTC"]
+    }
+    return (
+        tables["CHAMP"]
+        .join(tables["MTC"], on=geog, how="full", coalesce=True)
+        .with_columns(
+            (pl.col(f"{var}-CHAMP") - pl.col(f"{var}-MTC")).alias(
+                f"{var}-diff-CHAMP_-_MTC"
+            )
+            for var in landuse_variables
+        )
+        .sort(geog)
+    )
+
+
+@profiled
+def demographics(
+    champ_base_taz_filepath,
+    champ_forecast_taz_filepath,
+    mtc_taz_excel_filepath,
+    out_dir,
+    base_year,
+    forecast_year,
+    cache_dir,
+):
+    out_dir = Path(out_dir) / landuse_out_dirname
+    mtc = read_mtc_landuse(
+        mtc_taz_excel_filepath, [base_year, forecast_year], cache_dir
+    )
+    # the CHAMP TAZs get their (super)district from the MTC base year
+    mtc_districts = mtc.filter(pl.col("year") == base_year).select(
+        pl.col("ZONE").alias("MTCTAZ"), "DISTRICT"
+    )
+    landuse = pl.concat(
+        (
+            read_champ_landuse(
+                champ_base_taz_filepath, mtc_districts
+            ).with_columns(
+                pl.lit("base").alias("scenario"),
+                pl.lit("CHAMP").alias("source"),
+            ),
+            read_champ_landuse(
+                champ_forecast_taz_filepath, mtc_districts
+            ).with_columns(
+                pl.lit("forecast").alias("scenario"),
+                pl.lit("CHAMP").alias("source"),
+            ),
+            mtc.select(
+                pl.when(pl.col("year") == base_year)
+                .then(pl.lit("base"))
+                .otherwise(pl.lit("forecast"))
+                .alias("scenario"),
+                pl.lit("MTC").alias("source"),
+                "COUNTY",
+                superdistrict(),
+                *(
+                    mtc_expr.alias(var)
+                    for var, (_, mtc_expr) in landuse_variables.items()
+                ),
+            ),
+        ),
+        how="diagonal_relaxed",
+    )
+    landuse_by_geog = aggregate_landuse(landuse)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for (scenario, geog), out_filename in demographics_tables.items():
+        compare_champ_mtc(landuse_by_geog, scenario, geog).write_csv(
+            out_dir / out_filename
+        )
+
+
+if __name__ == "__main__":
+    config = load_config()
+    champ_base_taz_filepath = config["champ"]["base"]["taz_filepath"]
+    champ_forecast_taz_filepath = config["champ"]["forecast"]["taz_filepath"]
+    mtc_taz_excel_filepath = config["mtc"]["taz_excel_filepath"]
+    run_if_stale(
+        demographics,
+        [
+            Path(config["out_dir"]) / landuse_out_dirname / out_filename
+            for out_filename in demographics_tables.values()
+        ],
+        [
+            champ_base_taz_filepath,
+            champ_forecast_taz_filepath,
+            mtc_taz_excel_filepath,
+        ],
+        champ_base_taz_filepath,
+        champ_forecast_taz_filepath,
+        mtc_taz_excel_filepath,
+        config["out_dir"],
+        config["base_year"],
+        config["forecast_year"],
+        cache_dir=config["cache_dir"],
+        force=config["force"],
+    )
+    write_profile(config["out_dir"])
@@ -0,0 +1,68 @@
+"""
+Cross-process lock of the files shared by concurrently run reports (e.g. the
+manifests of incremental.py and staging.py), and unique temporary filepaths
+to write them atomically (write, then os.replace).
+
+The lock is a lock file created exclusively (O_EXCL), which works the same on
+Windows, Linux and network shares. Its holder touches it every
+stale_lock_s / 4 (e.g. during a long conversion), so a lock file not
+modified for stale_lock_s is assumed to be left by a crashed process, and is
+removed.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+lock_poll_interval_s = 0.05
+stale_lock_s = 600
+
+
+def tmp_filepath(filepath):
+    """a temporary filepath next to filepath, unique to the process/thread"""
+    filepath = Path(filepath)
+    return filepath.with_name(
+        f"{filepath.name}.{os.getpid()}-{threading.get_ident()}.tmp"
+    )
+
+
+def _keep_fresh(lock_filepath, released):
+    while not released.wait(stale_lock_s / 4):
+        try:
+            os.utime(lock_filepath)
+        except FileNotFoundError:
+            return
+
+
+def _remove_if_stale(lock_filepath):
+    try:
+        if time.time() - lock_filepath.stat().st_mtime > stale_lock_s:
+            lock_filepath.unlink(missing_ok=True)
+    except FileNotFoundError:  # released meanwhile
+        pass
+
+
+@contextmanager
+def file_lock(filepath):
+    """Hold the lock of filepath (the {filepath}.lock file), waiting for it"""
+    lock_filepath = Path(f"{filepath}.lock")
+    while True:
+        try:
+            fd = os.open(lock_filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            _remove_if_stale(lock_filepath)
+            time.sleep(lock_poll_interval_s)
+    released = threading.Event()
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        os.close(fd)
+        threading.Thread(
+            target=_keep_fresh, args=(lock_filepath, released), daemon=True
+        ).start()
+        yield
+    finally:
+        released.set()
+        lock_filepath.unlink(missing_ok=True)
@@ -0,0 +1,168 @@
+"""
+Incremental rebuild of the consistency report outputs: each output file is
+recorded (in a .build-manifest.json next to it) with a fingerprint of
+- the content of its input files,
+- the config values it is run with, and
+- the code version (the source of the modules of this directory it uses),
+so that rerunning a report whose outputs are all up to date is skipped.
+
+Input files are only rehashed when their size or modification time changed,
+and are staged locally first if a staging directory is configured (see
+staging.py).
+Run a script with --force to rebuild regardless.
+"""
+
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+
+from file_lock import file_lock, tmp_filepath
+from staging import prefetch, staged_filepath
+
+manifest_filename = ".build-manifest.json"
+
+
+def _read_manifest(manifest_filepath):
+    try:
+        with open(manifest_filepath) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"outputs": {}, "inputs": {}}
+
+
+def _write_manifest(manifest, manifest_filepath):
+    # write then rename, so that an interrupted run can't corrupt it
+    manifest_tmp_filepath = tmp_filepath(manifest_filepath)
+    with open(manifest_tmp_filepath, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_tmp_filepath, manifest_filepath)
+
+
+def _update_manifest(manifest_filepath, outputs, input_hashes):
+    """
+    Merge the outputs' fingerprints and the input hashes into the manifest,
+    re-read under its lock, so as to keep the entries written meanwhile by
+    the reports run concurrently with outputs in the same directory
+    """
+    with file_lock(manifest_filepath):
+        manifest = _read_manifest(manifest_filepath)
+        manifest["outputs"].update(outputs)
+        manifest["inputs"].update(input_hashes)
+        _write_manifest(manifest, manifest_filepath)
+
+
+def _content_hash(filepath, hash_cache):
+    """
+    sha256 of the file's content, reusing the hash in hash_cache
+    ({filepath: {"size", "mtime_ns", "sha256"}}) if the file is unchanged
+    """
+    stat = filepath.stat()
+    cached = hash_cache.get(str(filepath))
+    if (
+        cached
+        and cached["size"] == stat.st_size
+        and cached["mtime_ns"] == stat.st_mtime_ns
+    ):
+        return cached["sha256"]
+    with open(filepath, "rb") as f:
+        sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+    hash_cache[str(filepath)] = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "sha256": sha256,
+    }
+    return sha256
+
+
+def _resolve(filepath):
+    return Path(filepath).resolve()
+
+
+def _code_filepaths():
+    """the (loaded) modules of this directory, e.g. the report's and core"""
+    code_dir = Path(__file__).resolve().parent
+    return sorted(
+        {
+            filepath
+            for module in list(sys.modules.values())
+            if getattr(module, "__file__", None)
+            and (filepath := Path(module.__file__).resolve()).parent
+            == code_dir
+        }
+    )
+
+
+def fingerprint(input_filepaths, config_values, code_filepaths, hash_cache):
+    return hashlib.sha256(
+        json.dumps(
+            {
+                "inputs": {
+                    str(f): _content_hash(staged_filepath(f), hash_cache)
+                    for f in map(_resolve, input_filepaths)
+                },
+                "config": config_values,
+                "code": {
+                    f.name: _content_hash(f, hash_cache)
+                    for f in code_filepaths
+                },
+            },
+            sort_keys=True,
+            default=str,
+        ).encode()
+    ).hexdigest()
+
+
+def run_if_stale(
+    report,
+    out_filepaths,
+    input_filepaths,
+    *args,
+    force=False,
+    **kwargs,
+):
+    """
+    Run report(*args, **kwargs) unless each of out_filepaths exists and was
+    built from the same input files (content), arguments (i.e. the config
+    values the report is called with) and code.
+
+    out_filepaths: all the files the report writes (recorded in the
+        manifest of the first one's directory)
+    input_filepaths: all the files the report reads
+
+    Returns whether the report was run.
+    """
+    out_filepaths = [_resolve(f) for f in out_filepaths]
+    manifest_dir = out_filepaths[0].parent
+    manifest_filepath = manifest_dir / manifest_filename
+    # (relative) output keys, in case the outputs span directories
+    out_keys = [os.path.relpath(f, manifest_dir) for f in out_filepaths]
+    manifest = _read_manifest(manifest_filepath)
+    # copy the inputs to the local staging directory (if configured) first,
+    # to hash and read them locally
+    prefetch(input_filepaths)
+    report_fingerprint = fingerprint(
+        input_filepaths,
+        {"args": args, "kwargs": kwargs},
+        _code_filepaths(),
+        manifest["inputs"],
+    )
+    stale = [
+        f
+        for f, key in zip(out_filepaths, out_keys)
+        if not f.exists() or manifest["outputs"].get(key) != report_fingerprint
+    ]
+    if not stale and not force:
+        print(f"{report.__name__}: outputs up to date, skipped")
+        # (updated input hashes)
+        _update_manifest(manifest_filepath, {}, manifest["inputs"])
+        return False
+
+    report(*args, **kwargs)
+    _update_manifest(
+        manifest_filepath,
+        {key: report_fingerprint for key in out_keys},
+        manifest["inputs"],
+    )
+    return True
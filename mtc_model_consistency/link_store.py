@@ -0,0 +1,257 @@
+"""
+Persistent, memory-mapped store of the loaded network links: one row per
+(A, B) link, with the attributes and the volumes (and the other time period
+specific columns) of all the time periods' LOAD{XX}_FINAL.csv, plus a sorted
+(A, B) key index, so that any subset of links can be looked up without
+loading (parsing) the loaded networks.
+
+Files (in the store directory):
+- links.arrow: uncompressed Arrow IPC (memory-mappable), sorted by (A, B);
+  columns that differ between time periods are named {column}-{time period}
+  (e.g. V1_1-AM, BUSVOL-AM), columns that don't keep their name (e.g. FT)
+- keys.npy: the sorted (A << 32 | B) keys of the rows of links.arrow
+
+Both files are memory-mapped, so lookups from many processes share the same
+(OS page cache) pages, and only the looked up rows are copied. The files can
+be read directly by other scripts too, e.g. with
+pl.read_ipc(..., memory_map=True) and np.load(..., mmap_mode="r").
+
+Build/refresh the store (for the forecast run) with
+python link_store.py <config filename>
+"""
+
+import os
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+import polars as pl
+from core import (
+    load_config,
+    loaded_network_filepath,
+    run_cache_dir,
+    time_periods,
+)
+from profiling import profiled
+from staging import staged_filepath
+
+links_filename = "links.arrow"
+keys_filename = "keys.npy"
+
+veh_class_volume_columns = [f"V{i}_1" for i in range(1, 19)]
+
+
+class LinkStore(NamedTuple):
+    links: pl.DataFrame  # memory-mapped
+    keys: np.ndarray  # memory-mapped, sorted
+
+
+def link_store_dir(model_run_dir, cache_dir):
+    """a store directory in cache_dir, unique to model_run_dir"""
+    return run_cache_dir(model_run_dir, cache_dir, "link_store")
+
+
+def read_loaded_network(model_run_dir, time_period, usecols=None):
+    """
+    Read LOAD{time_period}_FINAL.csv, dropping the _{time_period} suffix
+    from the time period specific column names (e.g. BUSVOL_AM -> BUSVOL)
+    """
+    bus_volume_column = f"BUSVOL_{time_period}"
+    # read with pandas then convert because for some reason polars fails
+    # to read some rows and also doesn't raise an error for this
+    loaded_network = pl.from_pandas(
+        pd.read_csv(
+            staged_filepath(
+                loaded_network_filepath(model_run_dir, time_period)
+            ),
+            sep=",",
+            quotechar="'",
+            dtype={
+                col: float
+                for col in veh_class_volume_columns + [bus_volume_column]
+            },
+            usecols=usecols,
+        )
+    )
+    suffix = f"_{time_period}"
+    return loaded_network.rename(
+        {
+            col: col.removesuffix(suffix)
+            for col in loaded_network.columns
+            if col.endswith(suffix)
+        }
+    )
+
+
+def _link_keys(A, B):
+    return (np.asarray(A, dtype=np.int64) << 32) | np.asarray(
+        B, dtype=np.int64
+    )
+
+
+def _combine_time_periods(loaded_networks):
+    """
+    One row per (A, B) link, with the columns that are the same in all the
+    time periods (ignoring links missing from some time periods) kept once,
+    and the other columns as {column}-{time period}
+
+    loaded_networks: {time period: loaded network}
+    """
+    links = None
+    for time_period, loaded_network in loaded_networks.items():
+        loaded_network = loaded_network.rename(
+            {
+                col: f"{col}-{time_period}"
+                for col in loaded_network.columns
+                if col not in {"A", "B"}
+            }
+        )
+        links = (
+            loaded_network
+            if links is None
+            else links.join(
+                loaded_network, on=["A", "B"], how="full", coalesce=True
+            )
+        )
+    common_columns = [
+        col
+        for col in next(iter(loaded_networks.values())).columns
+        if col not in {"A", "B"}
+        and all(col in ln.columns for ln in loaded_networks.values())
+    ]
+    first_time_period = next(iter(loaded_networks))
+    is_static = links.select(
+        pl.all_horizontal(
+            (
+                pl.col(f"{col}-{time_period}")
+                == pl.col(f"{col}-{first_time_period}")
+            ).fill_null(True)
+            for time_period in loaded_networks
+        )
+        .all()
+        .alias(col)
+        for col in common_columns
+    ).row(0, named=True)
+    static_columns = [col for col in common_columns if is_static[col]]
+    return links.select(
+        "A",
+        "B",
+        *(
+            pl.coalesce(
+                f"{col}-{time_period}" for time_period in loaded_networks
+            ).alias(col)
+            for col in static_columns
+        ),
+        pl.exclude(
+            ["A", "B"]
+            + [
+                f"{col}-{time_period}"
+                for col in static_columns
+                for time_period in loaded_networks
+            ]
+        ),
+    ).sort("A", "B")
+
+
+@profiled
+def build_link_store(model_run_dir, store_dir):
+    links = _combine_time_periods(
+        {
+            time_period: read_loaded_network(model_run_dir, time_period)
+            for time_period in time_periods
+        }
+    )
+    keys = _link_keys(links["A"], links["B"])
+    if (np.diff(keys) <= 0).any():
+        raise ValueError(f"duplicate (A, B) links in {model_run_dir}")
+    store_dir = Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    # write then rename, so that readers never see a half-written store;
+    # the keys are written last, as their mtime marks the store as built
+    links.write_ipc(
+        store_dir / f"{links_filename}.tmp", compression="uncompressed"
+    )
+    os.replace(store_dir / f"{links_filename}.tmp", store_dir / links_filename)
+    with open(store_dir / f"{keys_filename}.tmp", "wb") as f:
+        np.save(f, keys)
+    os.replace(store_dir / f"{keys_filename}.tmp", store_dir / keys_filename)
+
+
+def _is_store_fresh(model_run_dir, store_dir):
+    keys_filepath = Path(store_dir) / keys_filename
+    return keys_filepath.exists() and all(
+        keys_filepath.stat().st_mtime
+        >= loaded_network_filepath(model_run_dir, time_period).stat().st_mtime
+        for time_period in time_periods
+    )
+
+
+def open_link_store(model_run_dir, store_dir):
+    """
+    Memory-map the link store in store_dir, (re)building it first if it's
+    missing or older than the loaded networks (of model_run_dir)
+    """
+    if not _is_store_fresh(model_run_dir, store_dir):
+        build_link_store(model_run_dir, store_dir)
+    return LinkStore(
+        links=pl.read_ipc(Path(store_dir) / links_filename, memory_map=True),
+        keys=np.load(Path(store_dir) / keys_filename, mmap_mode="r"),
+    )
+
+
+def period_columns(store, columns, time_period):
+    """
+    The store column names of columns for time_period, i.e.
+    {column}-{time period}, or just column if it's the same in all periods
+    """
+    return [
+        (
+            f"{col}-{time_period}"
+            if f"{col}-{time_period}" in store.links.columns
+            else col
+        )
+        for col in columns
+    ]
+
+
+def link_positions(store, A, B):
+    """
+    The store row positions of the links (A, B) (arrays), with None for the
+    links not in the store
+    """
+    keys = _link_keys(A, B)
+    positions = np.searchsorted(store.keys, keys)
+    positions[positions == len(store.keys)] = 0
+    found = store.keys[positions] == keys
+    return pl.Series(positions, dtype=pl.UInt32).scatter(
+        np.flatnonzero(~found), None
+    )
+
+
+@profiled
+def lookup_links(store, A, B, columns=None):
+    """
+    The store rows (columns; default: all) of the links (A, B), in the order
+    of A and B, with nulls for the links not in the store
+    """
+    links = store.links if columns is None else store.links.select(columns)
+    return links.select(pl.all().gather(link_positions(store, A, B)))
+
+
+def join_links(df, store, columns, on=("A", "B")):
+    """
+    Left join the store columns onto df (polars) by its (A, B) columns on,
+    preserving the row order of df
+    """
+    A, B = on
+    return df.hstack(lookup_links(store, df[A], df[B], columns=columns))
+
+
+if __name__ == "__main__":
+    config = load_config()
+    model_run_dir = config["champ"]["forecast"]["model_run_dir"]
+    build_link_store(
+        model_run_dir,
+        link_store_dir(model_run_dir, config["cache_dir"]),
+    )
@@ -0,0 +1,219 @@
+"""
+Compare the loaded networks of two or more scenarios (model runs), link by
+link, for all the time periods at once, e.g.
+python network_diff.py 2023.toml
+(the [champ.base] vs the [champ.forecast] model run), or
+python network_diff.py 2023.toml --run noproject=X:/run1 --run project=X:/run2
+
+The scenarios' link stores (see link_store.py) are (hash) joined on (A, B),
+and, for each time period, the volume (V1_1..V18_1 + BUSVOL), loaded speed
+(LOAD_SPD, or CSPD_1 if the loaded networks were converted with
+NETtoCSV_simple.s) and V/C (VC_RATIO, or VC_1) of each scenario are written
+side by side, with the absolute and percent differences of each scenario
+from the first (the reference) one, and the links added/removed (relative to
+the reference), to out_dir/network_diff.parquet (one row per link of any of
+the scenarios, to be joined to the network shapefile on A, B for mapping).
+
+Columns: A, B, FT, STREETNAME, status-{scenario} ("added", "removed" or
+null), then for metric: volume, speed, vc, {metric}-{time period}-{scenario}
+and {metric}-{time period}-diff-{scenario}, -pct_diff-{scenario}.
+"""
+
+from pathlib import Path
+
+import polars as pl
+from core import load_config, loaded_network_filepath, time_periods
+from incremental import run_if_stale
+from link_store import (
+    link_store_dir,
+    open_link_store,
+    period_columns,
+    veh_class_volume_columns,
+)
+from profiling import profiled, write_profile
+
+out_filename = "network_diff.parquet"
+
+# (static) link attributes, of the first scenario with the link
+link_attributes = ["FT", "STREETNAME"]
+# {metric: loaded network columns, the first one in the loaded networks is
+# used}
+metric_columns = {
+    "speed": ["LOAD_SPD", "CSPD_1"],
+    "vc": ["VC_RATIO", "VC_1"],
+}
+
+
+def scenario_metrics(store, scenario):
+    """
+    (Lazy) A, B, the link attributes and the {metric}-{time period}-{scenario}
+    columns of a scenario's link store, with an in-{scenario} (True) column,
+    and the {metric}-{time period} names of the metrics in the link store
+    """
+    metrics = {}
+    for time_period in time_periods:
+        metrics[f"volume-{time_period}"] = pl.sum_horizontal(
+            period_columns(
+                store, veh_class_volume_columns + ["BUSVOL"], time_period
+            )
+        )
+        for metric, columns in metric_columns.items():
+            for col in columns:
+                (store_col,) = period_columns(store, [col], time_period)
+                if store_col in store.links.columns:
+                    metrics[f"{metric}-{time_period}"] = pl.col(
+                        store_col
+                    ).cast(pl.Float64)
+                    break
+    return store.links.lazy().select(
+        "A",
+        "B",
+        *(
+            pl.col(col).alias(f"{col}-{scenario}")
+            for col in link_attributes
+            if col in store.links.columns
+        ),
+        pl.lit(True).alias(f"in-{scenario}"),
+        *(expr.alias(f"{name}-{scenario}") for name, expr in metrics.items()),
+    ), list(metrics)
+
+
+@profiled
+def network_diff(scenarios, out_filepath, cache_dir):
+    """
+    scenarios: {scenario name: model_run_dir}, the first one is the
+        reference that the others are compared to
+    out_filepath: .parquet output (see the module docstring)
+    cache_dir: where the scenarios' link stores are (built)
+    """
+    if len(scenarios) < 2:
+        raise ValueError("network_diff needs at least two scenarios")
+    tables = {}
+    metric_names = {}
+    for scenario, model_run_dir in scenarios.items():
+        tables[scenario], metric_names[scenario] = scenario_metrics(
+            open_link_store(
+                model_run_dir, link_store_dir(model_run_dir, cache_dir)
+            ),
+            scenario,
+        )
+    reference, *others = scenarios
+    links = None
+    for table in tables.values():
+        links = (
+            table
+            if links is None
+            else links.join(table, on=["A", "B"], how="full", coalesce=True)
+        )
+    columns = links.collect_schema().names()
+    reference_metrics = set(metric_names[reference])
+    statuses = []
+    diffs = []
+    for scenario in others:
+        statuses.append(
+            pl.when(
+                pl.col(f"in-{reference}").is_null()
+                & pl.col(f"in-{scenario}").is_not_null()
+            )
+            .then(pl.lit("added"))
+            .when(
+                pl.col(f"in-{reference}").is_not_null()
+                & pl.col(f"in-{scenario}").is_null()
+            )
+            .then(pl.lit("removed"))
+            .alias(f"status-{scenario}")
+        )
+        for metric in metric_names[scenario]:
+            if metric not in reference_metrics:
+                continue
+            metric_name, time_period = metric.split("-")
+            value = pl.col(f"{metric}-{scenario}")
+            reference_value = pl.col(f"{metric}-{reference}")
+            diffs += [
+                (value - reference_value).alias(
+                    f"{metric_name}-{time_period}-diff-{scenario}"
+                ),
+                pl.when(reference_value != 0)
+                .then((value - reference_value) / reference_value * 100)
+                .alias(f"{metric_name}-{time_period}-pct_diff-{scenario}"),
+            ]
+    links.select(
+        "A",
+        "B",
+        *(
+            pl.coalesce(
+                f"{col}-{scenario}"
+                for scenario in scenarios
+                if f"{col}-{scenario}" in columns
+            ).alias(col)
+            for col in link_attributes
+            if any(f"{col}-{scenario}" in columns for scenario in scenarios)
+        ),
+        *statuses,
+        *(
+            f"{metric}-{scenario}"
+            for scenario in scenarios
+            for metric in metric_names[scenario]
+        ),
+        *diffs,
+    ).sort("A", "B").sink_parquet(out_filepath, compression="zstd")
+
+
+def parse_run(run):
+    """e.g. "project=X:/run" -> ("project", "X:/run")"""
+    name, sep, model_run_dir = run.partition("=")
+    if not sep:
+        raise ValueError(f"expected NAME=MODEL_RUN_DIR, got {run}")
+    # (- separates the parts of the output column names)
+    if not name or "-" in name:
+        raise ValueError(
+            f"the scenario name can't be empty or have a -: {run}"
+        )
+    return name, model_run_dir
+
+
+def _add_arguments(parser):
+    parser.add_argument(
+        "--run",
+        action="append",
+        type=parse_run,
+        metavar="NAME=MODEL_RUN_DIR",
+        help=(
+            "a scenario to compare (repeatable; the first one is the "
+            "reference), default: [champ.base] and [champ.forecast]"
+        ),
+    )
+
+
+if __name__ == "__main__":
+    config = load_config(_add_arguments)
+    if config["args"].run:
+        scenarios = dict(config["args"].run)
+        if len(scenarios) < len(config["args"].run):
+            raise SystemExit("the --run scenario names should be unique")
+    else:
+        scenarios = {
+            scenario: run["model_run_dir"]
+            for scenario, run in config["champ"].items()
+            if "model_run_dir" in run
+        }
+    if len(scenarios) < 2:
+        raise SystemExit(
+            "need two scenarios: [champ.base] and [champ.forecast] "
+            "model_run_dir in the config, or --run"
+        )
+    out_filepath = Path(config["out_dir"]) / out_filename
+    run_if_stale(
+        network_diff,
+        [out_filepath],
+        [
+            loaded_network_filepath(model_run_dir, time_period)
+            for model_run_dir in scenarios.values()
+            for time_period in time_periods
+        ],
+        scenarios,
+        out_filepath,
+        config["cache_dir"],
+        force=config["force"],
+    )
+    write_profile(config["out_dir"])
@@ -0,0 +1,117 @@
+"""
+OD matrices: (optionally weighted/filtered) counts of integer TAZ pairs as a
+dense TAZ x TAZ NumPy array (with np.bincount on the flattened OD indices),
+aggregated to coarser geographies (e.g. superdistrict, county) the same way,
+with np.bincount on the flattened zone pair indices of the TAZ pairs
+(weighted by the TAZ OD matrix)
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+
+class Geography(NamedTuple):
+    zones: np.ndarray  # sorted zone ids, e.g. counties
+    zone_indices: np.ndarray  # the index (into zones) of the zone of each TAZ
+
+
+def taz_indices(tazs, tazs_of_od):
+    """
+    The indices into tazs (sorted TAZ ids) of tazs_of_od, and whether each
+    TAZ is in tazs (the indices of the TAZs not in tazs are meaningless)
+    """
+    tazs_of_od = np.asarray(tazs_of_od)
+    indices = np.searchsorted(tazs, tazs_of_od)
+    indices[indices == len(tazs)] = 0
+    return indices, tazs[indices] == tazs_of_od
+
+
+def od_matrix(tazs, o_tazs, d_tazs, weights=None, mask=None):
+    """
+    TAZ x TAZ (in the order of tazs, sorted TAZ ids) matrix of the number
+    (or sum of weights) of the (o_tazs, d_tazs) pairs (where mask is True)
+    """
+    return od_matrices(tazs, o_tazs, d_tazs, {"od": (weights, mask)})["od"]
+
+
+def od_matrices(tazs, o_tazs, d_tazs, layers):
+    """
+    OD matrices of several (weighted/filtered) layers of the same OD pairs,
+    e.g. persons/tours/trips of a purpose, mapping the TAZs to indices once.
+    Raises ValueError if a layer has TAZs not in tazs (mask them out to
+    ignore them).
+
+    layers: {name: (weights or None, mask or None)}
+    """
+    n = len(tazs)
+    o_indices, o_known = taz_indices(tazs, o_tazs)
+    d_indices, d_known = taz_indices(tazs, d_tazs)
+    flat_indices = o_indices * n + d_indices
+    unknown = ~(o_known & d_known)
+    ods = {}
+    for name, (weights, mask) in layers.items():
+        indices = flat_indices
+        layer_unknown = unknown
+        if mask is not None:
+            mask = np.asarray(mask, dtype=bool)
+            indices = flat_indices[mask]
+            layer_unknown = unknown[mask]
+            if weights is not None:
+                weights = np.asarray(weights)[mask]
+        if layer_unknown.any():
+            raise ValueError(f"{name}: OD pairs with TAZs not in the TAZ list")
+        ods[name] = np.bincount(
+            indices, weights=weights, minlength=n * n
+        ).reshape(n, n)
+    return ods
+
+
+def geography(tazs, zones_of_tazs):
+    """
+    The geography (e.g. county) of the TAZs
+
+    tazs: sorted TAZ ids
+    zones_of_tazs: the zone (e.g. county) of each of tazs
+    """
+    zones, zone_indices = np.unique(zones_of_tazs, return_inverse=True)
+    return Geography(zones=zones, zone_indices=zone_indices.ravel())
+
+
+def taz_geographies(taz, geog_cols, taz_col="SFTAZ"):
+    """
+    The sorted TAZ ids and their geographies ({geog col: Geography}) from
+    taz (e.g. output of read_taz()), e.g. for geog_cols COUNTY, SUPERDST
+    """
+    taz = taz.sort_values(taz_col)
+    tazs = taz[taz_col].to_numpy()
+    return tazs, {
+        geog_col: geography(tazs, taz[geog_col].to_numpy())
+        for geog_col in geog_cols
+    }
+
+
+def aggregate_od(od, geog):
+    """zone x zone matrix of the TAZ x TAZ od"""
+    n = len(geog.zones)
+    zone_pair_indices = (
+        geog.zone_indices[:, np.newaxis] * n + geog.zone_indices[np.newaxis, :]
+    )
+    # (bincount sums weights as floats; back to integers for counts)
+    return (
+        np.bincount(
+            zone_pair_indices.ravel(), weights=od.ravel(), minlength=n * n
+        )
+        .reshape(n, n)
+        .astype(od.dtype, copy=False)
+    )
+
+
+def od_table(od, o_zones, d_zones, o_name, d_name):
+    """OD matrix as a DataFrame (rows: origins, columns: destinations)"""
+    return pd.DataFrame(
+        od,
+        index=pd.Index(o_zones, name=o_name),
+        columns=pd.Index(d_zones, name=d_name),
+    )
@@ -0,0 +1,137 @@
+"""
+Preview mode: run the Daysim reports on a deterministic sample of the
+households, for a quick look at a model run, e.g.
+python trips.py 2023.toml --preview 0.05
+
+The households are sampled by a hash of hhno (the same households in all the
+Daysim tables and in every run; a smaller sample is a subset of a larger
+one), filtering the Daysim tables while they're read (see
+core._read_model_output_dat), so only the sample is ever in memory. The
+counts in the report outputs are expanded (divided by the sample fraction),
+and the approximate standard error of each cell is written next to each
+output (to {output name}-se.csv), estimated from the variation between the
+sampled households (as households, not persons/tours/trips, are sampled).
+The outputs are written to out_dir/preview-{fraction}/.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# set by configure() (from the config, in core.load_config())
+_preview = {"fraction": None}
+
+
+def configure(fraction):
+    """sample the fraction (0 to 1) of the households (None: don't sample)"""
+    if fraction is not None and not 0 < fraction <= 1:
+        raise ValueError(f"sample fraction must be in (0, 1], got {fraction}")
+    _preview["fraction"] = fraction
+
+
+def sample_fraction():
+    """the sample fraction, None if not in preview mode"""
+    return _preview["fraction"]
+
+
+def _hash(hhno):
+    """splitmix64 of hhno: uniform (and platform independent) uint64s"""
+    x = np.asarray(hhno, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def in_sample(hhno, fraction):
+    """whether each of the households hhno is in the fraction sample"""
+    if fraction >= 1:
+        return np.ones(len(hhno), dtype=bool)
+    return _hash(hhno) < np.uint64(fraction * 2.0**64)
+
+
+def sample_households(df):
+    """the rows of df (with an hhno column) of the sampled households"""
+    if _preview["fraction"] is None:
+        return df
+    return df[in_sample(df["hhno"], _preview["fraction"])]
+
+
+def expand(counts):
+    """the counts of the sample expanded to the population"""
+    if _preview["fraction"] is None:
+        return counts
+    return counts / _preview["fraction"]
+
+
+def preview_out_dir(out_dir):
+    """out_dir, or its preview-{fraction} subdirectory in preview mode"""
+    if _preview["fraction"] is None:
+        return out_dir
+    preview_dir = Path(out_dir) / f"preview-{_preview['fraction']}"
+    preview_dir.mkdir(parents=True, exist_ok=True)
+    return preview_dir
+
+
+def se_filepath(filepath):
+    """the standard error output filepath of an output filepath"""
+    filepath = Path(filepath)
+    return filepath.with_name(f"{filepath.stem}-se{filepath.suffix}")
+
+
+def squares_se(hh_squares):
+    """
+    Standard errors of expanded totals (Poisson sampling of households with
+    the sample fraction f probability) from the sums over the sampled
+    households of their squared totals (hh_squares):
+    sqrt((1 - f) * sum over households of (household total)^2) / f
+    """
+    f = _preview["fraction"]
+    return np.sqrt((1 - f) * hh_squares) / f
+
+
+def total_se(df, by, value=None):
+    """
+    Standard errors of the expanded totals of value (None: the number of
+    rows) of the sampled rows of df by the by columns (see squares_se())
+    """
+    grouped = df.groupby(by + ["hhno"], observed=True)
+    hh_totals = grouped.size() if value is None else grouped[value].sum()
+    return squares_se((hh_totals**2).groupby(level=by).sum()).rename("se")
+
+
+def ratio_se(df, by, numerators, denominator=None):
+    """
+    Standard errors (columns: numerators) of the ratios
+    sum(numerator) / sum(denominator) of the sampled rows of df by the by
+    columns, e.g. shares (numerators: 0/1 indicator columns) or means
+    (denominator None: the number of rows), by linearization:
+    sqrt((1 - f) * sum over households of (y - ratio * x)^2) / sum(x)
+    """
+    f = _preview["fraction"]
+    if denominator is None:
+        df = df.assign(_rows=1)
+        denominator = "_rows"
+    hh_sums = df.groupby(by + ["hhno"], observed=True)[
+        numerators + [denominator]
+    ].sum()
+    sums = hh_sums.groupby(level=by).sum()
+    ratios = sums[numerators].div(sums[denominator], axis=0)
+    residuals = hh_sums[numerators] - (
+        ratios.reindex(hh_sums.index.droplevel("hhno")).to_numpy()
+        * hh_sums[[denominator]].to_numpy()
+    )
+    return np.sqrt((1 - f) * (residuals**2).groupby(level=by).sum()).div(
+        sums[denominator], axis=0
+    )
+
+
+def with_totals(df, totals):
+    """
+    df with its rows repeated for each of the totals, i.e. with the columns
+    of each total ({column: label}) set to the label, e.g. to estimate the
+    standard errors of subtotals along with the cells'
+    """
+    return pd.concat(
+        [df] + [df.assign(**total) for total in totals], ignore_index=True
+    )
@@ -0,0 +1,277 @@
+"""
+Opt-in per-stage profiling: wall time, rows in/out and peak RSS of each
+(decorated or `with stage(...)`) stage, written as a JSON run profile.
+
+Enable by setting the CHAMP_POSTPROCESS_PROFILE environment variable (to any
+non-empty value), e.g. in powershell: $env:CHAMP_POSTPROCESS_PROFILE = 1
+When disabled, the decorator/context manager only costs a flag check.
+
+The peak RSS of a stage is the highest (process) RSS sampled, every
+rss_sample_interval_s by a background thread, while the stage runs (and at
+its start and end), so nested and concurrent stages each get their own peak
+(a peak shorter than the sampling interval may be missed).
+
+The validation scripts use this module too (see validation/profiling.py).
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import cache, wraps
+from pathlib import Path
+
+enabled = bool(os.environ.get("CHAMP_POSTPROCESS_PROFILE"))
+
+rss_sample_interval_s = 0.01
+
+_run_start = time.perf_counter()
+_run_started_at = datetime.now()
+_stages = []  # finished stage records, in order of completion
+# records of the stages currently running in each thread (for nesting)
+_running = threading.local()
+# records of the stages currently running in all threads (for the RSS
+# sampler), guarded by _open_lock
+_open = []
+_open_lock = threading.Lock()
+_sampler = None
+
+
+def _stack():
+    if not hasattr(_running, "stack"):
+        _running.stack = []
+    return _running.stack
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+@cache
+def _windows_memory_info():
+    """
+    A function returning the PROCESS_MEMORY_COUNTERS of the process (with
+    the Win32 GetProcessMemoryInfo, i.e. without psutil), None if not on
+    Windows
+    """
+    if sys.platform != "win32":
+        return None
+    import ctypes
+    from ctypes import wintypes
+
+    class ProcessMemoryCounters(ctypes.Structure):
+        _fields_ = [
+            ("cb", wintypes.DWORD),
+            ("PageFaultCount", wintypes.DWORD),
+            ("PeakWorkingSetSize", ctypes.c_size_t),
+            ("WorkingSetSize", ctypes.c_size_t),
+            ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+            ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+            ("PagefileUsage", ctypes.c_size_t),
+            ("PeakPagefileUsage", ctypes.c_size_t),
+        ]
+
+    # (own WinDLL instances, not to change the shared ctypes.windll ones)
+    kernel32 = ctypes.WinDLL("kernel32")
+    psapi = ctypes.WinDLL("psapi")
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    psapi.GetProcessMemoryInfo.argtypes = [
+        wintypes.HANDLE,
+        ctypes.POINTER(ProcessMemoryCounters),
+        wintypes.DWORD,
+    ]
+    psapi.GetProcessMemoryInfo.restype = wintypes.BOOL
+    process = kernel32.GetCurrentProcess()
+
+    def memory_info():
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        if not psapi.GetProcessMemoryInfo(
+            process, ctypes.byref(counters), counters.cb
+        ):
+            return None
+        return counters
+
+    return memory_info
+
+
+def _rss_mb():
+    """the current RSS (Windows: working set) of the process"""
+    try:  # Linux
+        with open("/proc/self/statm") as f:
+            return (
+                int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+            )
+    except (OSError, AttributeError, ValueError):
+        pass
+    memory_info = _windows_memory_info()
+    counters = memory_info() if memory_info is not None else None
+    if counters is None:
+        return None
+    return counters.WorkingSetSize / 2**20
+
+
+def _sample_rss():
+    """update the peak RSS of the stages running (in any thread)"""
+    rss_mb = _rss_mb()
+    if rss_mb is None:
+        return
+    with _open_lock:
+        for record in _open:
+            record["peak_rss_mb"] = max(rss_mb, record["peak_rss_mb"] or 0)
+
+
+def _sample_rss_forever():
+    while True:
+        time.sleep(rss_sample_interval_s)
+        _sample_rss()
+
+
+def _start_sampler():
+    global _sampler
+    with _open_lock:
+        if _sampler is None:
+            _sampler = threading.Thread(
+                target=_sample_rss_forever, name="rss-sampler", daemon=True
+            )
+            _sampler.start()
+
+
+def _peak_rss_mb():
+    try:  # Linux
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    memory_info = _windows_memory_info()
+    if memory_info is not None:
+        counters = memory_info()
+        return (
+            None if counters is None else counters.PeakWorkingSetSize / 2**20
+        )
+    try:  # macOS (bytes)
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+    except ImportError:
+        return None
+
+
+def _n_rows(obj):
+    """number of rows of a (pandas/polars) DataFrame/Series or array"""
+    if isinstance(obj, tuple) and obj:  # e.g. (df, skipped)
+        return _n_rows(obj[0])
+    shape = getattr(obj, "shape", None)
+    if shape:
+        return shape[0]
+    return None
+
+
+def _sum_rows(objs):
+    n_rows = [n for n in map(_n_rows, objs) if n is not None]
+    return sum(n_rows) if n_rows else None
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """
+    Profile a stage; set record["rows_out"] inside the with block to record
+    the number of output rows, e.g.
+    with stage("geomatch") as record:
+        ...
+        record["rows_out"] = len(df)
+    """
+    if not enabled:
+        yield {}
+        return
+    stack = _stack()
+    record = {
+        "stage": name,
+        "parent": stack[-1]["stage"] if stack else None,
+        "start_s": time.perf_counter() - _run_start,
+        "wall_time_s": None,
+        "rows_in": rows_in,
+        "rows_out": None,
+        "peak_rss_mb": None,
+    }
+    stack.append(record)
+    _start_sampler()
+    with _open_lock:
+        _open.append(record)
+    _sample_rss()
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record["wall_time_s"] = time.perf_counter() - start
+        _sample_rss()
+        with _open_lock:
+            _open[:] = [r for r in _open if r is not record]
+        stack.pop()
+        _stages.append(record)
+
+
+def profiled(func):
+    """
+    Decorator to profile each call of func as a stage, counting the rows of
+    the DataFrame arguments (rows_in) and of the returned DataFrame (rows_out)
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return func(*args, **kwargs)
+        with stage(
+            func.__qualname__,
+            rows_in=_sum_rows(list(args) + list(kwargs.values())),
+        ) as record:
+            result = func(*args, **kwargs)
+            record["rows_out"] = _n_rows(result)
+        return result
+
+    return wrapper
+
+
+def write_profile(out_dir, name=None):
+    """
+    Write the run profile (if enabled) as JSON to out_dir, as
+    profile-{name}-{run start time}.json (name defaults to the script name),
+    so that the profiles of different runs can be compared
+    """
+    if not enabled:
+        return None
+    if name is None:
+        name = Path(sys.argv[0]).stem
+    profile_filepath = Path(out_dir) / (
+        f"profile-{name}-{_run_started_at:%Y%m%d-%H%M%S}.json"
+    )
+    with open(profile_filepath, "w") as f:
+        json.dump(
+            {
+                "script": name,
+                "argv": sys.argv,
+                "started_at": _run_started_at.isoformat(),
+                "wall_time_s": time.perf_counter() - _run_start,
+                "peak_rss_mb": max(
+                    (
+                        peak_rss_mb
+                        for peak_rss_mb in [_peak_rss_mb()]
+                        + [s["peak_rss_mb"] for s in _stages]
+                        if peak_rss_mb is not None
+                    ),
+                    default=None,
+                ),
+                "stages": _stages,
+            },
+            f,
+            indent=2,
+        )
+    return profile_filepath
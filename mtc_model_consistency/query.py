@@ -0,0 +1,232 @@
+"""
+SQL queries over the outputs of a model run, e.g.
+python query.py 2023.toml "SELECT mode, COUNT(*) AS trips FROM trip GROUP BY mode"
+python query.py 2023.toml "SELECT ..." --out trips_by_mode.csv
+
+The outputs are registered as lazy views of a polars SQLContext, so a query
+only reads the columns (and Parquet row groups) it needs, and is run on the
+streaming engine, i.e. without loading the whole tables into memory:
+- household, person, tour, trip: the Daysim outputs (_household_2.dat,
+  _person_2.dat, _tour_2.dat, _trip_2.dat), read from Parquet copies in the
+  cache directory, which are converted chunk by chunk (and reconverted when
+  older than the .dat files)
+- taz: the TAZ table (tazdata.csv)
+- links: the link store (see link_store.py), i.e. the loaded networks of all
+  the time periods side by side
+- LOADEA, LOADAM, LOADMD, LOADPM, LOADEV: the loaded network of each time
+  period (from the link store, with the LOAD{XX}_FINAL.csv column names,
+  except BUSVOL_{XX} -> BUSVOL)
+Table names are case sensitive.
+"""
+
+import os
+import shutil
+from pathlib import Path
+
+import polars as pl
+from core import (
+    daysim_filepath,
+    load_config,
+    loaded_network_filepath,
+    read_hh,
+    read_pers,
+    read_tours,
+    read_trips,
+    run_cache_dir,
+    time_periods,
+)
+from file_lock import file_lock, tmp_filepath
+from link_store import link_store_dir, open_link_store
+from profiling import profiled, write_profile
+from staging import prefetch, staged_filepath
+
+# {view name: (Daysim output filename, reader)}
+daysim_tables = {
+    "household": ("_household_2.dat", read_hh),
+    "person": ("_person_2.dat", read_pers),
+    "tour": ("_tour_2.dat", read_tours),
+    "trip": ("_trip_2.dat", read_trips),
+}
+
+
+def daysim_store_dir(model_run_dir, cache_dir):
+    """a Parquet store directory in cache_dir, unique to model_run_dir"""
+    return run_cache_dir(model_run_dir, cache_dir, "daysim_store")
+
+
+def _is_table_fresh(model_run_dir, table_dir, filename):
+    return (
+        table_dir.exists()
+        and table_dir.stat().st_mtime
+        >= daysim_filepath(model_run_dir, filename).stat().st_mtime
+    )
+
+
+def _unify_parts(part_filepaths, schemas):
+    """
+    Cast the Parquet parts to the common supertype of each column over all
+    the parts' schemas (e.g. Float64 for Int64 and Float64, String for Null
+    and String), for the columns whose dtype is inferred (i.e. not in
+    daysim_schemas) for each chunk
+    """
+    schema = pl.concat(
+        (pl.DataFrame(schema=part_schema) for part_schema in schemas),
+        how="vertical_relaxed",
+    ).schema
+    for part_filepath, part_schema in zip(part_filepaths, schemas):
+        if part_schema != schema:
+            pl.read_parquet(part_filepath).cast(schema).write_parquet(
+                part_filepath
+            )
+
+
+@profiled
+def build_daysim_table(model_run_dir, store_dir, table, chunksize=1_000_000):
+    """
+    Convert a Daysim output (table: key of daysim_tables) to a directory of
+    Parquet files (one per chunk of chunksize rows, all with the same
+    schema) in store_dir
+    """
+    _, read = daysim_tables[table]
+    table_dir = Path(store_dir) / table
+    tmp_dir = tmp_filepath(table_dir)
+    tmp_dir.mkdir(parents=True)
+    part_filepaths = []
+    schemas = []
+    try:
+        for i, chunk in enumerate(read(model_run_dir, chunksize=chunksize)):
+            chunk = pl.from_pandas(chunk)
+            part_filepaths.append(tmp_dir / f"part-{i:05d}.parquet")
+            schemas.append(chunk.schema)
+            chunk.write_parquet(part_filepaths[-1])
+        _unify_parts(part_filepaths, schemas)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    # replace the whole directory, so that readers never see a half-written
+    # table; its mtime (last part written) marks the table as converted
+    shutil.rmtree(table_dir, ignore_errors=True)
+    os.replace(tmp_dir, table_dir)
+
+
+def scan_daysim_table(model_run_dir, store_dir, table):
+    """
+    (Lazy) the Parquet copy of a Daysim output, (re)converting it first if
+    it's missing or older than the output
+    """
+    table_dir = Path(store_dir) / table
+    table_dir.parent.mkdir(parents=True, exist_ok=True)
+    # (one conversion at a time, e.g. of concurrent queries on the same
+    # cache, which would delete each other's parts)
+    with file_lock(table_dir):
+        if not _is_table_fresh(
+            model_run_dir, table_dir, daysim_tables[table][0]
+        ):
+            build_daysim_table(model_run_dir, store_dir, table)
+    return pl.scan_parquet(table_dir / "*.parquet")
+
+
+def loaded_network_views(model_run_dir, store_dir):
+    """
+    (Lazy) {"links": link store, "LOAD{XX}": loaded network of time period
+    XX}, from the (memory-mapped) link store in store_dir
+    """
+    links = open_link_store(model_run_dir, store_dir).links
+    period_suffixes = tuple(f"-{t}" for t in time_periods)
+    views = {"links": links.lazy()}
+    for time_period in time_periods:
+        suffix = f"-{time_period}"
+        views[f"LOAD{time_period}"] = links.lazy().select(
+            *(
+                (
+                    pl.col(col).alias(col.removesuffix(suffix))
+                    if col.endswith(suffix)
+                    else pl.col(col)
+                )
+                for col in links.columns
+                if col.endswith(suffix) or not col.endswith(period_suffixes)
+            )
+        )
+    return views
+
+
+def query_context(model_run_dir, cache_dir, taz_filepath=None):
+    """
+    SQLContext with the (lazy) views of the outputs of model_run_dir (see
+    the module docstring) that exist, caching the columnar copies in
+    cache_dir (model_run_dir None: the TAZ table only)
+    """
+    context = pl.SQLContext()
+    if taz_filepath is not None:
+        # (query.py isn't run through run_if_stale, which prefetches)
+        prefetch([taz_filepath])
+        context.register("taz", pl.scan_csv(staged_filepath(taz_filepath)))
+    if model_run_dir is None:
+        return context
+    for table, (filename, _) in daysim_tables.items():
+        if daysim_filepath(model_run_dir, filename).exists():
+            context.register(
+                table,
+                scan_daysim_table(
+                    model_run_dir,
+                    daysim_store_dir(model_run_dir, cache_dir),
+                    table,
+                ),
+            )
+    if all(
+        loaded_network_filepath(model_run_dir, t).exists()
+        for t in time_periods
+    ):
+        context.register_many(
+            loaded_network_views(
+                model_run_dir, link_store_dir(model_run_dir, cache_dir)
+            )
+        )
+    return context
+
+
+@profiled
+def query(context, sql, out_filepath=None):
+    """
+    Run the sql query (on the streaming engine), returning the result, or,
+    if out_filepath (.csv or .parquet) is given, streaming it to the file
+    """
+    result = context.execute(sql)
+    if out_filepath is None:
+        return result.collect(engine="streaming")
+    if Path(out_filepath).suffix == ".parquet":
+        result.sink_parquet(out_filepath, engine="streaming")
+    else:
+        result.sink_csv(out_filepath, engine="streaming")
+
+
+def _add_arguments(parser):
+    parser.add_argument("sql", help="SQL query, e.g. SELECT * FROM trip")
+    parser.add_argument(
+        "--run",
+        choices=["base", "forecast"],
+        default="forecast",
+        help="the model run to query (default: forecast)",
+    )
+    parser.add_argument(
+        "--out", help="write the result to this .csv or .parquet file"
+    )
+
+
+if __name__ == "__main__":
+    config = load_config(_add_arguments)
+    if config["args"].preview is not None:
+        # the Parquet copies are converted from (and cached as) full tables
+        raise SystemExit("--preview is not supported by query.py")
+    args = config["args"]
+    run = config["champ"][args.run]
+    context = query_context(
+        run.get("model_run_dir"),
+        config["cache_dir"],
+        run.get("taz_filepath"),
+    )
+    result = query(context, args.sql, args.out)
+    if result is not None:
+        with pl.Config(tbl_rows=50, tbl_cols=-1):
+            print(result)
+    write_profile(config["out_dir"])
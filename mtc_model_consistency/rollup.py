@@ -0,0 +1,73 @@
+"""
+Grouping sets (SQL GROUPING SETS / ROLLUP): the sums of some columns by
+several subsets of the grouping keys (e.g. by county and purpose, by county
+(all purposes), and in total), in one tidy table, the rolled up keys being
+labelled (e.g. "All", "Total").
+
+The source rows are grouped by all the keys once (the base aggregate); every
+grouping set is then summed from the base aggregate, never from the source
+rows, so the aggregated values must be additive (e.g. counts, VMT).
+"""
+
+import polars as pl
+
+
+def rollup(keys):
+    """
+    The hierarchical grouping sets of keys (SQL ROLLUP), e.g.
+    ["county", "purpose"] -> [["county", "purpose"], ["county"], []]
+    """
+    keys = list(keys)
+    return [keys[:i] for i in range(len(keys), -1, -1)]
+
+
+def grouping_sets(df, keys, sets, values, labels="All"):
+    """
+    The sums of the values columns of df (lazy or eager) by each of the
+    grouping sets (subsets of keys), stacked in one DataFrame with the keys
+    and values columns, in the order of sets. In the rows of a grouping set,
+    the keys not in the set (rolled up) are labelled with labels; the columns
+    of the keys rolled up in any set are returned as strings. Null keys are
+    grouped as any other value (filter them out beforehand to exclude them
+    from the totals).
+
+    sets: e.g. [["county", "purpose"], ["county"], []], or rollup(keys)
+    labels: label of the rolled up keys, or {key: label}
+    """
+    keys = list(keys)
+    values = list(values)
+    if isinstance(labels, str):
+        labels = dict.fromkeys(keys, labels)
+    for grouping_set in sets:
+        if not set(grouping_set) <= set(keys):
+            raise ValueError(f"grouping set {grouping_set} not in {keys}")
+    # the keys rolled up in any grouping set hold labels, i.e. strings
+    rolled_up = [key for key in keys if any(key not in s for s in sets)]
+    base = df.lazy().group_by(keys).agg(pl.col(values).sum()).collect()
+    return pl.concat(
+        (
+            base.group_by(grouping_set, maintain_order=True)
+            .agg(pl.col(values).sum())
+            .select(
+                *(
+                    (
+                        (
+                            pl.col(key).cast(pl.String)
+                            if key in rolled_up
+                            else pl.col(key)
+                        )
+                        if key in grouping_set
+                        else pl.lit(labels[key], pl.String).alias(key)
+                    )
+                    for key in keys
+                ),
+                *values,
+            )
+            if grouping_set
+            else base.select(
+                *(pl.lit(labels[key], pl.String).alias(key) for key in keys),
+                pl.col(values).sum(),
+            )
+        )
+        for grouping_set in sets
+    )
@@ -1,69 +1,181 @@
 from pathlib import Path
 
-import pandas as pd
 import polars as pl
-from core import load_config, time_period_conversion_champ_to_mtc, time_periods
+from core import (
+    load_config,
+    loaded_network_filepath,
+    time_period_conversion_champ_to_mtc,
+    time_periods,
+)
+from incremental import run_if_stale
+from link_store import (
+    join_links,
+    link_store_dir,
+    open_link_store,
+    period_columns,
+    veh_class_volume_columns,
+)
+from profiling import profiled, write_profile
 
+# the default screenline set: the screenlines' links (A, B), in out_dir
+screenline_AB_filename = "screenline-AB.csv"
+default_screenline_sets = {"screenline": screenline_AB_filename}
 
-def screenline(model_run_dir, out_dir):
-    out_filepath = out_dir / "J-Traffic&TransitAssignment-screenline-2050.csv"
+# loaded network columns summed as the screenline volume:
+# cf. Y:\champ\dev\...\scripts\summarize\create-daily.s
+# this script is called from modelRunTopsheet, which was
+# referenced when I created this script
+default_volume_columns = veh_class_volume_columns + ["BUSVOL"]
 
-    screenline_AB = pl.read_csv(out_dir / "screenline-AB.csv").select(
-        "Route Number/Direction",
-        "Link Description",
-        "A",
-        "B",
+screenline_cols = ["Route Number/Direction", "Link Description"]
+
+
+def out_filepath(out_dir, screenline_set):
+    return (
+        Path(out_dir)
+        / f"J-Traffic&TransitAssignment-{screenline_set}-2050.csv"
     )
-    loaded_network_veh_class_cols = [f"V{i}_1" for i in range(1, 19)]
-    screenline_vols = screenline_AB
-    champ_volume_columns = []
-    for time_period in time_periods:
-        filename_root = f"LOAD{time_period}_FINAL"
-        column_name = f"CHAMP-{time_period}"
-        champ_volume_columns.append(column_name)
-        loaded_network_vol_cols = loaded_network_veh_class_cols + [
-            f"BUSVOL_{time_period}"
-        ]
-        loaded_network = (
-            # read with pandas then convert because for some reason polars fails
-            # to read some rows and also doesn't raise an error for this
-            pl.from_pandas(
-                pd.read_csv(
-                    Path(model_run_dir, f"{filename_root}.csv"),
-                    sep=",",
-                    quotechar="'",
-                    dtype={col: float for col in loaded_network_vol_cols},
-                    usecols=["A", "B"] + loaded_network_vol_cols,
-                )
+
+
+def read_screenline_sets(screenline_set_filepaths):
+    """
+    Stack the screenline definition files (screenlines' links (A, B)) into
+    one table, with a screenline_set column
+
+    screenline_set_filepaths: {screenline set name: filepath}
+    """
+    return pl.concat(
+        pl.read_csv(filepath).select(
+            pl.lit(screenline_set).alias("screenline_set"),
+            *(pl.col(col).cast(pl.String) for col in screenline_cols),
+            "A",
+            "B",
+        )
+        for screenline_set, filepath in screenline_set_filepaths.items()
+    )
+
+
+@profiled
+def screenline_volumes(store, screenlines, volume_columns):
+    """
+    The CHAMP volumes by time period (CHAMP-{time period} columns) of each
+    screenline (of each screenline set), from one long table of the volumes
+    of the screenlines' links by time period, with a single join and grouped
+    aggregation
+
+    screenlines: output of read_screenline_sets()
+    volume_columns: loaded network columns summed as the link volume
+    """
+    time_period_volume_columns = {
+        time_period: period_columns(store, volume_columns, time_period)
+        for time_period in time_periods
+    }
+    # all the volume columns of the (unique) links, in one store lookup
+    link_volumes = join_links(
+        screenlines.select("A", "B").unique(),
+        store,
+        columns=list(
+            dict.fromkeys(
+                col
+                for cols in time_period_volume_columns.values()
+                for col in cols
             )
-            # pl.scan_csv(
-            #     Path(model_run_dir, f"{filename_root}.csv"),
-            #     separator=",",
-            #     quote_char="'",
-            #     dtypes={col: pl.Float64 for col in loaded_network_vol_cols},
-            # )
-            .with_columns(
-                # columns to sum:
-                # cf. Y:\champ\dev\...\scripts\summarize\create-daily.s
-                # this script is called from modelRunTopsheet, which was
-                # referenced when I created this script
-                pl.sum_horizontal(loaded_network_vol_cols).alias(column_name)
-            ).select(["A", "B", column_name])
+        ),
+    )
+    link_volumes = pl.concat(
+        link_volumes.select(
+            "A",
+            "B",
+            pl.lit(time_period).alias("time_period"),
+            # links not in the loaded networks count as 0
+            pl.sum_horizontal(cols).alias("volume"),
         )
-        screenline_vols = screenline_vols.join(
-            loaded_network, on=["A", "B"], how="left"
+        for time_period, cols in time_period_volume_columns.items()
+    )
+    return (
+        screenlines.with_row_index("order")
+        .join(link_volumes, on=["A", "B"], how="left")
+        .group_by(["screenline_set"] + screenline_cols + ["time_period"])
+        .agg(pl.col("order").min(), pl.col("volume").sum())
+        .pivot(
+            on="time_period",
+            index=["screenline_set"] + screenline_cols + ["order"],
+            values="volume",
+        )
+        # keep the screenlines in their order of (first) appearance
+        .sort("order")
+        .select(
+            "screenline_set",
+            *screenline_cols,
+            *(pl.col(t).alias(f"CHAMP-{t}") for t in time_periods),
+        )
+    )
+
+
+@profiled
+def screenline(
+    model_run_dir,
+    out_dir,
+    screenline_set_filepaths=None,
+    volume_columns=default_volume_columns,
+    *,
+    cache_dir,
+):
+    """
+    Screenline volumes for any number of screenline sets (written to one
+    output file per set) in one pass. The screenlines' links are looked up in
+    the (memory-mapped) link store of model_run_dir, which is built
+    (in cache_dir) from the loaded networks if needed
+
+    screenline_set_filepaths: {screenline set name: screenline (A, B) file},
+        default: {"screenline": out_dir/screenline-AB.csv}
+    volume_columns: loaded network columns summed as the link volume
+    """
+    out_dir = Path(out_dir)
+    if screenline_set_filepaths is None:
+        screenline_set_filepaths = {
+            screenline_set: out_dir / filename
+            for screenline_set, filename in default_screenline_sets.items()
+        }
+    store = open_link_store(
+        model_run_dir, link_store_dir(model_run_dir, cache_dir)
+    )
+
+    screenline_vols = time_period_conversion_champ_to_mtc(
+        screenline_volumes(
+            store,
+            read_screenline_sets(screenline_set_filepaths),
+            volume_columns,
         )
-    screenline_vols = screenline_vols.group_by(
-        ["Route Number/Direction", "Link Description"], maintain_order=True
-    ).agg((pl.sum(col) for col in champ_volume_columns))
-    time_period_conversion_champ_to_mtc(screenline_vols).write_csv(
-        out_filepath
     )
+    for (screenline_set,), df in screenline_vols.partition_by(
+        "screenline_set", as_dict=True, include_key=False
+    ).items():
+        df.write_csv(out_filepath(out_dir, screenline_set))
 
 
 if __name__ == "__main__":
     config = load_config()
-    screenline(
-        config["champ"]["forecast"]["model_run_dir"],
-        config["out_dir"],
+    model_run_dir = config["champ"]["forecast"]["model_run_dir"]
+    out_dir = Path(config["out_dir"])
+    screenline_config = config.get("screenline", {})
+    screenline_set_filepaths = screenline_config.get(
+        "sets",
+        {
+            screenline_set: str(out_dir / filename)
+            for screenline_set, filename in default_screenline_sets.items()
+        },
+    )
+    run_if_stale(
+        screenline,
+        [out_filepath(out_dir, s) for s in screenline_set_filepaths],
+        list(screenline_set_filepaths.values())
+        + [loaded_network_filepath(model_run_dir, t) for t in time_periods],
+        model_run_dir,
+        out_dir,
+        screenline_set_filepaths,
+        screenline_config.get("volume_columns", default_volume_columns),
+        cache_dir=config["cache_dir"],
+        force=config["force"],
     )
+    write_profile(config["out_dir"])
@@ -0,0 +1,262 @@
+"""
+Local staging cache of the input files on network shares (X:, Y:, Q:, ...):
+before a report is run (see incremental.run_if_stale), the input files it
+declares are copied, concurrently with a thread pool, to a local staging
+directory, and the core readers (Daysim outputs, TAZ tables, loaded
+networks) transparently read the local copies instead (staged_filepath()).
+
+A copy is reused as long as its source file's size and modification time are
+unchanged, and the copy's own size matches (and, with verify, its sha256,
+computed while copying). The staging directory is kept under a maximum size
+by evicting the least recently used copies (but not those used since the
+run started, which concurrent runs might be reading). The manifest is only
+updated under a lock file, shared by the concurrent runs (of any process).
+
+Enable it with staging_dir (and optionally staging_max_size_gb) in the
+config. Prefetch (and verify) all the inputs of a config's model runs with
+python staging.py <config filename>
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from file_lock import file_lock, tmp_filepath
+from profiling import profiled
+
+manifest_filename = ".staging-manifest.json"
+copy_buffer_size = 16 * 2**20
+
+# set by configure() (from the config, in core.load_config())
+_staging = {"dir": None, "max_bytes": None}
+# {source filepath (resolved): local copy filepath}, of this process' prefetch
+_staged = {}
+# one prefetch at a time, e.g. of concurrent reports (of this process)
+_prefetch_lock = threading.Lock()
+# the copies used since then aren't evicted
+_run_start = time.time()
+
+
+def configure(staging_dir, max_size_gb=None):
+    """
+    Stage the input files in staging_dir (None: don't stage), keeping it
+    under max_size_gb (None: no limit)
+    """
+    _staging["dir"] = None if staging_dir is None else Path(staging_dir)
+    _staging["max_bytes"] = (
+        None if max_size_gb is None else int(max_size_gb * 2**30)
+    )
+
+
+def staged_filepath(filepath):
+    """the local copy of filepath if it was prefetched, else filepath"""
+    return _staged.get(str(Path(filepath).resolve()), filepath)
+
+
+def _read_manifest(manifest_filepath):
+    try:
+        with open(manifest_filepath) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_manifest(manifest, manifest_filepath):
+    manifest_tmp_filepath = tmp_filepath(manifest_filepath)
+    with open(manifest_tmp_filepath, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_tmp_filepath, manifest_filepath)
+
+
+def _local_filename(source):
+    """unique to the source filepath, keeping its name (and suffix)"""
+    source_hash = hashlib.sha256(source.encode()).hexdigest()
+    return f"{source_hash[:16]}-{Path(source).name}"
+
+
+def _sha256(filepath):
+    with open(filepath, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _is_fresh(entry, source_stat, local_filepath, verify):
+    return (
+        entry is not None
+        and entry["size"] == source_stat.st_size
+        and entry["mtime_ns"] == source_stat.st_mtime_ns
+        and local_filepath.exists()
+        and local_filepath.stat().st_size == entry["size"]
+        and (not verify or _sha256(local_filepath) == entry["sha256"])
+    )
+
+
+def _copy(source, local_filepath):
+    """
+    Copy source to local_filepath (keeping its modification time), hashing
+    it on the way; returns its manifest entry
+    """
+    local_tmp_filepath = tmp_filepath(local_filepath)
+    sha256 = hashlib.sha256()
+    with open(source, "rb") as src, open(local_tmp_filepath, "wb") as dst:
+        while chunk := src.read(copy_buffer_size):
+            sha256.update(chunk)
+            dst.write(chunk)
+    shutil.copystat(source, local_tmp_filepath)
+    # stat the source after copying, so that a copy of a file modified
+    # while being copied isn't considered fresh later
+    source_stat = Path(source).stat()
+    os.replace(local_tmp_filepath, local_filepath)
+    return {
+        "local": local_filepath.name,
+        "size": source_stat.st_size,
+        "mtime_ns": source_stat.st_mtime_ns,
+        "sha256": sha256.hexdigest(),
+    }
+
+
+def _evict(manifest, staging_dir, max_bytes, keep):
+    """
+    Delete the least recently used copies (except those in keep, and those
+    used since the run started) until the copies fit in max_bytes
+    """
+    total = sum(entry["size"] for entry in manifest.values())
+    for source, entry in sorted(
+        manifest.items(), key=lambda item: item[1]["last_used"]
+    ):
+        if total <= max_bytes:
+            break
+        if source in keep or entry["last_used"] >= _run_start:
+            continue
+        (staging_dir / entry["local"]).unlink(missing_ok=True)
+        del manifest[source]
+        total -= entry["size"]
+
+
+@profiled
+def prefetch(filepaths, max_workers=8, verify=False):
+    """
+    Copy the (existing) files in filepaths that aren't staged yet (or are
+    stale) to the staging directory, concurrently, and read them from there
+    from now on. Does nothing if staging isn't configured.
+
+    verify: also check the sha256 of the copies that are reused
+
+    Returns {source filepath: local copy filepath}.
+    """
+    if _staging["dir"] is None:
+        return {}
+    with _prefetch_lock:
+        return _prefetch(filepaths, max_workers, verify)
+
+
+def _touch(manifest, sources):
+    now = time.time()
+    for source in sources:
+        manifest[source]["last_used"] = now
+
+
+def _prefetch(filepaths, max_workers, verify):
+    staging_dir = _staging["dir"]
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    manifest_filepath = staging_dir / manifest_filename
+    sources = [
+        str(filepath)
+        for filepath in dict.fromkeys(Path(f).resolve() for f in filepaths)
+        if filepath.is_file()
+    ]
+    local_filepaths = {
+        source: staging_dir / _local_filename(source) for source in sources
+    }
+    # mark the fresh copies as used first, so that concurrent runs don't
+    # evict them while the others are copied (outside of the lock)
+    with file_lock(manifest_filepath):
+        manifest = _read_manifest(manifest_filepath)
+        fresh = [
+            source
+            for source in sources
+            if _is_fresh(
+                manifest.get(source),
+                Path(source).stat(),
+                local_filepaths[source],
+                verify=False,
+            )
+        ]
+        _touch(manifest, fresh)
+        _write_manifest(manifest, manifest_filepath)
+    if verify:
+        fresh = [
+            source
+            for source in fresh
+            if _sha256(local_filepaths[source]) == manifest[source]["sha256"]
+        ]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        copies = {}
+        for source in sources:
+            if source not in fresh:
+                print(f"staging {source}")
+                copies[source] = executor.submit(
+                    _copy, source, local_filepaths[source]
+                )
+        copied = {source: copy.result() for source, copy in copies.items()}
+
+    # merge into the manifest as (re)written meanwhile by concurrent runs
+    with file_lock(manifest_filepath):
+        manifest = _read_manifest(manifest_filepath)
+        manifest.update(copied)
+        for source in sources:
+            # (a fresh copy evicted meanwhile by a run started since)
+            if source not in manifest:
+                manifest[source] = _copy(source, local_filepaths[source])
+        _touch(manifest, sources)
+        if _staging["max_bytes"] is not None:
+            _evict(
+                manifest,
+                staging_dir,
+                _staging["max_bytes"],
+                set(sources) | set(_staged),
+            )
+        _write_manifest(manifest, manifest_filepath)
+
+    staged = {
+        source: staging_dir / manifest[source]["local"] for source in sources
+    }
+    _staged.update(staged)
+    return staged
+
+
+if __name__ == "__main__":
+    # (core imports this module)
+    from core import (
+        daysim_filepath,
+        load_config,
+        loaded_network_filepath,
+        time_periods,
+    )
+
+    config = load_config()
+    configure(config.get("staging_dir"), config.get("staging_max_size_gb"))
+    if _staging["dir"] is None:
+        raise SystemExit("no staging_dir in the config")
+    filepaths = []
+    for run in config["champ"].values():
+        if "taz_filepath" in run:
+            filepaths.append(run["taz_filepath"])
+        if "model_run_dir" in run:
+            filepaths += [
+                daysim_filepath(run["model_run_dir"], filename)
+                for filename in [
+                    "_household_2.dat",
+                    "_person_2.dat",
+                    "_tour_2.dat",
+                    "_trip_2.dat",
+                ]
+            ] + [
+                loaded_network_filepath(run["model_run_dir"], t)
+                for t in time_periods
+            ]
+    prefetch(filepaths, verify=True)
@@ -1,82 +1,211 @@
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import geopandas as gpd
-import matplotlib.pyplot as plt
-import pandas as pd
-from core import load_config, read_taz
+import matplotlib
+from core import load_config, read_mtc_taz_landuse, read_taz
+from incremental import run_if_stale
+from matplotlib.figure import Figure
+from profiling import profiled, write_profile
+
+# {variable: (CHAMP tazdata column, MTC land use column)}
+map_variables = {"hh": ("HHLDS", "TOTHH"), "emp": ("TOTALEMP", "TOTEMP")}
+
+
+def _cache_filepath(source_filepath, cache_dir, suffix=""):
+    return Path(cache_dir) / f"{Path(source_filepath).stem}{suffix}.parquet"
+
+
+def _is_cache_fresh(cache_filepath, source_filepath):
+    return (
+        cache_filepath.exists()
+        and cache_filepath.stat().st_mtime
+        >= Path(source_filepath).stat().st_mtime
+    )
+
+
+@profiled
+def read_gis_cached(gis_filepath, cache_dir, columns=None):
+    """
+    Read a GIS file (e.g. shapefile), caching it as GeoParquet in cache_dir
+    so that later reads only parse the requested columns
+    """
+    cache_filepath = _cache_filepath(gis_filepath, cache_dir)
+    if not _is_cache_fresh(cache_filepath, gis_filepath):
+        cache_filepath.parent.mkdir(parents=True, exist_ok=True)
+        gpd.read_file(gis_filepath).to_parquet(cache_filepath)
+    if columns is not None:
+        columns = list(columns) + ["geometry"]
+    return gpd.read_parquet(cache_filepath, columns=columns)
+
+
+def _out_filepath_stem(out_dir, out_prefix, year):
+    return Path(out_dir) / f"{out_prefix}-taz-diff-{year}"
+
+
+def out_filepaths(champ_taz_filepaths, out_dir, variables=map_variables):
+    """the map layers (.gpkg) and images (.png) written by taz_maps()"""
+    out_filepaths = []
+    for year, (_, out_prefix) in champ_taz_filepaths.items():
+        out_filepath_stem = _out_filepath_stem(out_dir, out_prefix, year)
+        out_filepaths.append(f"{out_filepath_stem}.gpkg")
+        out_filepaths.extend(
+            f"{out_filepath_stem}-{var}.png" for var in variables
+        )
+    return out_filepaths
+
+
+def _gis_filepaths(gis_filepath):
+    """the GIS file and its sidecar files (e.g. .dbf, .shx, .prj)"""
+    gis_filepath = Path(gis_filepath)
+    return sorted(gis_filepath.parent.glob(f"{gis_filepath.stem}.*"))
+
+
+def _init_plot_worker():
+    matplotlib.use("Agg")  # headless
 
 
 def plot_map(gdf, var, out_filepath_stem):
-    assert var in {"hh", "emp"}
-    ax = gdf.plot(f"{var}-diff-CHAMP_-_MTC", legend=True)
+    fig = Figure()
+    ax = fig.subplots()
+    gdf.plot(f"{var}-diff-CHAMP_-_MTC", ax=ax, legend=True)
     ax.set_xlim([5978000, 6026000])
     ax.set_ylim([2085000, 2132000])
-    plt.savefig(f"{out_filepath_stem}-{var}.png")
-
+    fig.savefig(f"{out_filepath_stem}-{var}.png")
 
-def write_map_output(gdf, out_filepath_stem):
-    gdf.to_file(f"{out_filepath_stem}.gpkg")
-    plot_map(gdf, "hh", out_filepath_stem)
-    plot_map(gdf, "emp", out_filepath_stem)
 
-
-def taz_maps(
-    champ_forecast_taz_filepath,
+@profiled
+def taz_comparison(
+    champ_taz_filepath,
     mtc_taz_excel_filepath,
-    mtc_taz_gis_filepath,
-    out_dir,
-    forecast_year,
+    year,
+    cache_dir,
+    variables=map_variables,
 ):
-    champ_forecast_taz = read_taz(
-        champ_forecast_taz_filepath, usecols={"MTCTAZ", "HHLDS", "TOTALEMP"}
+    champ_taz = read_taz(
+        champ_taz_filepath,
+        usecols={"MTCTAZ"} | {champ for champ, _ in variables.values()},
     )
-    mtc_forecast_taz = pd.read_excel(
+    mtc_taz = read_mtc_taz_landuse(
         mtc_taz_excel_filepath,
-        sheet_name=str(forecast_year),
-        usecols=["ZONE", "COUNTY", "TOTHH", "TOTEMP"],
-    )
-    out_filepath_stem = (
-        Path(out_dir) / f"C-ForecastYearDemographics-taz-diff-{forecast_year}"
-    )
+        cache_dir,
+        years=[year],
+        usecols=["ZONE", "COUNTY"] + [mtc for _, mtc in variables.values()],
+    ).drop(columns="year")
 
-    champ_forecast_taz = (
-        champ_forecast_taz[champ_forecast_taz["COUNTY"] == 1]  # SF only
-        .rename(columns={"HHLDS": "HH-CHAMP", "TOTALEMP": "EMP-CHAMP"})
+    champ_taz = (
+        champ_taz[champ_taz["COUNTY"] == 1]  # SF only
+        .rename(
+            columns={
+                champ: f"{var.upper()}-CHAMP"
+                for var, (champ, _) in variables.items()
+            }
+        )
         .drop(columns=["SFTAZ", "COUNTY", "SUPERDST"])
         .groupby("MTCTAZ")
         .sum()  # sum households and employment
     )
 
-    mtc_forecast_taz = (
-        mtc_forecast_taz[mtc_forecast_taz["COUNTY"] == 1]  # SF only
+    mtc_taz = (
+        mtc_taz[mtc_taz["COUNTY"] == 1]  # SF only
         .rename(
-            columns={"ZONE": "MTCTAZ", "TOTHH": "HH-MTC", "TOTEMP": "EMP-MTC"}
+            columns={"ZONE": "MTCTAZ"}
+            | {
+                mtc: f"{var.upper()}-MTC"
+                for var, (_, mtc) in variables.items()
+            }
         )
         .drop(columns=["COUNTY"])
         .set_index("MTCTAZ")
     )
 
-    taz_comparison = champ_forecast_taz.join(mtc_forecast_taz, on="MTCTAZ")
-    taz_comparison["hh-diff-CHAMP_-_MTC"] = (
-        taz_comparison["HH-CHAMP"] - taz_comparison["HH-MTC"]
-    )
-    taz_comparison["emp-diff-CHAMP_-_MTC"] = (
-        taz_comparison["EMP-CHAMP"] - taz_comparison["EMP-MTC"]
-    )
+    taz_comparison = champ_taz.join(mtc_taz, on="MTCTAZ")
+    for var in variables:
+        taz_comparison[f"{var}-diff-CHAMP_-_MTC"] = (
+            taz_comparison[f"{var.upper()}-CHAMP"]
+            - taz_comparison[f"{var.upper()}-MTC"]
+        )
+    return taz_comparison
+
 
-    gdf = gpd.read_file(mtc_taz_gis_filepath)
+@profiled
+def taz_maps(
+    champ_taz_filepaths,
+    mtc_taz_excel_filepath,
+    mtc_taz_gis_filepath,
+    out_dir,
+    *,
+    cache_dir,
+    variables=map_variables,
+    max_workers=None,
+):
+    """
+    champ_taz_filepaths: {year: (CHAMP tazdata filepath, output name prefix)}
+    e.g. {2050: (".../tazdata.csv", "C-ForecastYearDemographics")}
+    The GIS file and Excel workbook are cached (as (Geo)Parquet) in
+    cache_dir, and the maps for all the years and variables are rendered in
+    parallel (in max_workers processes).
+    """
+    gdf = read_gis_cached(
+        mtc_taz_gis_filepath, cache_dir, columns=["TAZ1454", "COUNTY"]
+    )
     gdf = gdf[gdf["COUNTY"] == 1]  # SF only
-    gdf = gdf.merge(taz_comparison, left_on="TAZ1454", right_on="MTCTAZ")
 
-    write_map_output(gdf, out_filepath_stem)
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_init_plot_worker
+    ) as executor:
+        futures = []
+        for year, champ_taz in champ_taz_filepaths.items():
+            champ_taz_filepath, out_prefix = champ_taz
+            out_filepath_stem = _out_filepath_stem(out_dir, out_prefix, year)
+            year_gdf = gdf.merge(
+                taz_comparison(
+                    champ_taz_filepath,
+                    mtc_taz_excel_filepath,
+                    year,
+                    cache_dir,
+                    variables=variables,
+                ),
+                left_on="TAZ1454",
+                right_on="MTCTAZ",
+            )
+            year_gdf.to_file(f"{out_filepath_stem}.gpkg")
+            for var in variables:
+                futures.append(
+                    executor.submit(
+                        plot_map,
+                        year_gdf[[f"{var}-diff-CHAMP_-_MTC", "geometry"]],
+                        var,
+                        out_filepath_stem,
+                    )
+                )
+        for future in futures:
+            future.result()  # raise any exceptions from the workers
 
 
 if __name__ == "__main__":
     config = load_config()
-    taz_maps(
-        config["champ"]["forecast"]["taz_filepath"],
+    champ_taz_filepaths = {
+        config["base_year"]: (
+            config["champ"]["base"]["taz_filepath"],
+            "B-BaseYearDemographics",
+        ),
+        config["forecast_year"]: (
+            config["champ"]["forecast"]["taz_filepath"],
+            "C-ForecastYearDemographics",
+        ),
+    }
+    run_if_stale(
+        taz_maps,
+        out_filepaths(champ_taz_filepaths, config["out_dir"]),
+        [taz_filepath for taz_filepath, _ in champ_taz_filepaths.values()]
+        + [config["mtc"]["taz_excel_filepath"]]
+        + _gis_filepaths(config["mtc"]["taz_gis_filepath"]),
+        champ_taz_filepaths,
         config["mtc"]["taz_excel_filepath"],
         config["mtc"]["taz_gis_filepath"],
         config["out_dir"],
-        config["forecast_year"],
+        cache_dir=config["cache_dir"],
+        force=config["force"],
     )
+    write_profile(config["out_dir"])
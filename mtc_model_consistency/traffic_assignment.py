@@ -5,8 +5,17 @@ First create the LOAD{XX}_FINAL.csv files with Y:/champ/util/Validation/NETtoCSV
 
 from pathlib import Path
 
-import pandas as pd
-from core import load_config, time_periods
+import polars as pl
+from core import (
+    load_config,
+    loaded_network_filepath,
+    time_period_conversion_champ_to_mtc,
+    time_periods,
+)
+from incremental import run_if_stale
+from link_store import link_store_dir, open_link_store, period_columns
+from profiling import profiled, write_profile
+from rollup import grouping_sets
 
 facility_type_champ = {
     1: "Ramp",
@@ -32,6 +41,11 @@ facility_type_champ_to_mtc = {
     15: "Major arterials",
 }
 
+out_filename = "J-Traffic&TransitAssignment-VMTVHTSpeed-2050.csv"
+breakdown_out_filename = (
+    "J-Traffic&TransitAssignment-VMTVHTSpeed-breakdown-2050.csv"
+)
+
 facility_types_mtc = [
     # "Managed Freeways",  # no easy way to get VHT & VMT of all toll/express lanes in CHAMP
     "Freeways",
@@ -43,81 +57,203 @@ facility_types_mtc = [
 ]
 
 
-def load_VMT_and_VHT(model_run_dir, time_period):
-    loaded_network = pd.read_csv(
-        model_run_dir / f"LOAD{time_period}_FINAL.csv",
-        usecols=["FT", "VDT_1", "VHT_1"],
+def link_VMT_and_VHT(store, dimensions, facility_types):
+    """
+    (Lazy) long table of the VMT and VHT of every link and time period, with
+    the link's facility_type (FT mapped with facility_types; null if
+    unmapped) and dimensions (loaded network columns, e.g. AT, TOLL; time
+    period specific columns, e.g. TOLL-AM, are taken for each time period)
+    """
+    links = store.links.lazy()
+    return pl.concat(
+        links.select(
+            pl.col(period_columns(store, ["FT"], time_period)[0])
+            .replace_strict(
+                facility_types, default=None, return_dtype=pl.String
+            )
+            .alias("facility_type"),
+            *(
+                pl.col(col).alias(dimension)
+                for dimension, col in zip(
+                    dimensions,
+                    period_columns(store, dimensions, time_period),
+                )
+            ),
+            pl.lit(time_period).alias("time_period"),
+            *(
+                pl.col(col).alias(var)
+                for var, col in zip(
+                    ["VMT", "VHT"],
+                    period_columns(store, ["VDT_1", "VHT_1"], time_period),
+                )
+            ),
+        )
+        for time_period in time_periods
     )
-    loaded_network["FT"] = loaded_network["FT"].map(facility_type_champ_to_mtc)
-    VMT_and_VHT_by_FT = (
-        loaded_network.groupby("FT")
-        .sum()
-        .rename(columns={"VDT_1": "VMT", "VHT_1": "VHT"})
+
+
+@profiled
+def aggregate_VMT_and_VHT(
+    store, dimensions=(), facility_types=facility_type_champ_to_mtc
+):
+    """
+    CHAMP VMT and VHT by time period, facility_type and dimensions, for all
+    the links and time periods in one (lazy) pass over the link store; any
+    coarser breakdown (e.g. the MTC table) can be summed from this
+    """
+    dimensions = list(dimensions)
+    return (
+        link_VMT_and_VHT(store, dimensions, facility_types)
+        .group_by(["facility_type"] + dimensions + ["time_period"])
+        .agg(pl.col("VMT").sum(), pl.col("VHT").sum())
+        .collect()
     )
-    VMT_and_VHT_by_FT.loc["All Facilities"] = VMT_and_VHT_by_FT.sum()
-    return VMT_and_VHT_by_FT
 
 
-def load_VMT_and_VHT_all_time_periods(model_run_dir):
-    return {t: load_VMT_and_VHT(model_run_dir, t) for t in time_periods}
+def _time_period_conversion(VMT_and_VHT, by):
+    """
+    Convert the summed CHAMP time period VMT and VHT (long: by, time_period)
+    to MTC time periods (plus All Time), in long format
+    """
+    mtc = []
+    for var in ["VMT", "VHT"]:
+        champ = (
+            VMT_and_VHT.pivot(on="time_period", index=by, values=var)
+            .with_columns(pl.col(time_periods).fill_null(0))
+            .rename({t: f"CHAMP-{t}" for t in time_periods})
+        )
+        mtc.append(
+            time_period_conversion_champ_to_mtc(champ)
+            .select(*by, *(pl.col(f"MTC-{t}").alias(t) for t in time_periods))
+            .unpivot(index=by, variable_name="time_period", value_name=var)
+        )
+    return grouping_sets(
+        # (null facility_type/dimensions, e.g. unmapped FTs, are kept)
+        mtc[0].join(mtc[1], on=by + ["time_period"], nulls_equal=True),
+        by + ["time_period"],
+        [by + ["time_period"], by],
+        ["VMT", "VHT"],
+        labels={"time_period": "All Time"},
+    ).with_columns((pl.col("VMT") / pl.col("VHT")).alias("avg_speed"))
 
 
-def time_period_conversion_champ_to_mtc(champ_timeperiods_dict):
+def VMT_VHT_speed_table(VMT_and_VHT):
     """
-    Convert from 3hr (CHAMP) to 4hr (MTC) peaks while maintaining totals.
-    The conversion factors have been used since 2019, and are derived from PeMS
-    See Q:/MTC/Model/ConsistencyReports/2021/Analysis/12.HighwayAssignment.xlsx
+    The MTC VMT/VHT/avg_speed table (rows: variable, time period (MTC),
+    columns: MTC facility types), from the output of aggregate_VMT_and_VHT()
     """
-    mtc_timeperiods_dict = {
-        "EA": champ_timeperiods_dict["EA"] * 0.75178,  # 0300-0600
-        "AM": (
-            champ_timeperiods_dict["EA"] * 0.24822  # 0600-0630
-            + champ_timeperiods_dict["AM"]  # 0630-0930
-            + champ_timeperiods_dict["MD"] * 0.09532  # 0930-1000
-        ),
-        "MD": champ_timeperiods_dict["MD"] * 0.81584,  # 1000-1500
-        "PM": (
-            champ_timeperiods_dict["MD"] * 0.08884  # 1500-1530
-            + champ_timeperiods_dict["PM"]  # 1530-1830
-            + champ_timeperiods_dict["EV"] * 0.11220  # 1830-1900
-        ),
-        "EV": champ_timeperiods_dict["EV"] * 0.88780,  # 1900-0300
-    }
-    return mtc_timeperiods_dict
+    by_facility_type = grouping_sets(
+        VMT_and_VHT.filter(pl.col("facility_type").is_not_null()),
+        ["facility_type", "time_period"],
+        [["facility_type", "time_period"], ["time_period"]],
+        ["VMT", "VHT"],
+        labels={"facility_type": "All Facilities"},
+    )
+    return (
+        _time_period_conversion(by_facility_type, ["facility_type"])
+        .unpivot(
+            index=["facility_type", "time_period"],
+            on=["VMT", "VHT", "avg_speed"],
+        )
+        .pivot(
+            on="facility_type",
+            index=["variable", "time_period"],
+            values="value",
+        )
+        .sort(
+            pl.col("variable").cast(pl.Enum(["VMT", "VHT", "avg_speed"])),
+            pl.col("time_period").cast(pl.Enum(time_periods + ["All Time"])),
+        )
+        .select(
+            "variable",
+            "time_period",
+            *(
+                (
+                    pl.col(facility_type)
+                    if facility_type in by_facility_type["facility_type"]
+                    else pl.lit(None, pl.Float64).alias(facility_type)
+                )
+                for facility_type in facility_types_mtc
+            ),
+        )
+    )
+
+
+def VMT_VHT_speed_breakdown(VMT_and_VHT, dimensions):
+    """
+    VMT/VHT/avg_speed by facility_type and dimensions (long, by MTC time
+    period), from the output of aggregate_VMT_and_VHT()
+    """
+    return _time_period_conversion(
+        VMT_and_VHT, ["facility_type"] + list(dimensions)
+    ).sort(
+        pl.all().exclude("time_period", "VMT", "VHT", "avg_speed"),
+        pl.col("time_period").cast(pl.Enum(time_periods + ["All Time"])),
+        nulls_last=True,
+    )
+
 
+@profiled
+def traffic_assignment(
+    model_run_dir,
+    out_dir,
+    breakdown_dimensions=(),
+    facility_types=facility_type_champ_to_mtc,
+    *,
+    cache_dir,
+):
+    """
+    The MTC VMT/VHT/speed table, and, if breakdown_dimensions (loaded network
+    columns, e.g. ["AT", "TOLL"]) are given, the VMT/VHT/speed by facility
+    type and breakdown_dimensions, from one aggregation of the (memory-mapped)
+    link store of model_run_dir (built in cache_dir)
 
-def traffic_assignment(model_run_dir, out_dir):
-    mtc_timeperiods_dict = time_period_conversion_champ_to_mtc(
-        load_VMT_and_VHT_all_time_periods(Path(model_run_dir))
+    facility_types: {CHAMP FT: MTC facility type}
+    """
+    store = open_link_store(
+        model_run_dir, link_store_dir(model_run_dir, cache_dir)
     )
-    dfs = []
-    for t, df in mtc_timeperiods_dict.items():
-        df["timeperiod"] = t
-        dfs.append(df)
-    df = pd.concat(dfs)
-    alltime_df = df.groupby("FT").sum()
-    alltime_df["timeperiod"] = "All Time"
-    df = pd.concat((df, alltime_df))
-    df["avg_speed"] = df["VMT"] / df["VHT"]
-    df = df.reset_index().melt(
-        id_vars=["FT", "timeperiod"], value_vars=["VMT", "VHT", "avg_speed"]
+    VMT_and_VHT = aggregate_VMT_and_VHT(
+        store, breakdown_dimensions, facility_types
     )
-    df.pivot_table(
-        columns="FT", index=["variable", "timeperiod"], values="value"
-    ).reindex(
-        pd.MultiIndex.from_product(
-            (["VMT", "VHT", "avg_speed"], time_periods + ["All Time"])
+    # with the (blank) index column headers of the original pandas table
+    with open(Path(out_dir) / out_filename, "w", newline="") as f:
+        f.write(",".join(["", "", *facility_types_mtc]) + "\n")
+        VMT_VHT_speed_table(VMT_and_VHT).write_csv(f, include_header=False)
+    if breakdown_dimensions:
+        VMT_VHT_speed_breakdown(VMT_and_VHT, breakdown_dimensions).write_csv(
+            Path(out_dir) / breakdown_out_filename
         )
-    )[
-        facility_types_mtc
-    ].to_csv(
-        Path(out_dir) / "J-Traffic&TransitAssignment-VMTVHTSpeed-2050.csv"
-    )
 
 
 if __name__ == "__main__":
     config = load_config()
-    traffic_assignment(
-        config["champ"]["forecast"]["model_run_dir"],
+    model_run_dir = config["champ"]["forecast"]["model_run_dir"]
+    traffic_assignment_config = config.get("traffic_assignment", {})
+    breakdown_dimensions = traffic_assignment_config.get(
+        "breakdown_dimensions", []
+    )
+    # TOML keys are strings
+    facility_types = {
+        int(ft): facility_type
+        for ft, facility_type in traffic_assignment_config.get(
+            "facility_types", facility_type_champ_to_mtc
+        ).items()
+    }
+    run_if_stale(
+        traffic_assignment,
+        [Path(config["out_dir"]) / out_filename]
+        + (
+            [Path(config["out_dir"]) / breakdown_out_filename]
+            if breakdown_dimensions
+            else []
+        ),
+        [loaded_network_filepath(model_run_dir, t) for t in time_periods],
+        model_run_dir,
         config["out_dir"],
+        breakdown_dimensions,
+        facility_types,
+        cache_dir=config["cache_dir"],
+        force=config["force"],
     )
+    write_profile(config["out_dir"])
@@ -1,10 +1,12 @@
 from pathlib import Path
 
-import pandas as pd
 import polars as pl
 from core import load_config, time_period_conversion_champ_to_mtc, time_periods
+from incremental import run_if_stale
+from profiling import profiled, write_profile
+from rollup import grouping_sets
 
-# these 2 lists are for sorting via pandas reindex later
+# these 2 lists are for sorting (and selecting the output rows) later
 operators_mtc = [
     "AC Transit",
     "BART",
@@ -41,66 +43,115 @@ techs_mtc = [
     "All",
 ]
 
+# in out_dir/transit_assignment/
+transit_data_dirname = "transit_assignment"
+quickboards_filename = "quickboards-transit_line_boardings.csv"
+line_operator_techs_filename = "transit_lines-operator-tech.csv"
+out_filename = "J-Traffic&TransitAssignment-Transit-2050.csv"
 
-def transit(out_dir):
-    transit_data_dir = Path(out_dir) / "transit_assignment"
-    out_csv_filepath = (
-        transit_data_dir / "J-Traffic&TransitAssignment-Transit-2050.csv"
-    )
+mtc_operator_techs = pl.DataFrame(
+    {"Operator": operators_mtc, "Technology": techs_mtc}
+)
 
-    boardings = pl.from_pandas(
-        # cast from pandas to polars df as join not working in pandas
-        pd.read_csv(  # read as pandas df to use thousands arg
-            transit_data_dir / "quickboards-transit_line_boardings.csv",
-            thousands=",",
-        ),
-        # no need to cast as int as time period conversion later
-        # would cast back these numbers back as float
-        # schema_overrides={
-        #     "Daily": int,
-        #     "AM": int,
-        #     "MD": int,
-        #     "PM": int,
-        #     "EV": int,
-        #     "EA": int,
-        # },
-    ).join(
-        pl.read_csv(
-            transit_data_dir / "transit_lines-operator-tech.csv",
-            columns=["Line Name", "Operator", "Technology"],
+
+def scan_quickboards_boardings(quickboards_filepath):
+    """
+    Boardings by line and (CHAMP) time period from quickboards, parsing the
+    comma-thousands numbers (e.g. "1,234") while scanning
+    """
+    return pl.scan_csv(
+        quickboards_filepath,
+        schema_overrides={t: pl.String for t in time_periods},
+    ).select(
+        pl.col("Line Name").cast(pl.Categorical),
+        *(
+            pl.col(t).str.replace_all(",", "", literal=True).cast(pl.Float64)
+            # no need to cast as int as time period conversion later
+            # would cast back these numbers back as float
+            .fill_null(0)
+            for t in time_periods
         ),
-        on="Line Name",
     )
-    boardings = (
-        time_period_conversion_champ_to_mtc(
-            boardings.fill_null(strategy="zero")
-            .group_by(["Operator", "Technology"])
-            .sum()
-            .rename({t: f"CHAMP-{t}" for t in time_periods})
-        )
-        .select(
-            ["Operator", "Technology"] + [f"MTC-{t}" for t in time_periods]
-        )
-        .sort("Operator", "Technology")
+
+
+def scan_line_operator_techs(line_operator_techs_filepath):
+    return pl.scan_csv(line_operator_techs_filepath).select(
+        pl.col("Line Name").cast(pl.Categorical),
+        pl.col("Operator"),
+        pl.col("Technology"),
     )
+
+
+def report_unmapped_lines(boardings):
+    """
+    print the lines that would be dropped from the output, i.e. without an
+    operator/technology, or with an operator/technology not in the MTC table
+    """
+    unmapped = boardings.join(
+        mtc_operator_techs, on=["Operator", "Technology"], how="anti"
+    )
+    for row in unmapped.iter_rows(named=True):
+        print(
+            "transit line not mapped to an MTC operator/technology:",
+            row["Line Name"],
+            row["Operator"],
+            row["Technology"],
+        )
+    return unmapped
+
+
+@profiled
+def transit(out_dir):
+    transit_data_dir = Path(out_dir) / transit_data_dirname
+    out_csv_filepath = transit_data_dir / out_filename
+
     boardings = (
-        pl.concat(
-            (
-                boardings,
-                boardings.sum().with_columns(
-                    pl.lit("All").alias("Operator"),
-                    pl.lit("All").alias("Technology"),
-                ),
-            )
-            # cast back to pandas to do manual sorting via reindex
+        scan_quickboards_boardings(transit_data_dir / quickboards_filename)
+        .join(
+            scan_line_operator_techs(
+                transit_data_dir / line_operator_techs_filename
+            ),
+            on="Line Name",
+            how="left",
         )
-        .to_pandas()
-        .set_index(["Operator", "Technology"])
-        .reindex(pd.MultiIndex.from_arrays((operators_mtc, techs_mtc)))
-        .to_csv(out_csv_filepath)
+        .collect()
     )
+    report_unmapped_lines(boardings)
+    # by operator/technology, and in total (of the lines with an operator)
+    boardings = time_period_conversion_champ_to_mtc(
+        grouping_sets(
+            boardings.filter(pl.col("Operator").is_not_null()).rename(
+                {t: f"CHAMP-{t}" for t in time_periods}
+            ),
+            ["Operator", "Technology"],
+            [["Operator", "Technology"], []],
+            [f"CHAMP-{t}" for t in time_periods],
+            labels="All",
+        )
+    ).select(["Operator", "Technology"] + [f"MTC-{t}" for t in time_periods])
+    # fixed MTC operator/technology ordering (and rows, incl. All), with the
+    # (blank) index column headers of the original pandas table
+    with open(out_csv_filepath, "w", newline="") as f:
+        f.write(",".join(["", "", *(f"MTC-{t}" for t in time_periods)]) + "\n")
+        mtc_operator_techs.join(
+            boardings,
+            on=["Operator", "Technology"],
+            how="left",
+            maintain_order="left",
+        ).write_csv(f, include_header=False)
 
 
 if __name__ == "__main__":
     config = load_config()
-    transit(config["out_dir"])
+    transit_data_dir = Path(config["out_dir"]) / transit_data_dirname
+    run_if_stale(
+        transit,
+        [transit_data_dir / out_filename],
+        [
+            transit_data_dir / quickboards_filename,
+            transit_data_dir / line_operator_techs_filename,
+        ],
+        config["out_dir"],
+        force=config["force"],
+    )
+    write_profile(config["out_dir"])
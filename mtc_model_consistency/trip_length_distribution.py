@@ -0,0 +1,230 @@
+"""
+Trip length frequency distribution: the number of trips in fixed-width trip
+distance (travdist) bins, by home county, purpose (MTC) and mode (MTC).
+
+The trips (_trip_2.dat) are read chunk by chunk, each chunk's trips being
+binned and added to one NumPy count array (with np.bincount), so the counts
+are exact and the trip table is never fully in memory (only the tours are).
+"""
+
+from math import ceil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from core import (
+    daysim_filepath,
+    load_config,
+    read_tours_with_home_geog,
+    read_trips,
+)
+from incremental import run_if_stale
+from preview import (
+    expand,
+    preview_out_dir,
+    sample_fraction,
+    se_filepath,
+    squares_se,
+)
+from profiling import profiled, write_profile
+from trips import modes_champ_to_mtc, parse_tours, purposes_champ_to_mtc
+
+out_filename = "H-ForecastActivityLocation-triplen_distribution.csv"
+
+# MTC modes/purposes of the CHAMP codes (without the total categories)
+trip_modes = list(dict.fromkeys(modes_champ_to_mtc.values()))
+purposes = list(dict.fromkeys(purposes_champ_to_mtc.values()))
+
+
+def _code_indices(labels, categories):
+    """
+    lookup array from the (non-negative integer) codes of labels
+    ({code: label}) to the index of their label in categories (-1: none)
+    """
+    indices = np.full(max(labels) + 1, -1, dtype=np.int64)
+    for code, label in labels.items():
+        indices[code] = categories.index(label)
+    return indices
+
+
+def _lookup(indices, codes):
+    """indices[codes], with -1 for the codes outside of indices"""
+    codes = np.asarray(codes, dtype=np.int64)
+    in_range = (codes >= 0) & (codes < len(indices))
+    return np.where(in_range, indices[np.where(in_range, codes, 0)], -1)
+
+
+def read_tour_purposes_and_home_counties(model_run_dir, taz_filepath):
+    """
+    The (MTC) purpose and home county of each tour, as indices into purposes
+    and the returned home_counties, indexed by (hhno, pno, tour)
+    """
+    tours = parse_tours(
+        read_tours_with_home_geog(
+            model_run_dir,
+            taz_filepath,
+            pers_usecols=["pptyp"],
+            tours_usecols=["tour", "pdpurp", "parent", "subtrs"],
+        )
+    )
+    home_counties = sorted(tours["home_county"].unique())
+    tour_indices = pd.DataFrame(
+        {
+            "purpose_index": _lookup(
+                _code_indices(purposes_champ_to_mtc, purposes),
+                tours["pdpurp"],
+            ),
+            "home_county_index": tours["home_county"]
+            .map({county: i for i, county in enumerate(home_counties)})
+            .to_numpy(),
+        },
+        index=pd.MultiIndex.from_frame(tours[["hhno", "pno", "tour"]]),
+    )
+    return tour_indices, home_counties
+
+
+@profiled
+def trip_length_counts(
+    model_run_dir,
+    tour_indices,
+    n_home_counties,
+    bin_width,
+    n_bins,
+    chunksize,
+):
+    """
+    Trip counts as an array of shape
+    (n_home_counties, len(purposes), len(trip_modes), n_bins), accumulated
+    over the trips chunk by chunk. The last bin counts all the trips of
+    n_bins - 1 bin widths or longer; trips with a negative distance, or an
+    unmapped (e.g. park and ride) mode or purpose, are not counted.
+
+    Also returns (in preview mode; else None) the sums over the households
+    of their squared trip counts, of the same shape, for the standard
+    errors (per chunk, i.e. approximate for the households whose trips span
+    two chunks; Daysim writes the trips by household)
+    """
+    shape = (n_home_counties, len(purposes), len(trip_modes), n_bins)
+    counts = np.zeros(np.prod(shape), dtype=np.int64)
+    squares = None if sample_fraction() is None else np.zeros(len(counts))
+    mode_indices = _code_indices(modes_champ_to_mtc, trip_modes)
+    for trips in read_trips(
+        model_run_dir,
+        usecols=["hhno", "pno", "tour", "mode", "travdist"],
+        chunksize=chunksize,
+    ):
+        trips = trips.join(tour_indices, on=["hhno", "pno", "tour"])
+        home_county_index = trips["home_county_index"].to_numpy()
+        purpose_index = trips["purpose_index"].to_numpy()
+        mode_index = _lookup(mode_indices, trips["mode"])
+        travdist = trips["travdist"].to_numpy()
+        counted = (
+            ~np.isnan(home_county_index)  # trips of (merged) tours
+            & (purpose_index >= 0)
+            & (mode_index >= 0)
+            & np.isfinite(travdist)
+            & (travdist >= 0)
+        )
+        # binned after masking, as NaN and inf can't be cast to int64
+        bin_index = np.minimum(
+            (travdist[counted] // bin_width).astype(np.int64), n_bins - 1
+        )
+        cell_index = np.ravel_multi_index(
+            (
+                home_county_index[counted].astype(np.int64),
+                purpose_index[counted].astype(np.int64),
+                mode_index[counted],
+                bin_index,
+            ),
+            shape,
+        )
+        counts += np.bincount(cell_index, minlength=len(counts))
+        if squares is not None:
+            hh_counts = pd.DataFrame(
+                {"hhno": trips["hhno"].to_numpy()[counted], "cell": cell_index}
+            ).value_counts()
+            squares += np.bincount(
+                hh_counts.index.get_level_values("cell"),
+                weights=hh_counts.to_numpy() ** 2,
+                minlength=len(squares),
+            )
+    return counts.reshape(shape), (
+        None if squares is None else squares.reshape(shape)
+    )
+
+
+@profiled
+def trip_length_distribution(
+    model_run_dir,
+    out_dir,
+    taz_filepath,
+    bin_width=1.0,
+    max_distance=50.0,
+    chunksize=1_000_000,
+):
+    """
+    Write the trip length frequency distribution (in bin_width miles bins up
+    to max_distance, plus a last max_distance+ bin), reading the trips in
+    chunks of chunksize rows
+    """
+    n_bins = ceil(max_distance / bin_width) + 1
+    tour_indices, home_counties = read_tour_purposes_and_home_counties(
+        model_run_dir, taz_filepath
+    )
+    counts, squares = trip_length_counts(
+        model_run_dir,
+        tour_indices,
+        len(home_counties),
+        bin_width,
+        n_bins,
+        chunksize,
+    )
+    bin_starts = np.arange(n_bins) * bin_width
+    index = pd.MultiIndex.from_product(
+        [home_counties, purposes, trip_modes, bin_starts],
+        names=["home_county", "purpose", "trip_mode", "travdist_from"],
+    )
+    tlfd = pd.DataFrame(
+        {"trips": expand(counts.ravel())}, index=index
+    ).reset_index()
+    tlfd.insert(
+        4,
+        "travdist_to",
+        (tlfd["travdist_from"] + bin_width).where(
+            tlfd["travdist_from"] < bin_starts[-1]
+        ),  # NaN: no upper bound
+    )
+    tlfd.to_csv(Path(out_dir) / out_filename, index=False)
+    if squares is not None:
+        tlfd.assign(trips=squares_se(squares.ravel())).to_csv(
+            se_filepath(Path(out_dir) / out_filename), index=False
+        )
+
+
+if __name__ == "__main__":
+    config = load_config()
+    model_run_dir = Path(config["champ"]["forecast"]["model_run_dir"])
+    taz_filepath = config["champ"]["forecast"]["taz_filepath"]
+    tlfd_config = config.get("trip_length_distribution", {})
+    out_dir = preview_out_dir(Path(config["out_dir"]))
+    run_if_stale(
+        trip_length_distribution,
+        [out_dir / out_filename],
+        [
+            daysim_filepath(model_run_dir, filename)
+            for filename in [
+                "_household_2.dat",
+                "_person_2.dat",
+                "_tour_2.dat",
+                "_trip_2.dat",
+            ]
+        ]
+        + [taz_filepath],
+        model_run_dir,
+        out_dir,
+        taz_filepath,
+        bin_width=tlfd_config.get("bin_width", 1.0),
+        max_distance=tlfd_config.get("max_distance", 50.0),
+        force=config["force"],
+    )
+    write_profile(config["out_dir"])
@@ -1,21 +1,26 @@
 from pathlib import Path
 
 import pandas as pd
-from core import load_config, read_tours_with_home_geog, read_trips
-
-# source: Daysim2.1 Users Guide.xlsx
-modes_champ = {
-    0: "none",
-    1: "walk",
-    2: "bike",
-    3: "sov",
-    4: "hov 2",
-    5: "hov 3",
-    6: "walk to transit",
-    7: "park and ride",
-    8: "school bus",
-    9: "other",
-}
+import polars as pl
+from core import (
+    daysim_filepath,
+    label_codes,
+    load_config,
+    read_tours_with_home_geog,
+    read_trips,
+)
+from incremental import run_if_stale
+from preview import (
+    expand,
+    preview_out_dir,
+    ratio_se,
+    sample_fraction,
+    se_filepath,
+    total_se,
+    with_totals,
+)
+from profiling import profiled, write_profile
+from rollup import grouping_sets
 
 modes_champ_to_mtc = {
     1: "Walk",
@@ -41,25 +46,6 @@ modes_mtc = [
     "All Modes",
 ]
 
-# source: Daysim2.1 Users Guide.xlsx
-purposes_champ = {
-    0: "none/home",
-    1: "work",
-    2: "school",
-    3: "escort",
-    4: "pers.bus",
-    5: "shop",
-    6: "meal",
-    7: "social",
-    8: "recreational",  # (currently combined with social)
-    9: "medical",  # (currently combined with pers.bus.)
-    10: "change mode inserted purpose",
-    # extra:
-    11: "work-based",
-    12: "college/university",
-    13: "other school",
-}
-
 purposes_champ_to_mtc = {
     1: "Work",
     2: "School",
@@ -87,19 +73,15 @@ purposes_mtc = [
 
 purposes_mtc_with_total = purposes_mtc + ["Total"]
 
-# source: Daysim2.1 Users Guide.xlsx
-person_type = {
-    1: "Full time worker",
-    2: "Part time worker",
-    3: 'Non working adult age 6"5+',
-    4: "Non working adult age<65",
-    5: "University student",
-    6: "High school student age 16+",
-    7: "Child age 5-15",
-    8: "Child age 0-4",
+out_filenames = {
+    "tripfreq_county": "G-ForecastActivityPattern-tripfreq_county.csv",
+    "tripfreq_superdst": "G-ForecastActivityPattern-tripfreq_superdst.csv",
+    "triplen": "H-ForecastActivityLocation-triplen.csv",
+    "mode_choice": "I-ForecastModeChoice-2050.csv",
 }
 
 
+@profiled
 def parse_tours(tours):
     parents = tours.loc[tours["subtrs"] > 0]
     parents.set_index(["hhno", "pno", "tour"], inplace=True)
@@ -137,11 +119,23 @@ def calc_trips_and_dist_by_purp(trips, geog=None):
 
 def trip_freq_pivot(trips_by_purpose, geog):
     assert geog in {"home_county", "home_superdst"}
-    return trips_by_purpose.pivot(
-        index=geog, columns="purpose", values="trips"
-    )[purposes_mtc]
+    return expand(
+        trips_by_purpose.pivot(index=geog, columns="purpose", values="trips")[
+            purposes_mtc
+        ]
+    )
+
+
+def trip_freq_se(trips, geog):
+    """standard errors of trip_freq_pivot() (preview mode)"""
+    return (
+        total_se(trips, [geog, "purpose"])
+        .unstack("purpose")
+        .reindex(columns=purposes_mtc)
+    )
 
 
+@profiled
 def calculate_trip_freq(trips, out_dir):
     # trips_by_purpose_bayarea = calc_trips_and_dist_by_purp(trips)
     trips_by_purpose_county = calc_trips_and_dist_by_purp(trips, "home_county")
@@ -150,17 +144,20 @@ def calculate_trip_freq(trips, out_dir):
     )
 
     tripfreq_county = trip_freq_pivot(trips_by_purpose_county, "home_county")
-    tripfreq_county.to_csv(
-        out_dir / "G-ForecastActivityPattern-tripfreq_county.csv"
-    )
+    tripfreq_county.to_csv(out_dir / out_filenames["tripfreq_county"])
     tripfreq_superdst = trip_freq_pivot(
         trips_by_purpose_superdst, "home_superdst"
     )
-    tripfreq_superdst.to_csv(
-        out_dir / "G-ForecastActivityPattern-tripfreq_superdst.csv"
-    )
+    tripfreq_superdst.to_csv(out_dir / out_filenames["tripfreq_superdst"])
+    if sample_fraction() is not None:
+        for geog, filename in [
+            ("home_county", out_filenames["tripfreq_county"]),
+            ("home_superdst", out_filenames["tripfreq_superdst"]),
+        ]:
+            trip_freq_se(trips, geog).to_csv(se_filepath(out_dir / filename))
 
 
+@profiled
 def calculate_trip_len(trips, out_dir):
     triplen = (
         trips.groupby("purpose")
@@ -169,17 +166,62 @@ def calculate_trip_len(trips, out_dir):
         .reindex(purposes_mtc)
     )
     triplen.loc["All Purposes", "avg_trip_dist"] = trips["travdist"].mean()
-    triplen.to_csv(out_dir / "H-ForecastActivityLocation-triplen.csv")
+    triplen.to_csv(out_dir / out_filenames["triplen"])
+    if sample_fraction() is not None:
+        ratio_se(
+            with_totals(
+                trips[["hhno", "purpose", "travdist"]],
+                [{"purpose": "All Purposes"}],
+            ),
+            ["purpose"],
+            ["travdist"],
+        ).rename(columns={"travdist": "avg_trip_dist"}).reindex(
+            triplen.index
+        ).to_csv(
+            se_filepath(out_dir / out_filenames["triplen"])
+        )
 
 
+@profiled
 def calculate_mode_choice(trips, out_dir):
-    tripmc = trips.pivot_table(
-        index=["home_county", "purpose"],
-        columns=["trip_mode"],
-        aggfunc="size",
-        fill_value=0,
+    trip_counts = (
+        trips.groupby(["home_county", "purpose", "trip_mode"], observed=True)
+        .size()
+        .rename("trips")
+        .reset_index()
+    )
+    home_counties = [
+        str(county) for county in sorted(trip_counts["home_county"].unique())
+    ] + ["Bay Area"]
+    # by county & purpose, county totals (all purposes) and the Bay Area
+    # total, each by mode and for all modes
+    tripmc = (
+        grouping_sets(
+            pl.from_pandas(trip_counts),
+            ["home_county", "purpose", "trip_mode"],
+            [
+                ["home_county", "purpose", "trip_mode"],
+                ["home_county", "purpose"],
+                ["home_county", "trip_mode"],
+                ["home_county"],
+                ["trip_mode"],
+                [],
+            ],
+            ["trips"],
+            labels={
+                "home_county": "Bay Area",
+                "purpose": "Total",
+                "trip_mode": "All Modes",
+            },
+        )
+        .to_pandas()
+        .pivot(
+            index=["home_county", "purpose"],
+            columns="trip_mode",
+            values="trips",
+        )
+        .fillna(0)
     )
-    tripmc["All Modes"] = tripmc.sum(axis=1)
     tripmc["All Auto"] = (
         tripmc["Drive Alone"]
         + tripmc["Shared Ride 2"]
@@ -187,29 +229,60 @@ def calculate_mode_choice(trips, out_dir):
         + tripmc["Taxi & Ride-Hailing"]
     )
 
-    tripmc_countytotals = tripmc.groupby("home_county").sum()
-    tripmc_countytotals["purpose"] = "Total"
-    tripmc_countytotals.set_index(
-        [tripmc_countytotals.index, "purpose"], inplace=True
-    )
-    tripmode_bayarea = tripmc_countytotals.sum()
-    tripmode_bayarea["home_county"] = "Bay Area"
-    tripmode_bayarea["purpose"] = "Total"
-    tripmode_bayarea = tripmode_bayarea.to_frame().T.set_index(
-        ["home_county", "purpose"]
-    )
-
-    tripmc = pd.concat((tripmc, tripmc_countytotals, tripmode_bayarea))
     tripmc = tripmc.div(tripmc["All Modes"], axis=0)
     tripmc = tripmc.reindex(
         pd.MultiIndex.from_product(
-            [tripmc.index.levels[0], purposes_mtc_with_total],
+            [home_counties, purposes_mtc_with_total],
             names=tripmc.index.names,
         )
     )[modes_mtc]
-    tripmc.to_csv(out_dir / "I-ForecastModeChoice-2050.csv")
+    tripmc.to_csv(out_dir / out_filenames["mode_choice"])
+    if sample_fraction() is not None:
+        mode_choice_se(trips).reindex(tripmc.index)[modes_mtc].to_csv(
+            se_filepath(out_dir / out_filenames["mode_choice"])
+        )
+
+
+def mode_choice_se(trips):
+    """
+    standard errors of the mode shares of calculate_mode_choice() (preview
+    mode), indexed by home_county (as strings) and purpose
+    """
+    trips = trips.loc[
+        trips["trip_mode"].notna() & trips["purpose"].notna(),
+        ["hhno", "home_county", "purpose", "trip_mode"],
+    ]
+    # mode indicators (all the modes_mtc categories)
+    modes = pd.get_dummies(trips["trip_mode"], dtype=int)
+    modes["All Auto"] = (
+        modes["Drive Alone"]
+        + modes["Shared Ride 2"]
+        + modes["Shared Ride 3+"]
+        + modes["Taxi & Ride-Hailing"]
+    )
+    modes["All Modes"] = 1
+    trips = pd.concat(
+        (
+            trips[["hhno", "purpose"]],
+            trips["home_county"].astype(str),
+            modes[modes_mtc],
+        ),
+        axis=1,
+    )
+    return ratio_se(
+        with_totals(
+            trips,
+            [
+                {"purpose": "Total"},
+                {"home_county": "Bay Area", "purpose": "Total"},
+            ],
+        ),
+        ["home_county", "purpose"],
+        modes_mtc,
+    )
 
 
+@profiled
 def trips_stats(model_run_dir, out_dir, taz_filepath):
     pers_cols = ["hhno", "pno", "pptyp"]
     tour_cols = [
@@ -247,8 +320,12 @@ def trips_stats(model_run_dir, out_dir, taz_filepath):
     )
     trips = read_trips(model_run_dir, usecols=trip_cols)
     trips = pd.merge(tours, trips, on=["hhno", "pno", "tour"])
-    trips["trip_mode"] = trips["mode"].map(modes_champ_to_mtc)
-    trips["purpose"] = trips["pdpurp"].map(purposes_champ_to_mtc)
+    trips["trip_mode"] = label_codes(
+        trips["mode"], modes_champ_to_mtc, categories=modes_mtc
+    )
+    trips["purpose"] = label_codes(
+        trips["pdpurp"], purposes_champ_to_mtc, categories=purposes_mtc
+    )
 
     calculate_trip_freq(trips, out_dir)
     calculate_trip_len(trips, out_dir)
@@ -257,8 +334,25 @@ def trips_stats(model_run_dir, out_dir, taz_filepath):
 
 if __name__ == "__main__":
     config = load_config()
-    trips_stats(
-        Path(config["champ"]["forecast"]["model_run_dir"]),
-        Path(config["out_dir"]),
-        config["champ"]["forecast"]["taz_filepath"],
+    model_run_dir = Path(config["champ"]["forecast"]["model_run_dir"])
+    out_dir = preview_out_dir(Path(config["out_dir"]))
+    taz_filepath = config["champ"]["forecast"]["taz_filepath"]
+    run_if_stale(
+        trips_stats,
+        [out_dir / filename for filename in out_filenames.values()],
+        [
+            daysim_filepath(model_run_dir, filename)
+            for filename in [
+                "_household_2.dat",
+                "_person_2.dat",
+                "_tour_2.dat",
+                "_trip_2.dat",
+            ]
+        ]
+        + [taz_filepath],
+        model_run_dir,
+        out_dir,
+        taz_filepath,
+        force=config["force"],
     )
+    write_profile(config["out_dir"])
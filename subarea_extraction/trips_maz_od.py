@@ -0,0 +1,607 @@
+"""
+Redistribute the vehicle-trips of a Cube/CHAMP subarea extraction from TAZs to
+MAZs (Daysim parcels), using the Daysim trip list.
+
+Since this script redistributes vehicle counts from the subarea extraction, it
+ignores walk, bike, transit, and school bus trips (from the Daysim trips list)
+
+Note that there are slight discrepancies in the number of trips between the
+Daysim trips list and Cube/CHAMP trip list.
+
+Usage: python trips_maz_od.py valencia.toml
+with the config file in champ-postprocess/subarea_extraction/configs/
+Any number of subareas (each defined by a list of TAZs or by a polygon) can be
+configured; the Daysim trip list is only scanned once for all of them.
+"""
+
+import argparse
+import tomllib
+from pathlib import Path
+
+import geopandas as gpd
+import polars as pl
+from profiling import profiled, write_profile
+
+time_periods = ["EA", "AM", "MD", "PM", "EV"]
+
+# only look at vehicle trips because
+# the subarea extraction only outputs vehicle trips
+# (so walk, bike, transit, and school_bus trips are dropped)
+vehicle_modes_daysim = {3: "sov", 4: "hov2", 5: "hov3+", 9: "tnc"}
+
+maz_od_columns = [
+    "omaz",
+    "dmaz",
+    "otaz",
+    "dtaz",
+    "DA",
+    "SR2",
+    "SR3",
+    "TNC",
+    "TRK",
+    "COM",
+]
+
+
+def deptm_to_time_period(deptm=pl.col("deptm")):
+    """CHAMP time period (deptm is in minutes since midnight)"""
+    return (
+        pl.when(deptm < 180)
+        .then(pl.lit("EV"))  # 0000-0300
+        .when(deptm < 360)
+        .then(pl.lit("EA"))  # 0300-0600
+        .when(deptm < 540)
+        .then(pl.lit("AM"))  # 0600-0900
+        .when(deptm < 930)
+        .then(pl.lit("MD"))  # 0900-1530
+        .when(deptm < 1110)
+        .then(pl.lit("PM"))  # 1530-1830
+        .otherwise(pl.lit("EV"))  # 1830-2400
+        .cast(pl.Enum(time_periods))
+    )
+
+
+def load_config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "config_filename",
+        help=(
+            "config filename in "
+            "champ-postprocess/subarea_extraction/configs/"
+        ),
+    )
+    args = parser.parse_args()
+    with open(
+        Path(__file__).parent.resolve() / "configs" / args.config_filename,
+        "rb",
+    ) as f:
+        return tomllib.load(f)
+
+
+def subarea_tazs_from_polygon(
+    polygon_filepath, taz_gis_filepath, taz_gis_id_col="TAZ"
+):
+    """TAZs whose representative point is within the subarea polygon(s)"""
+    polygon = gpd.read_file(polygon_filepath)
+    taz = gpd.read_file(taz_gis_filepath, columns=[taz_gis_id_col])
+    taz = taz.set_geometry(taz.representative_point()).to_crs(polygon.crs)
+    return sorted(
+        gpd.sjoin(taz, polygon[["geometry"]], predicate="within")[
+            taz_gis_id_col
+        ]
+        .unique()
+        .tolist()
+    )
+
+
+@profiled
+def read_subarea_tazs(config):
+    """
+    {subarea name: list of TAZs} for the subareas in the config, each defined
+    by either a list of TAZs (tazs) or a polygon file (polygon_filepath)
+    """
+    subarea_tazs = {}
+    for name, subarea in config["subareas"].items():
+        if "tazs" in subarea:
+            subarea_tazs[name] = subarea["tazs"]
+        elif "polygon_filepath" in subarea:
+            subarea_tazs[name] = subarea_tazs_from_polygon(
+                subarea["polygon_filepath"],
+                config["taz_gis_filepath"],
+                config.get("taz_gis_id_col", "TAZ"),
+            )
+        else:
+            raise ValueError(
+                f"subarea {name} should have either tazs or polygon_filepath."
+            )
+    return subarea_tazs
+
+
+@profiled
+def read_daysim_vehicle_trips(
+    daysim_trips_filepath, subarea_tazs, time_periods=time_periods
+):
+    """
+    Daysim vehicle-trips to/from each subarea, tagged with their CHAMP time
+    period, from a single scan of the Daysim trip list
+
+    subarea_tazs: {subarea name: list of TAZs}
+    Trips to/from several (overlapping) subareas are repeated once for each
+    subarea (in the subarea column).
+    """
+    subarea_membership = pl.concat_list(
+        pl.when(pl.col("otaz").is_in(tazs) | pl.col("dtaz").is_in(tazs)).then(
+            pl.lit(name)
+        )
+        for name, tazs in subarea_tazs.items()
+    ).list.drop_nulls()
+    return (
+        pl.scan_csv(daysim_trips_filepath, separator="\t")
+        .filter(pl.col("mode").is_in(list(vehicle_modes_daysim)))
+        .select(
+            "opcl",
+            "dpcl",
+            "otaz",
+            "dtaz",
+            pl.col("mode").replace_strict(
+                vehicle_modes_daysim, return_dtype=pl.String
+            ),
+            deptm_to_time_period().alias("time_period"),
+            subarea_membership.alias("subarea"),
+        )
+        .filter(
+            pl.col("time_period").is_in(time_periods)
+            & (pl.col("subarea").list.len() > 0)
+        )
+        .explode("subarea")
+        .with_columns(pl.col("subarea").cast(pl.Enum(list(subarea_tazs))))
+        .collect()
+    )
+
+
+@profiled
+def read_subarea_extraction_od(subarea_extraction_od_filepath):
+    return pl.read_csv(subarea_extraction_od_filepath)
+
+
+@profiled
+def calculate_maz_od(daysim_trips, subarea_extraction_od, subarea_tazs):
+    """
+    daysim_trips: Daysim vehicle-trips for one time period
+    subarea_extraction_od: subarea extraction OD for the same time period
+    """
+    return pl.concat(
+        (
+            calculate_maz_internal_od(
+                daysim_trips, subarea_extraction_od, subarea_tazs
+            ),
+            calculate_maz_external_od(
+                daysim_trips, subarea_extraction_od, subarea_tazs
+            ),
+            calculate_external_to_external_od(subarea_extraction_od),
+        ),
+        how="diagonal",
+    ).select(maz_od_columns)
+
+
+def calculate_external_to_external_od(subarea_extraction_od):
+    # external station IDs were set to be <0
+    external_to_external = (pl.col("otaz") < 0) & (pl.col("dtaz") < 0)
+    return subarea_extraction_od.filter(external_to_external).select(
+        pl.col("otaz").alias("omaz"),
+        pl.col("dtaz").alias("dmaz"),
+        pl.col("DA").fill_null(0),
+        pl.col("SR2").fill_null(0),
+        pl.col("SR3").fill_null(0),
+        # TNC: TNC vehicle-trips
+        (pl.col("TNC1") + pl.col("TNC2") + pl.col("TNC3"))
+        .fill_null(0)
+        .alias("TNC"),
+        pl.col("TRK").fill_null(0),
+        pl.col("COM").fill_null(0),
+    )
+
+
+def calculate_maz_external_od(
+    daysim_trips, subarea_extraction_od, subarea_tazs
+):
+    origin_in_subarea = pl.col("otaz").is_in(subarea_tazs)
+    destination_in_subarea = pl.col("dtaz").is_in(subarea_tazs)
+    exit_subarea = origin_in_subarea & ~destination_in_subarea
+    enter_subarea = ~origin_in_subarea & destination_in_subarea
+    daysim_exit_trips = daysim_trips.filter(exit_subarea)
+    daysim_enter_trips = daysim_trips.filter(enter_subarea)
+    subarea_extraction_exit_od = subarea_extraction_od.filter(exit_subarea)
+    subarea_extraction_enter_od = subarea_extraction_od.filter(enter_subarea)
+    return pl.concat(
+        (
+            _calculate_maz_external_od(
+                daysim_exit_trips, subarea_extraction_exit_od, "o", "d"
+            ),
+            _calculate_maz_external_od(
+                daysim_enter_trips, subarea_extraction_enter_od, "d", "o"
+            ),
+        ),
+        how="diagonal",
+    )
+
+
+def calculate_maz_internal_od(
+    daysim_trips, subarea_extraction_od, subarea_tazs
+):
+    internal = pl.col("otaz").is_in(subarea_tazs) & pl.col("dtaz").is_in(
+        subarea_tazs
+    )
+    daysim_internal_trips = daysim_trips.filter(internal)
+    subarea_extraction_internal_od = subarea_extraction_od.filter(internal)
+    return _calculate_maz_internal_od(
+        daysim_internal_trips, subarea_extraction_internal_od
+    )
+
+
+def _count_daysim_trips_by_mode(daysim_trips, index):
+    """
+    number of Daysim person-trips by vehicle mode for each index group, plus
+    the total of all auto person-trips (sov, hov2/3+, tnc), which is used to
+    estimate TRK and COM trips to/from each MAZ later
+    """
+    modes = list(vehicle_modes_daysim.values())
+    return (
+        daysim_trips.group_by(index)
+        .agg((pl.col("mode") == m).sum().alias(m) for m in modes)
+        .with_columns(pl.sum_horizontal(modes).alias("auto_tot"))
+    )
+
+
+def _calculate_maz_external_od(
+    daysim_external_trips, subarea_extraction_external_od, internal, external
+):
+    """
+    this is for calculating just trips entering or exiting the subarea
+    internal: "o" or "d"
+    external: "o" or "d"
+    we take the subarea extraction ("_taz") volumes as canonical,
+    and adjust them based on the Daysim ("_daysim_maz") volumes
+    Note that the Cube results include visitor trips (which Daysim
+    (residential trips only) doesn't) which we ignore in these calculations
+    """
+    if internal not in {"o", "d"}:
+        raise ValueError(
+            'internal should be either "o" (for trips exiting the subarea) or '
+            '"d" (for trips entering the subarea).'
+        )
+    if external not in {"o", "d"}:
+        raise ValueError(
+            'internal should be either "o" (for trips entering the subarea) or'
+            ' "d" (for trips exiting the subarea).'
+        )
+    if internal == external:
+        raise ValueError('internal and external cannot both be "o" or "d".')
+
+    # sum up all auto person-trips (sov, hov2/3+, tnc) at the MAZ and TAZ level
+    # to estimate TRK and COM trips to/from each MAZ later
+    daysim_external_trips = _count_daysim_trips_by_mode(
+        daysim_external_trips, [f"{internal}pcl", f"{internal}taz"]
+    )
+    daysim_external_trips_taz_tot = (
+        daysim_external_trips.group_by(f"{internal}taz")
+        .sum()
+        .drop(f"{internal}pcl")
+        .select(pl.all().name.suffix("_daysim_taz_tot"))
+    )
+
+    external_veh_trips = (
+        daysim_external_trips.select(pl.all().name.suffix("_daysim_maz"))
+        .join(
+            # get all combos of internal MAZ x external stations, by joining
+            # on the internal o/dtaz (rather than a cross-join then filter, so
+            # the intermediate only grows with the number of matching rows)
+            subarea_extraction_external_od.select(
+                "otaz",
+                "dtaz",
+                # convert residential vehicle-trips to person-trips
+                pl.col("DA").alias("sov"),
+                (pl.col("SR2") * 2).alias("hov2"),
+                (pl.col("SR3") * 3.5).alias("hov3+"),
+                # tnc: tnc person-trips: only for calculating  auto_tot later
+                (
+                    pl.col("TNC1") + pl.col("TNC2") * 2 + pl.col("TNC3") * 3
+                ).alias("tnc"),
+                # TNC: TNC vehicle-trips: since we ultimatly want vehicle-trips
+                (pl.col("TNC1") + pl.col("TNC2") + pl.col("TNC3")).alias(
+                    "TNC"
+                ),
+                # keep truck/commercial vehicle-trips as is
+                "TRK",
+                "COM",
+            ).select(pl.all().name.suffix("_taz")),
+            left_on=f"{internal}taz_daysim_maz",
+            right_on=f"{internal}taz_taz",
+            # NOTE The whole row (from the subarea extraction) would be lost if
+            # there's no trips to/from that TAZ in the Daysim trip list.
+        )
+        .join(
+            daysim_external_trips_taz_tot,
+            left_on=f"{internal}taz_daysim_maz",
+            right_on=f"{internal}taz_daysim_taz_tot",
+        )
+        .select(
+            pl.col(f"{internal}pcl_daysim_maz").alias(f"{internal}maz"),
+            pl.col(f"{internal}taz_daysim_maz").alias(f"{internal}taz"),
+            pl.col(f"{external}taz_taz").alias(
+                f"{external}maz"
+            ),  # treating external stations as a "maz"
+            # Estimate the number of person- (sov, hov2/3+, tnc) or vehicle-
+            # (TRK, COM) trips from each origin to each external node then
+            # convert from person- to vehicle-trips.
+            # NOTE Some trips present in the subarea extraction results may be
+            # lost if there are no trips to/from that TAZ in that vehicle
+            # subtype in daysim, since xxx_daysim_taz_tot and xxx_daysim_maz
+            # would both be 0 (hence the fill_nan(0) for 0/0).
+            (
+                pl.col("sov_taz")
+                * pl.col("sov_daysim_maz")
+                / pl.col("sov_daysim_taz_tot")
+            )
+            .fill_nan(0)
+            .fill_null(0)
+            .alias("DA"),
+            (
+                pl.col("hov2_taz")
+                * pl.col("hov2_daysim_maz")
+                / pl.col("hov2_daysim_taz_tot")
+                / 2
+            )
+            .fill_nan(0)
+            .fill_null(0)
+            .alias("SR2"),
+            (
+                pl.col("hov3+_taz")
+                * pl.col("hov3+_daysim_maz")
+                / pl.col("hov3+_daysim_taz_tot")
+                / 3.5
+            )
+            .fill_nan(0)
+            .fill_null(0)
+            .alias("SR3"),
+            (
+                pl.col("TNC_taz")
+                * pl.col("tnc_daysim_maz")
+                / pl.col("tnc_daysim_taz_tot")
+            )
+            .fill_nan(0)
+            .fill_null(0)
+            .alias("TNC"),
+            # ASSUMPTION: distribute TRK/COM trips to MAZs based on residential
+            # trips this may bias TRK/COM trips away from commercial corridors
+            # to residential areas
+            # FUTURE TODO MAYBE: using maz-level employment to distribute trips
+            # from TAZ to MAZ-level, as employment is a big driver of COM and
+            # TRK trips
+            (
+                pl.col("TRK_taz")
+                * pl.col("auto_tot_daysim_maz")
+                / pl.col("auto_tot_daysim_taz_tot")
+            )
+            .fill_nan(0)
+            .fill_null(0)
+            .alias("TRK"),
+            (
+                pl.col("COM_taz")
+                * pl.col("auto_tot_daysim_maz")
+                / pl.col("auto_tot_daysim_taz_tot")
+            )
+            .fill_nan(0)
+            .fill_null(0)
+            .alias("COM"),
+        )
+    )
+    return external_veh_trips
+
+
+def _calculate_maz_internal_od(
+    daysim_internal_trips, subarea_extraction_internal_od
+):
+    """
+    this is for calculating just trips internal to the subarea
+    we take the subarea extraction ("_taz") volumes as canonical,
+    and adjust them based on the Daysim ("_daysim_maz") volumes
+
+    Note that the Cube results include visitor trips (which Daysim (residential
+    trips only) doesn't) which we ignore in these calculations
+    """
+    # sum up all auto person-trips (sov, hov2/3+, tnc) at the MAZ and TAZ level
+    # to estimate TRK and COM trips to/from each MAZ later
+    daysim_internal_trips = _count_daysim_trips_by_mode(
+        daysim_internal_trips, ["opcl", "otaz", "dpcl", "dtaz"]
+    )
+
+    daysim_internal_trips_taz_tot = (
+        daysim_internal_trips.group_by("otaz", "dtaz")
+        .sum()
+        .drop("opcl", "dpcl")
+        .select(pl.all().name.suffix("_daysim_taz_tot"))
+    )
+
+    # tnc & TNC calculations
+    subarea_extraction_internal_od = subarea_extraction_internal_od.with_columns(
+        (pl.col("TNC1")).alias("tnc1"),
+        (pl.col("TNC2") * 2).alias("tnc2"),
+        (pl.col("TNC3") * 3).alias("tnc3"),
+    ).with_columns(
+        # tnc: tnc person-trips: also for calculating auto_tot later
+        (pl.col("tnc1") + pl.col("tnc2") + pl.col("tnc3")).alias("tnc")
+        # # TNC: TNC vehicle-trips: since we ultimatly want vehicle-trips
+        # (pl.col("TNC1") + pl.col("TNC2") + pl.col("TNC3")).alias("TNC"),
+    )
+
+    # for Daysim MAZ-pairs within TAZ-pairs that don't have any Cube/CHAMP
+    # trips, estimate the TNC vehicle-trips from Daysim person-trips using the
+    # conversion factor for tnc person-trips to TNC vehicle-trips for the whole
+    # subarea
+    subarea_tnc_to_TNC = (
+        subarea_extraction_internal_od.select("tnc1", "tnc2", "tnc3", "tnc")
+        .sum()
+        .select(
+            # calculate fractions of tnc1/2/3 person-trips out of all tnc
+            # person-trips within the whole subarea
+            (pl.col("tnc1") / pl.col("tnc")).alias("subarea_tnc1_fraction"),
+            (pl.col("tnc2") / pl.col("tnc")).alias("subarea_tnc2_fraction"),
+            (pl.col("tnc3") / pl.col("tnc")).alias("subarea_tnc3_fraction"),
+        )
+        .select(
+            (
+                pl.col("subarea_tnc1_fraction")
+                + pl.col("subarea_tnc2_fraction") / 2
+                + pl.col("subarea_tnc3_fraction") / 3
+            ).alias("subarea_tnc_to_TNC")
+        )
+        .item()
+    )
+    internal_veh_trips = (
+        daysim_internal_trips.select(pl.all().name.suffix("_daysim_maz"))
+        .join(
+            # get all combos of internal MAZ x internal TAZ, by joining on the
+            # o/dtaz pair (rather than a cross-join then filter)
+            subarea_extraction_internal_od.select(
+                "otaz",
+                "dtaz",
+                # # convert residential vehicle-trips to person-trips
+                # For internal sov/hov2/hov3+ (DA/SR2/SR3) trips,
+                # use Daysim trip numbers directly
+                "tnc1",
+                "tnc2",
+                "tnc3",
+                "tnc",
+                # keep truck/commercial vehicle-trips as is
+                "TRK",
+                "COM",
+            ).select(pl.all().name.suffix("_taz")),
+            # NOTE The whole row (from the subarea extraction) would be lost if
+            # there's no trips to/from that TAZ in the Daysim trip list.
+            left_on=["otaz_daysim_maz", "dtaz_daysim_maz"],
+            right_on=["otaz_taz", "dtaz_taz"],
+        )
+        .join(
+            daysim_internal_trips_taz_tot,
+            left_on=["otaz_daysim_maz", "dtaz_daysim_maz"],
+            right_on=["otaz_daysim_taz_tot", "dtaz_daysim_taz_tot"],
+        )
+        .select(
+            pl.col("opcl_daysim_maz").alias("omaz"),
+            pl.col("dpcl_daysim_maz").alias("dmaz"),
+            pl.col("otaz_daysim_maz").alias("otaz"),
+            pl.col("dtaz_daysim_maz").alias("dtaz"),
+            # Estimate the number of person- (sov, hov2/3+, tnc) or vehicle-
+            # (TRK, COM) trips from each origin to each external node then
+            # convert from person- to vehicle-trips.
+            # For internal sov/hov2/hov3+ trips, just use the Daysim trips OD
+            # numbers directly, even though there's slight discrepancies
+            # between Daysim and final Cube/CHAMP numbers.
+            (pl.col("sov_daysim_maz"))
+            .fill_null(0)
+            .cast(float)
+            .alias("DA"),  # cast(float) for pl.concat later
+            (pl.col("hov2_daysim_maz") / 2).fill_null(0).alias("SR2"),
+            (pl.col("hov3+_daysim_maz") / 3.5).fill_null(0).alias("SR3"),
+            # For internal tnc trips, we start from Daysim person-volumes, and
+            # estimate TNC1/2/3 based on CHAMP/Cube volumes for the TAZ OD pair
+            pl.when(pl.col("tnc_taz") > 0)
+            .then(
+                (
+                    pl.col("tnc_daysim_maz")
+                    * pl.col("tnc1_taz")
+                    / pl.col("tnc_taz")
+                )
+                + (  # estimated_tnc1_daysim_maz
+                    pl.col("tnc_daysim_maz")
+                    * pl.col("tnc2_taz")
+                    / pl.col("tnc_taz")
+                    / 2
+                )
+                + (  # estimated_tnc2_daysim_maz / 2
+                    pl.col("tnc_daysim_maz")
+                    * pl.col("tnc3_taz")
+                    / pl.col("tnc_taz")
+                    / 3
+                )  # estimated_tnc3_daysim_maz / 3
+            )
+            .otherwise(pl.col("tnc_daysim_maz") * subarea_tnc_to_TNC)
+            .fill_nan(0)
+            .fill_null(0)
+            .alias("TNC"),
+            # ASSUMPTION: distribute TRK/COM trips to MAZs based on residential
+            # trips this may bias TRK/COM trips away from commercial corridors
+            # to residential areas
+            # NOTE Some trips present in the subarea extraction results may be
+            # lost if there are no sov/hov2/hov3+/tnc trips to/from that TAZ in
+            # daysim, since auto_tot_daysim_maz and auto_tot_daysim_taz_tot
+            # would both be 0.
+            # FUTURE TODO MAYBE: using maz-level employment to distribute trips
+            # from TAZ to MAZ-level, as employment is a big driver of COM and
+            # TRK trips
+            (
+                pl.col("TRK_taz")
+                * pl.col("auto_tot_daysim_maz")
+                / pl.col("auto_tot_daysim_taz_tot")
+            )
+            .fill_nan(0)
+            .fill_null(0)
+            .alias("TRK"),
+            (
+                pl.col("COM_taz")
+                * pl.col("auto_tot_daysim_maz")
+                / pl.col("auto_tot_daysim_taz_tot")
+            )
+            .fill_nan(0)
+            .fill_null(0)
+            .alias("COM"),
+        )
+    )
+    return internal_veh_trips
+
+
+@profiled
+def trips_maz_od(config):
+    """
+    For each subarea in config["subareas"], subarea_extraction_od_filepath and
+    out_filepath should contain "{time_period}", which is replaced by each of
+    the time periods (config["time_periods"], all five by default).
+    If config["trips_out_dir"] is set, the filtered Daysim vehicle-trips are
+    also written there, partitioned by subarea and time period.
+    """
+    periods = config.get("time_periods", time_periods)
+    subarea_tazs = read_subarea_tazs(config)
+    daysim_trips = read_daysim_vehicle_trips(
+        config["daysim_trips_filepath"], subarea_tazs, periods
+    )
+    if "trips_out_dir" in config:
+        daysim_trips.write_parquet(
+            config["trips_out_dir"], partition_by=["subarea", "time_period"]
+        )
+    no_trips = daysim_trips.clear()
+    daysim_trips = daysim_trips.partition_by(
+        "subarea", "time_period", as_dict=True
+    )
+    for name, subarea in config["subareas"].items():
+        for time_period in periods:
+            calculate_maz_od(
+                daysim_trips.get((name, time_period), no_trips),
+                read_subarea_extraction_od(
+                    subarea["subarea_extraction_od_filepath"].format(
+                        time_period=time_period
+                    )
+                ),
+                subarea_tazs[name],
+            ).write_csv(
+                subarea["out_filepath"].format(time_period=time_period)
+            )
+
+
+if __name__ == "__main__":
+    config = load_config()
+    trips_maz_od(config)
+    # (next to the first subarea's outputs)
+    write_profile(
+        Path(next(iter(config["subareas"].values()))["out_filepath"]).parent
+    )
@@ -1,16 +1,32 @@
 import re
 from itertools import chain, pairwise, product, repeat
+from typing import NamedTuple
 
 import geopandas as gpd
 import networkx as nx
 import numpy as np
 import pandas as pd
+from profiling import profiled
 
 
+class NodeCoordinates(NamedTuple):
+    """X/Y of the CHAMP nodes, held in contiguous arrays
+
+    position[N] is the (dense) position of node N in x and y (-1 if N is not a
+    node), so the coordinates of many nodes can be looked up at once.
+    """
+
+    position: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+
+
+@profiled
 def read_champ_nodes(champ_nodes_gis_filepath) -> gpd.GeoDataFrame:
     return gpd.read_file(champ_nodes_gis_filepath).set_index("N")
 
 
+@profiled
 def load_champ_network(
     champ_links_gis_filepath: str, champ_nodes_gdf: gpd.GeoDataFrame
 ) -> nx.DiGraph:
@@ -152,6 +168,7 @@ def is_match_edge_name(
     return is_match_street_names(edge_name, edge_type, name, type, fuzzy=fuzzy)
 
 
+@profiled
 def find_paths_from_streetnames(
     champ_digraph: nx.DiGraph,
     primary_street_name: str,
@@ -317,62 +334,216 @@ def find_paths_from_streetnames(
         return []  # == paths_found
 
 
+@profiled
+def get_node_coordinates(champ_nodes_gdf: gpd.GeoDataFrame) -> NodeCoordinates:
+    """Copy the X/Y of each CHAMP node into contiguous arrays
+
+    Parameters
+    ----------
+    champ_nodes_gdf : gpd.GeoDataFrame
+        indexed by the node names, with X and Y columns
+        (i.e. the output of read_champ_nodes())
+
+    Returns
+    -------
+    NodeCoordinates
+        X/Y arrays plus a dense lookup from node name to array position
+    """
+    nodes = champ_nodes_gdf.index.to_numpy(dtype=np.int64)
+    if (nodes < 0).any():
+        raise ValueError("CHAMP node names should be non-negative integers.")
+    position = np.full(nodes.max() + 1, -1, dtype=np.int64)
+    position[nodes] = np.arange(len(nodes))
+    return NodeCoordinates(
+        position,
+        np.ascontiguousarray(champ_nodes_gdf["X"].to_numpy(dtype=np.float64)),
+        np.ascontiguousarray(champ_nodes_gdf["Y"].to_numpy(dtype=np.float64)),
+    )
+
+
+def _node_positions(node_coords: NodeCoordinates, nodes) -> np.ndarray:
+    """the positions of the nodes in node_coords, -1 for those not in it"""
+    nodes = np.asarray(nodes, dtype=np.int64)
+    in_range = (nodes >= 0) & (nodes < len(node_coords.position))
+    positions = np.full(nodes.shape, -1, dtype=np.int64)
+    positions[in_range] = node_coords.position[nodes[in_range]]
+    return positions
+
+
+def get_link_directions(
+    node_coords: NodeCoordinates, nodes_i, nodes_f, direction_pairs
+) -> np.ndarray:
+    """Classify the direction of many links/paths at once
+
+    Vectorized version of get_link_direction(): compares the X (for "EW") or
+    Y (for "NS") value of the initial and final node of each link/path.
+
+    Parameters
+    ----------
+    node_coords : NodeCoordinates
+        output of get_node_coordinates()
+    nodes_i : array-like of int
+        initial node of each link/path
+    nodes_f : array-like of int
+        final node of each link/path
+    direction_pairs : str | array-like of str
+        "NS" or "EW", for all or for each link/path
+
+    Returns
+    -------
+    np.ndarray
+        "NB"/"SB"/"EB"/"WB" for each link/path, or "" (unclassified) where
+        the two nodes have the same X (for "EW") or Y (for "NS") value, or
+        either node is not in node_coords
+
+    Raises
+    ------
+    ValueError
+        if a direction pair is not "NS" or "EW"
+    """
+    positions_i = _node_positions(node_coords, nodes_i)
+    positions_f = _node_positions(node_coords, nodes_f)
+    direction_pairs = np.broadcast_to(
+        np.asarray(direction_pairs), positions_i.shape
+    )
+    is_ns = direction_pairs == "NS"
+    if not (is_ns | (direction_pairs == "EW")).all():
+        raise ValueError('direction_pair should be "NS" or  "EW".')
+    delta = np.where(
+        is_ns,
+        node_coords.y[positions_f] - node_coords.y[positions_i],
+        node_coords.x[positions_f] - node_coords.x[positions_i],
+    )
+    directions = np.where(
+        is_ns,
+        np.where(delta > 0, "NB", "SB"),
+        np.where(delta > 0, "EB", "WB"),
+    )
+    directions[delta == 0] = ""  # ties
+    # (the coordinates looked up at position -1 are meaningless)
+    directions[(positions_i < 0) | (positions_f < 0)] = ""
+    return directions
+
+
 def get_link_direction(
-    champ_nodes_gdf: gpd.GeoDataFrame,
+    node_coords: NodeCoordinates,
     node_i: int,
     node_f: int,
     direction_pair: str,
-):
-    """_summary_
+) -> str:
+    """Classify the direction of a single link/path
+
+    See get_link_directions() for classifying many links/paths at once.
 
     Parameters
     ----------
-    champ_nodes_gdf : gpd.GeoDataFrame
-        indexed by the node names
-        (i.e. node_i and node_f should refer champ_nodes_gdf's index)
+    node_coords : NodeCoordinates
+        output of get_node_coordinates()
     node_i : int
-        _description_
+        initial node
     node_f : int
-        _description_
+        final node
     direction_pair : str
-        _description_
+        "NS" or "EW"
 
     Returns
     -------
-    _type_
-        _description_
+    str
+        "NB"/"SB" (for "NS") or "EB"/"WB" (for "EW")
 
     Raises
     ------
+    KeyError
+        if a node is not in node_coords
     RuntimeError
-        _description_
+        if the two nodes have the same X (for "EW") or Y (for "NS") value
     ValueError
-        _description_
+        if direction_pair is not "NS" or "EW"
     """
-    if direction_pair == "NS":
-        node_i_y = champ_nodes_gdf.loc[node_i]["Y"]
-        node_f_y = champ_nodes_gdf.loc[node_f]["Y"]
-        if node_i_y < node_f_y:
-            return "NB"
-        elif node_i_y > node_f_y:
-            return "SB"
-        else:
-            raise RuntimeError("The two nodes have the same Y value.")
-    elif direction_pair == "EW":
-        node_i_x = champ_nodes_gdf.loc[node_i]["X"]
-        node_f_x = champ_nodes_gdf.loc[node_f]["X"]
-        if node_i_x < node_f_x:
-            return "EB"
-        elif node_i_x > node_f_x:
-            return "WB"
-        else:
-            raise RuntimeError("The two nodes have the same X value.")
+    missing = [
+        node
+        for node, position in zip(
+            (node_i, node_f), _node_positions(node_coords, [node_i, node_f])
+        )
+        if position < 0
+    ]
+    if missing:
+        raise KeyError(f"Nodes not in the CHAMP nodes table: {missing}")
+    direction = get_link_directions(
+        node_coords, [node_i], [node_f], [direction_pair]
+    )[0]
+    if not direction:
+        raise RuntimeError(
+            "The two nodes have the same "
+            f"{'Y' if direction_pair == 'NS' else 'X'} value."
+        )
+    return direction
+
+
+def _direction_pair(direction: str) -> str:
+    if direction in {"NB", "SB"}:
+        return "NS"
+    elif direction in {"EB", "WB"}:
+        return "EW"
     else:
-        raise ValueError('direction_pair should be "NS" or  "EW".')
+        raise ValueError('direction should be "NB", "SB", "EB", or "WB".')
+
+
+@profiled
+def filter_paths_by_direction(
+    node_coords: NodeCoordinates, path_lists, directions
+) -> list:
+    """Get the path in each path_list that corresponds to each direction
+
+    The directions of all the candidate paths of all the path_lists are
+    classified in a single get_link_directions() call.
+
+    Parameters
+    ----------
+    node_coords : NodeCoordinates
+        output of get_node_coordinates()
+    path_lists : list
+        list of path_lists (each a list of paths, i.e. sequences of nodes,
+        e.g. the output of find_paths_from_streetnames())
+    directions : list of str
+        NB/SB/EB/WB, one for each path_list
+
+    Returns
+    -------
+    list
+        the path matching the direction for each path_list, or None if none of
+        its paths are in that direction (including ties). If several paths
+        match, the last one is returned (as in filter_by_direction()).
+    """
+    if len(path_lists) != len(directions):
+        raise ValueError(
+            "path_lists and directions should be the same length."
+        )
+    direction_pairs = [_direction_pair(d) for d in directions]
+    path_list_ids = np.repeat(
+        np.arange(len(path_lists)),
+        [len(path_list) for path_list in path_lists],
+    )
+    candidates = [path for path_list in path_lists for path in path_list]
+    if not candidates:
+        return [None] * len(path_lists)
+    candidate_directions = get_link_directions(
+        node_coords,
+        [path[0] for path in candidates],
+        [path[-1] for path in candidates],
+        np.asarray(direction_pairs)[path_list_ids],
+    )
+    matches = candidate_directions == np.asarray(directions)[path_list_ids]
+    paths = [None] * len(path_lists)
+    for path_list_id, candidate_id in zip(
+        path_list_ids[matches], np.flatnonzero(matches)
+    ):
+        paths[path_list_id] = candidates[candidate_id]
+    return paths
 
 
 def filter_by_direction(
-    champ_nodes_gdf: gpd.GeoDataFrame, path_list, direction: str
+    node_coords: NodeCoordinates, path_list, direction: str
 ):
     """Get the path in path_list that corresponds to direction
 
@@ -380,32 +551,16 @@ def filter_by_direction(
 
     Parameters
     ----------
-    champ_nodes_gdf : gpd.GeoDataFrame
-        the index should be the node name referenced in paths_list
+    node_coords : NodeCoordinates
+        output of get_node_coordinates()
     path_list : _type_
         list of paths (sequece of nodes)
     direction : str
         NB/SB/EB/WB
     """
-    if direction in {"NB", "SB"}:
-        direction_edge_dict = {
-            get_link_direction(
-                champ_nodes_gdf, edge_list[0], edge_list[-1], "NS"
-            ): edge_list
-            for edge_list in path_list
-        }
-    elif direction in {"EB", "WB"}:
-        direction_edge_dict = {
-            get_link_direction(
-                champ_nodes_gdf, edge_list[0], edge_list[-1], "EW"
-            ): edge_list
-            for edge_list in path_list
-        }
-    else:
-        raise ValueError('direction should be "NB", "SB", "EB", or "WB".')
-    try:
-        return direction_edge_dict[direction]
-    except KeyError:
+    (path,) = filter_paths_by_direction(node_coords, [path_list], [direction])
+    if path is None:
         raise RuntimeError(
             f"Direction {direction} does not exist in path_list."
         )
+    return path
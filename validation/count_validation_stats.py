@@ -0,0 +1,373 @@
+"""
+Validation statistics of CHAMP loaded network volumes against counts: joins
+the count-to-CHAMP-link comparison table (the output of
+sfmta_counts_18to20.py) to the loaded network volumes of each time period of
+one or more model runs, and computes GEH, RMSE, %RMSE and the model/count
+ratio by time period, facility type, volume group and direction, e.g.
+python count_validation_stats.py <comparison csv> <model run dir>... --out <dir>
+
+All the model runs are validated against the same counts in one pass: the
+statistics of all the runs and groupings are sums over grouped arrays (one
+groupby per grouping), from which the statistics are then derived.
+"""
+
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from profiling import profiled, write_profile
+
+time_periods = ["EA", "AM", "MD", "PM", "EV"]
+# duration (hours) of each CHAMP time period
+# (cf. sfmta_counts_18to20.bin_count_totals_by_champ_periods())
+time_period_hours = {"EA": 3, "AM": 3, "MD": 6.5, "PM": 3, "EV": 8.5}
+daily = "Daily"
+
+# loaded network columns summed as the link volume (as in the model run
+# topsheet / mtc_model_consistency/screenline.py); BUSVOL is BUSVOL_{XX}
+veh_class_volume_columns = [f"V{i}_1" for i in range(1, 19)]
+
+# count station: a count file's street segment and direction
+station_cols = [
+    "primary_st_name",
+    "primary_st_type",
+    "cross_st_1_name",
+    "cross_st_2_name",
+    "direction",
+]
+
+# hourly count volume group bins (lower bound inclusive)
+volume_group_bins = [0, 250, 500, 1000, 2000, 4000, np.inf]
+volume_group_labels = [
+    f"{lower:g}-{upper:g}" if np.isfinite(upper) else f"{lower:g}+"
+    for lower, upper in zip(volume_group_bins[:-1], volume_group_bins[1:])
+]
+
+groupings = [[], ["facility_type"], ["volume_group"], ["direction"]]
+all_label = "All"
+
+
+def loaded_network_filepath(model_run_dir, time_period: str) -> Path:
+    return Path(model_run_dir) / f"LOAD{time_period}_FINAL.csv"
+
+
+@profiled
+def read_loaded_network_volumes(model_run_dir) -> pd.DataFrame:
+    """Read the link volumes of each time period of a model run
+
+    Parameters
+    ----------
+    model_run_dir : str | Path
+        with the LOAD{XX}_FINAL.csv loaded networks
+
+    Returns
+    -------
+    pd.DataFrame
+        A, B, FT, time_period and model_volume (V1_1..V18_1 + BUSVOL_{XX})
+        of every link and time period
+    """
+    volumes = []
+    for time_period in time_periods:
+        bus_volume_column = f"BUSVOL_{time_period}"
+        df = pd.read_csv(
+            loaded_network_filepath(model_run_dir, time_period),
+            # (strings quoted with ', as in link_store.read_loaded_network)
+            sep=",",
+            quotechar="'",
+            usecols=["A", "B", "FT"]
+            + veh_class_volume_columns
+            + [bus_volume_column],
+        )
+        volumes.append(
+            pd.DataFrame(
+                {
+                    "A": df["A"],
+                    "B": df["B"],
+                    "FT": df["FT"],
+                    "time_period": time_period,
+                    "model_volume": df[
+                        veh_class_volume_columns + [bus_volume_column]
+                    ].sum(axis=1),
+                }
+            )
+        )
+    return pd.concat(volumes, ignore_index=True)
+
+
+def count_stations(comparison_df: pd.DataFrame) -> pd.DataFrame:
+    """Number the count stations of the comparison table
+
+    Parameters
+    ----------
+    comparison_df : pd.DataFrame
+        output of compare_sfmta_counts_to_champ_network(), i.e. one row per
+        CHAMP link (CHAMP_A, CHAMP_B) of each count station, with the
+        station's counts (EA..EV)
+
+    Returns
+    -------
+    pd.DataFrame
+        comparison_df with a station (id) column
+    """
+    return comparison_df.assign(
+        station=comparison_df.groupby(
+            station_cols, sort=False, dropna=False
+        ).ngroup()
+    )
+
+
+@profiled
+def join_model_volumes(
+    comparison_df: pd.DataFrame, model_run_volumes: dict
+) -> pd.DataFrame:
+    """Join the counts to the model volumes of each model run
+
+    A count station spanning several CHAMP links is compared to the mean
+    volume of its links (the links of a street segment between two
+    intersections), with the facility type of its first link.
+
+    Parameters
+    ----------
+    comparison_df : pd.DataFrame
+        output of count_stations()
+    model_run_volumes : dict
+        {model run name: output of read_loaded_network_volumes()}
+
+    Returns
+    -------
+    pd.DataFrame
+        one row per model run, station and time period (plus Daily, the sum
+        of the time periods, for the stations counted in all of them), with
+        the station_cols, facility_type, time_period, count and
+        model_volume; stations whose links aren't all in a model run's
+        loaded network are left out (of that run)
+    """
+    counts = comparison_df.melt(
+        id_vars=["station", "CHAMP_A", "CHAMP_B"] + station_cols,
+        value_vars=time_periods,
+        var_name="time_period",
+        value_name="count",
+    )
+    comparisons = []
+    for model_run, volumes in model_run_volumes.items():
+        df = counts.merge(
+            volumes.rename(columns={"A": "CHAMP_A", "B": "CHAMP_B"}),
+            on=["CHAMP_A", "CHAMP_B", "time_period"],
+            how="left",
+        )
+        complete = ~(
+            df["model_volume"].isna().groupby(df["station"]).transform("any")
+        )
+        df = (
+            df[complete]
+            .groupby(["station", "time_period"], sort=False)
+            .agg(
+                {
+                    **{col: "first" for col in station_cols},
+                    "FT": "first",
+                    "count": "first",
+                    "model_volume": "mean",
+                }
+            )
+            .reset_index()
+        )
+        df = df[df["count"].notna()]
+        counted_periods = df.groupby("station")["time_period"].transform(
+            "size"
+        )
+        daily_df = (
+            df[counted_periods == len(time_periods)]
+            .groupby("station", sort=False)
+            .agg(
+                {
+                    **{col: "first" for col in station_cols + ["FT"]},
+                    "count": "sum",
+                    "model_volume": "sum",
+                }
+            )
+            .reset_index()
+            .assign(time_period=daily)
+        )
+        comparisons.append(
+            pd.concat([df, daily_df], ignore_index=True).assign(
+                model_run=model_run
+            )
+        )
+    comparison = pd.concat(comparisons, ignore_index=True).rename(
+        columns={"FT": "facility_type"}
+    )
+    # (in the order of the model runs and time periods)
+    comparison["model_run"] = pd.Categorical(
+        comparison["model_run"], categories=list(model_run_volumes)
+    )
+    comparison["time_period"] = pd.Categorical(
+        comparison["time_period"], categories=time_periods + [daily]
+    )
+    # (float after the join to the missing links)
+    comparison["facility_type"] = comparison["facility_type"].astype("int64")
+    return comparison[
+        ["model_run", "station"]
+        + station_cols
+        + ["facility_type", "time_period", "count", "model_volume"]
+    ]
+
+
+def hourly(volumes: pd.Series, time_period: pd.Series) -> np.ndarray:
+    """Convert volumes of each time_period (or Daily) to hourly volumes"""
+    hours = pd.Series(time_period_hours | {daily: 24})
+    return volumes.to_numpy() / hours[time_period.astype(str)].to_numpy()
+
+
+def geh(model_volume, count) -> np.ndarray:
+    """GEH statistic of (hourly) volumes: sqrt(2 (M - C)^2 / (M + C))"""
+    model_volume = np.asarray(model_volume, dtype=np.float64)
+    count = np.asarray(count, dtype=np.float64)
+    total = model_volume + count
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(
+            total > 0,
+            np.sqrt(2 * (model_volume - count) ** 2 / total),
+            0.0,
+        )
+
+
+@profiled
+def validation_stats(comparison: pd.DataFrame) -> pd.DataFrame:
+    """Compute the validation statistics of every model run
+
+    For each model run and time period (and Daily), by each of groupings
+    (all stations, facility type, volume group, direction), from the sums
+    over the stations of each group:
+    - stations: number of count stations
+    - count, model_volume: total count and model volume
+    - ratio: model_volume / count
+    - RMSE: root mean squared error (model - count) of the station volumes
+    - %RMSE: RMSE / mean count * 100
+    - mean_GEH: mean GEH of the hourly station volumes
+    - %GEH<5: percentage of the stations with a GEH (hourly) under 5
+    The volume group of a station is by its hourly count (volume_group_bins).
+
+    Parameters
+    ----------
+    comparison : pd.DataFrame
+        output of join_model_volumes()
+
+    Returns
+    -------
+    pd.DataFrame
+        indexed by model_run, time_period, grouping (All, facility_type,
+        volume_group or direction) and group
+    """
+    hourly_count = hourly(comparison["count"], comparison["time_period"])
+    station_geh = geh(
+        hourly(comparison["model_volume"], comparison["time_period"]),
+        hourly_count,
+    )
+    error = comparison["model_volume"] - comparison["count"]
+    stats_inputs = pd.DataFrame(
+        {
+            "model_run": comparison["model_run"],
+            "time_period": comparison["time_period"],
+            "facility_type": comparison["facility_type"].astype(str),
+            "volume_group": pd.cut(
+                hourly_count,
+                volume_group_bins,
+                labels=volume_group_labels,
+                right=False,
+            ),
+            "direction": comparison["direction"],
+            "stations": 1,
+            "count": comparison["count"],
+            "model_volume": comparison["model_volume"],
+            "squared_error": error**2,
+            "GEH": station_geh,
+            "GEH<5": station_geh < 5,
+        }
+    )
+    sums = []
+    for grouping in groupings:
+        grouping_sums = (
+            stats_inputs.groupby(
+                ["model_run", "time_period"] + grouping, observed=True
+            )[
+                [
+                    "stations",
+                    "count",
+                    "model_volume",
+                    "squared_error",
+                    "GEH",
+                    "GEH<5",
+                ]
+            ]
+            .sum()
+            .reset_index()
+        )
+        if grouping:
+            (col,) = grouping
+            grouping_sums = grouping_sums.rename(columns={col: "group"})
+            grouping_sums["grouping"] = col
+        else:
+            grouping_sums["group"] = all_label
+            grouping_sums["grouping"] = all_label
+        sums.append(grouping_sums)
+    sums = pd.concat(sums, ignore_index=True).set_index(
+        ["model_run", "time_period", "grouping", "group"]
+    )
+    stations = sums["stations"]
+    rmse = np.sqrt(sums["squared_error"] / stations)
+    return pd.DataFrame(
+        {
+            "stations": stations,
+            "count": sums["count"],
+            "model_volume": sums["model_volume"],
+            "ratio": sums["model_volume"] / sums["count"],
+            "RMSE": rmse,
+            "%RMSE": rmse / (sums["count"] / stations) * 100,
+            "mean_GEH": sums["GEH"] / stations,
+            "%GEH<5": sums["GEH<5"] / stations * 100,
+        }
+    )
+
+
+def parse_model_run(model_run: str) -> tuple[str, Path]:
+    """e.g. "base=X:/run" -> ("base", X:/run); "X:/run" -> ("run", X:/run)"""
+    name, sep, model_run_dir = model_run.partition("=")
+    if not sep:
+        return Path(model_run).name, Path(model_run)
+    return name, Path(model_run_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="validation statistics of model runs against counts"
+    )
+    parser.add_argument(
+        "comparison_filepath",
+        help="count-to-CHAMP-link comparison CSV (of sfmta_counts_18to20.py)",
+    )
+    parser.add_argument(
+        "model_runs",
+        nargs="+",
+        help="model run directories (with the LOAD{XX}_FINAL.csv), "
+        "optionally named as name=directory",
+    )
+    parser.add_argument(
+        "--out",
+        help="output directory (default: that of the comparison CSV)",
+    )
+    args = parser.parse_args()
+    out_dir = Path(args.out or Path(args.comparison_filepath).parent)
+    model_runs = dict(map(parse_model_run, args.model_runs))
+    comparison = join_model_volumes(
+        count_stations(pd.read_csv(args.comparison_filepath)),
+        {
+            name: read_loaded_network_volumes(model_run_dir)
+            for name, model_run_dir in model_runs.items()
+        },
+    )
+    comparison.to_csv(out_dir / "count_vs_model-volumes.csv", index=False)
+    validation_stats(comparison).to_csv(
+        out_dir / "count_vs_model-validation_stats.csv"
+    )
+    write_profile(out_dir)
@@ -0,0 +1,178 @@
+"""
+Persistent cache of the geo-matching of count locations (street segments,
+e.g. parsed from the SFMTA count filenames) to CHAMP paths, so that rerunning
+the validation only geo-matches the new count locations, and those affected
+by the changes of the CHAMP network since the cache was written.
+
+The cache (JSON) records the edges (A, B, STREETNAME, TYPE) of the network
+the locations were matched on, and the candidate paths (of
+find_paths_from_streetnames()) of each location. With a new network, the
+edges that were added, removed or renamed are diffed, and a location is
+rematched if any of these changed edges
+- has a node on one of its cached paths, or
+- has a street name matching (fuzzily) its primary or cross street names
+  (i.e. might be part of a new match).
+Changes of the edges' other attributes (e.g. DISTANCE, for the shortest path
+search) aren't detected; delete the cache file to rematch everything.
+"""
+
+import json
+import os
+from pathlib import Path
+
+import networkx as nx
+import pandas as pd
+from champ_network import (
+    find_paths_from_streetnames,
+    is_match_specific_street_name,
+)
+from profiling import profiled
+
+
+def _attribute(value):
+    return None if pd.isna(value) else str(value)
+
+
+def network_edges(champ_digraph: nx.DiGraph) -> set:
+    """The (A, B, STREETNAME, TYPE) of each edge of the CHAMP network"""
+    return {
+        (
+            int(A),
+            int(B),
+            _attribute(edge["STREETNAME"]),
+            _attribute(edge["TYPE"]),
+        )
+        for A, B, edge in champ_digraph.edges(data=True)
+    }
+
+
+def read_geomatch_cache(cache_filepath) -> tuple[set, dict]:
+    """Read the cache
+
+    Returns
+    -------
+    tuple[set, dict]
+        the network edges (of network_edges()) and the cached entries
+        ({key: {"streets": [primary_st_name, primary_st_type,
+        cross_st_1_name, cross_st_2_name], "paths": [path, ...]}}), both
+        empty if there is no cache
+    """
+    try:
+        with open(cache_filepath) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return set(), {}
+    return set(map(tuple, cache["edges"])), cache["entries"]
+
+
+def write_geomatch_cache(cache_filepath, edges: set, entries: dict):
+    cache_filepath = Path(cache_filepath)
+    # write then rename, so that an interrupted run can't corrupt it
+    tmp_filepath = cache_filepath.with_suffix(".tmp")
+    with open(tmp_filepath, "w") as f:
+        json.dump(
+            {
+                "edges": sorted(edges, key=lambda edge: edge[:2]),
+                "entries": entries,
+            },
+            f,
+        )
+    os.replace(tmp_filepath, cache_filepath)
+
+
+def find_street_segment_paths(champ_digraph: nx.DiGraph, street_segment):
+    """
+    find_paths_from_streetnames() of a street segment (primary_st_name,
+    primary_st_type, cross_st_1_name, cross_st_2_name; the cross streets'
+    types are ignored), as lists of (int) nodes
+    """
+    primary_st_name, primary_st_type, cross_st_1_name, cross_st_2_name = (
+        street_segment
+    )
+    return [
+        [int(node) for node in path]
+        for path in find_paths_from_streetnames(
+            champ_digraph,
+            primary_st_name,
+            primary_st_type,
+            cross_st_1_name,
+            None,
+            cross_st_2_name,
+            None,
+        )
+    ]
+
+
+def is_affected(entry: dict, changed_nodes: set, changed_names: set) -> bool:
+    """Whether the changed edges might change the geo-match of an entry
+
+    Parameters
+    ----------
+    entry : dict
+        cached entry (see read_geomatch_cache())
+    changed_nodes : set
+        end-nodes of the changed edges
+    changed_names : set
+        street names of the changed edges
+    """
+    if any(node in changed_nodes for path in entry["paths"] for node in path):
+        return True
+    primary_st_name, _, cross_st_1_name, cross_st_2_name = entry["streets"]
+    return any(
+        is_match_specific_street_name(changed_name, name, fuzzy=True)
+        for changed_name in changed_names
+        for name in (primary_st_name, cross_st_1_name, cross_st_2_name)
+        if name is not None
+    )
+
+
+@profiled
+def geomatch_with_cache(
+    champ_digraph: nx.DiGraph, street_segments: dict, cache_filepath
+) -> dict:
+    """Geo-match the street segments to CHAMP paths, reusing the cache
+
+    Parameters
+    ----------
+    champ_digraph : nx.DiGraph
+        output of load_champ_network()
+    street_segments : dict
+        {key (e.g. count filename): (primary_st_name, primary_st_type,
+        cross_st_1_name, cross_st_2_name)}
+    cache_filepath : str | Path
+        the cache file, (re)written with the entries of street_segments
+
+    Returns
+    -------
+    dict
+        {key: list of paths (output of find_paths_from_streetnames())}
+    """
+    cached_edges, entries = read_geomatch_cache(cache_filepath)
+    edges = network_edges(champ_digraph)
+    # (no cache: nothing to invalidate)
+    changed_edges = cached_edges ^ edges if entries else set()
+    changed_nodes = {node for A, B, _, _ in changed_edges for node in (A, B)}
+    changed_names = {name for _, _, name, _ in changed_edges if name}
+
+    paths = {}
+    reused = affected = 0
+    new_entries = {}
+    for key, streets in street_segments.items():
+        streets = list(streets)
+        entry = entries.get(key)
+        if entry is not None and entry["streets"] == streets:
+            if not is_affected(entry, changed_nodes, changed_names):
+                reused += 1
+                new_entries[key] = entry
+                paths[key] = entry["paths"]
+                continue
+            affected += 1
+        paths[key] = find_street_segment_paths(champ_digraph, streets)
+        new_entries[key] = {"streets": streets, "paths": paths[key]}
+    print(
+        f"geo-matching: {reused} reused from the cache, "
+        f"{len(street_segments) - reused} matched "
+        f"({affected} affected by {len(changed_edges)} changed edges)"
+    )
+    write_geomatch_cache(cache_filepath, edges, new_entries)
+    return paths
@@ -0,0 +1,20 @@
+"""
+The validation scripts' profiling: mtc_model_consistency/profiling.py (see
+its docstring), which can't be imported directly as the validation scripts
+are run from this directory. This module replaces itself (in sys.modules)
+with it.
+"""
+
+import importlib.util
+import sys
+from pathlib import Path
+
+_spec = importlib.util.spec_from_file_location(
+    __name__,
+    Path(__file__).resolve().parent.parent
+    / "mtc_model_consistency"
+    / "profiling.py",
+)
+_profiling = importlib.util.module_from_spec(_spec)
+sys.modules[__name__] = _profiling
+_spec.loader.exec_module(_profiling)
@@ -7,11 +7,13 @@ from pathlib import Path
 import pandas as pd
 
 from champ_network import (
-    filter_by_direction,
-    find_paths_from_streetnames,
+    filter_paths_by_direction,
+    get_node_coordinates,
     load_champ_network,
     read_champ_nodes,
 )
+from geomatch_cache import find_street_segment_paths, geomatch_with_cache
+from profiling import profiled, write_profile
 
 sfmta_counts_dir = (
     r"Q:\Data\Observed\Streets\Counts\PreCountDracula"
@@ -60,6 +62,7 @@ def _parse_time(t: str | datetime | time) -> time:
             return t
 
 
+@profiled
 def load_counts_sheet(filename, direction, sfmta_counts_dir=sfmta_counts_dir):
     filepath = Path(sfmta_counts_dir, filename)
     # the UC col are counts where there are no associated speed data
@@ -154,9 +157,17 @@ def bin_count_totals_by_champ_periods(count_totals):
     return binned_count_totals
 
 
+@profiled
 def compare_sfmta_counts_to_champ_network(
-    champ_nodes, champ_digraph, sfmta_counts_dir=sfmta_counts_dir
+    node_coords,
+    champ_digraph,
+    sfmta_counts_dir=sfmta_counts_dir,
+    geomatch_cache_filepath=None,
 ):
+    """
+    geomatch_cache_filepath: if given, reuse the geo-matches of the count
+    files (to CHAMP paths) cached there (see geomatch_cache.py)
+    """
     filename_parse_skipped = []
     counts_extract_skipped = []
     geomatch_skipped = []
@@ -164,32 +175,55 @@ def compare_sfmta_counts_to_champ_network(
 
     comparison_df_rows = []  # the output
 
+    parsed_filenames = {}
     for p in Path(sfmta_counts_dir).glob("*.xls*"):
-        # without maybe monads, `continue` is cleaner than using nested
-        # if-else/try-except structures
         parsed_filename = parse_filename(p.name)
         if not parsed_filename:  # if None
             filename_parse_skipped.append(p.name)
             print("can't parse filename:", p.name)
             continue
-        (
+        parsed_filenames[p.name] = parsed_filename
+    street_segments = {
+        filename: (
             primary_st_name,
             primary_st_type,
-            directions,
             cross_st_1_name,
             cross_st_2_name,
-        ) = parsed_filename
-        champ_paths_found = find_paths_from_streetnames(
-            champ_digraph,
+        )
+        for filename, (
             primary_st_name,
             primary_st_type,
+            _,
             cross_st_1_name,
-            None,
             cross_st_2_name,
-            None,
+        ) in parsed_filenames.items()
+    }
+    if geomatch_cache_filepath is None:
+        champ_paths_by_filename = {
+            filename: find_street_segment_paths(champ_digraph, street_segment)
+            for filename, street_segment in street_segments.items()
+        }
+    else:
+        champ_paths_by_filename = geomatch_with_cache(
+            champ_digraph, street_segments, geomatch_cache_filepath
         )
+
+    # geo-match every count file first, so that the directions of all the
+    # candidate paths (of all the count files) can be classified in one call
+    geomatched = []  # (filename, parsed_filename, direction, champ_paths)
+    for filename, parsed_filename in parsed_filenames.items():
+        # without maybe monads, `continue` is cleaner than using nested
+        # if-else/try-except structures
+        (
+            primary_st_name,
+            primary_st_type,
+            directions,
+            cross_st_1_name,
+            cross_st_2_name,
+        ) = parsed_filename
+        champ_paths_found = champ_paths_by_filename[filename]
         if not champ_paths_found:  # if []
-            geomatch_skipped.append(p.name)
+            geomatch_skipped.append(filename)
             print(
                 "geo-matching unsuccessful; paths not found:",
                 f"{primary_st_name}/{primary_st_type}",
@@ -199,41 +233,58 @@ def compare_sfmta_counts_to_champ_network(
             )
             continue
         for direction in directions:
-            try:
-                champ_path = filter_by_direction(
-                    champ_nodes, champ_paths_found, direction
-                )
-            except:
-                geomatch_direction_skipped.append([p.name, direction])
-                print(
-                    f"can't find direction {direction} in:",
-                    f"{primary_st_name}/{primary_st_type}",
-                    directions,
-                    cross_st_1_name,
-                    cross_st_2_name,
-                )
-                continue
-            try:
-                count_totals = bin_count_totals_by_champ_periods(
-                    get_counts_totals(load_counts_sheet(p.name, direction))
+            geomatched.append(
+                (filename, parsed_filename, direction, champ_paths_found)
+            )
+
+    champ_paths = filter_paths_by_direction(
+        node_coords,
+        [champ_paths_found for _, _, _, champ_paths_found in geomatched],
+        [direction for _, _, direction, _ in geomatched],
+    )
+    for (filename, parsed_filename, direction, _), champ_path in zip(
+        geomatched, champ_paths
+    ):
+        (
+            primary_st_name,
+            primary_st_type,
+            directions,
+            cross_st_1_name,
+            cross_st_2_name,
+        ) = parsed_filename
+        if champ_path is None:
+            geomatch_direction_skipped.append([filename, direction])
+            print(
+                f"can't find direction {direction} in:",
+                f"{primary_st_name}/{primary_st_type}",
+                directions,
+                cross_st_1_name,
+                cross_st_2_name,
+            )
+            continue
+        try:
+            count_totals = bin_count_totals_by_champ_periods(
+                get_counts_totals(
+                    load_counts_sheet(filename, direction, sfmta_counts_dir)
                 )
-            except (ValueError, RuntimeError):
-                counts_extract_skipped.append([p.name, direction])
-                print("can't extract counts from", direction, p.name)
-                continue
-            row = count_totals.to_dict()  # or maybe consider using OrderedDict
-            # now join the count_totals to the champ_path
-            # add identifying info to the Series count_totals,
-            # to prepare for turning into a row of the output_df later
-            row["primary_st_name"] = primary_st_name
-            row["primary_st_type"] = primary_st_type
-            row["cross_st_1_name"] = cross_st_1_name
-            row["cross_st_2_name"] = cross_st_2_name
-            row["direction"] = direction
-            for A, B in pairwise(champ_path):
-                # beware of mutability,
-                # thus not adding champ_nodes to row directly
-                comparison_df_rows.append(row | {"CHAMP_A": A, "CHAMP_B": B})
+            )
+        except (ValueError, RuntimeError):
+            counts_extract_skipped.append([filename, direction])
+            print("can't extract counts from", direction, filename)
+            continue
+        row = count_totals.to_dict()  # or maybe consider using OrderedDict
+        # now join the count_totals to the champ_path
+        # add identifying info to the Series count_totals,
+        # to prepare for turning into a row of the output_df later
+        row["primary_st_name"] = primary_st_name
+        row["primary_st_type"] = primary_st_type
+        row["cross_st_1_name"] = cross_st_1_name
+        row["cross_st_2_name"] = cross_st_2_name
+        row["direction"] = direction
+        for A, B in pairwise(champ_path):
+            # beware of mutability,
+            # thus not adding champ_nodes to row directly
+            comparison_df_rows.append(row | {"CHAMP_A": A, "CHAMP_B": B})
     columns = [
         "CHAMP_A",
         "CHAMP_B",
@@ -277,11 +328,19 @@ if __name__ == "__main__":
         r"\2018-2020\OneDrive_2023-05-15\2018-Feb 2020\_CHAMP_comparison"
         "\skipped-log.json"
     )
+    geomatch_cache_filepath = (
+        r"Q:\Data\Observed\Streets\Counts\PreCountDracula"
+        r"\2018-2020\OneDrive_2023-05-15\2018-Feb 2020\_CHAMP_comparison"
+        r"\geomatch-cache.json"
+    )
     champ_nodes = read_champ_nodes(champ_nodes_gis_filepath)
     champ_digraph = load_champ_network(champ_links_gis_filepath, champ_nodes)
     comparison_df, skipped = compare_sfmta_counts_to_champ_network(
-        champ_nodes, champ_digraph
+        get_node_coordinates(champ_nodes),
+        champ_digraph,
+        geomatch_cache_filepath=geomatch_cache_filepath,
     )
     comparison_df.to_csv(comparison_df_filepath, index=False)
     with open(skipped_log_filepath, "w") as f:
         json.dump(skipped, f, indent=2)
+    write_profile(Path(comparison_df_filepath).parent)